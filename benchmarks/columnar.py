@@ -0,0 +1,115 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Compare the memory used by buffered spans held in a list with a
+# ColumnarSpanBuffer, and the cost of filling and formatting each.
+#
+# > python benchmarks/columnar.py
+#
+
+from __future__ import print_function
+
+import gc
+import sys
+import timeit
+import types
+
+from tryfer.columnar import ColumnarSpanBuffer
+from tryfer.formatters import json_formatter
+from tryfer.trace import Trace, Annotation, Endpoint
+from tryfer.tracers import get_tracers
+
+SPANS = 10000
+
+_ENDPOINTS = [Endpoint('10.0.0.{0}'.format(i), 8080, 'service-{0}'.format(i))
+              for i in range(4)]
+
+# Objects which outlive the buffer and so are not counted against it.
+_SHARED = (type, types.ModuleType, types.FunctionType, types.ClassType,
+           types.BuiltinFunctionType)
+
+
+def _spans():
+    root = Trace('request', tracers=[])
+
+    for i in xrange(SPANS):
+        trace = root.child('call-{0}'.format(i % 8))
+        endpoint = _ENDPOINTS[i % len(_ENDPOINTS)]
+        annotations = [Annotation.client_send(1400000000000000 + i),
+                       Annotation.client_recv(1400000000001000 + i)]
+
+        if i % 4 == 0:
+            annotations.append(Annotation.string('http.uri', '/path'))
+
+        for annotation in annotations:
+            annotation.endpoint = endpoint
+
+        yield (trace, annotations)
+
+
+def _deep_size(obj, shared):
+    seen = set(id(o) for o in shared)
+    pending = [obj]
+    size = 0
+
+    while pending:
+        o = pending.pop()
+
+        if id(o) in seen or isinstance(o, _SHARED):
+            continue
+
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        pending.extend(gc.get_referents(o))
+
+    return size
+
+
+def _fill(factory):
+    buffer = factory()
+    buffer.extend(_spans())
+    return buffer
+
+
+if __name__ == '__main__':
+    shared = [get_tracers()] + _ENDPOINTS
+    shared.extend(e.__dict__ for e in _ENDPOINTS)
+
+    as_list = _fill(list)
+    columnar = _fill(ColumnarSpanBuffer)
+
+    list_size = _deep_size(as_list, shared)
+    columnar_size = _deep_size(columnar, shared)
+
+    print('{0} spans'.format(SPANS))
+    print('{0:<24} {1:8.1f} bytes/span'.format(
+        'list', float(list_size) / SPANS))
+    print('{0:<24} {1:8.1f} bytes/span'.format(
+        'ColumnarSpanBuffer', float(columnar_size) / SPANS))
+    print('{0:<24} {1:8.1f}x'.format(
+        'reduction', float(list_size) / columnar_size))
+    print()
+
+    for (label, factory) in [('list', list),
+                             ('ColumnarSpanBuffer', ColumnarSpanBuffer)]:
+        spans = list(_spans())
+
+        def _run():
+            buffer = factory()
+            buffer.extend(spans)
+            json_formatter(list(buffer))
+
+        seconds = min(timeit.repeat(_run, number=1, repeat=3))
+        print('{0:<24} {1:8.2f} us/span fill and format'.format(
+            label, seconds / SPANS * 1e6))
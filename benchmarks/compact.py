@@ -0,0 +1,81 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Compare the size and encoding time of a batch of spans in each format.
+#
+# > python benchmarks/compact.py
+#
+
+from __future__ import print_function
+
+import random
+import timeit
+
+from tryfer.formatters import (
+    json_formatter,
+    compact_formatter,
+    thrift_spans_formatter,
+    base64_thrift_messages_formatter
+)
+from tryfer.loadgen import record_trace_tree
+from tryfer.tracers import EndAnnotationTracer
+
+TREES = 10
+NUMBER = 20
+
+
+class _Collect(object):
+    def __init__(self):
+        self.traces = []
+
+    def record(self, traces):
+        self.traces.extend(traces)
+
+
+def _batch():
+    collect = _Collect()
+    tracer = EndAnnotationTracer(collect)
+    rng = random.Random(0)
+
+    for i in xrange(TREES):
+        record_trace_tree(tracer, depth=3, fanout=3, _random=rng,
+                          _time=lambda: 1400000000.0)
+
+    return collect.traces
+
+
+def _base64_thrift(traces):
+    return '\n'.join(base64_thrift_messages_formatter(traces))
+
+
+if __name__ == '__main__':
+    traces = _batch()
+    print('{0} spans per batch'.format(len(traces)))
+
+    json_size = None
+
+    for (label, formatter) in [('json_formatter', json_formatter),
+                               ('compact_formatter', compact_formatter),
+                               ('thrift_spans_formatter',
+                                thrift_spans_formatter),
+                               ('base64 thrift (scribe)', _base64_thrift)]:
+        size = len(formatter(traces))
+        json_size = json_size or size
+
+        seconds = min(timeit.repeat(lambda: formatter(traces),
+                                    number=NUMBER, repeat=3))
+
+        print('{0:<24} {1:7.1f} bytes/span ({2:4.0%}) {3:7.2f} us/span'.format(
+            label, float(size) / len(traces), float(size) / json_size,
+            seconds / (NUMBER * len(traces)) * 1e6))
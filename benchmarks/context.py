@@ -0,0 +1,68 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Measure the per-callback overhead of tryfer.context.install().
+#
+# > python benchmarks/context.py
+#
+
+from __future__ import print_function
+
+import timeit
+
+from twisted.internet.defer import Deferred
+
+from tryfer import context
+from tryfer.trace import Trace
+
+CALLBACKS = 10
+NUMBER = 20000
+
+
+def _identity(result):
+    return result
+
+
+def _chain():
+    d = Deferred()
+    for x in range(CALLBACKS):
+        d.addCallback(_identity)
+    d.callback(None)
+
+
+def _run(label, f):
+    seconds = min(timeit.repeat(f, number=NUMBER, repeat=3))
+    per_callback = seconds / (NUMBER * CALLBACKS) * 1e9
+    print('{0:<32} {1:8.1f} ns/callback'.format(label, per_callback))
+    return per_callback
+
+
+if __name__ == '__main__':
+    trace = Trace('benchmark', tracers=[])
+
+    baseline = _run('not installed', _chain)
+
+    context.install()
+    try:
+        idle = _run('installed, no current trace', _chain)
+        active = _run('installed, current trace',
+                      lambda: context.call_with_trace(trace, _chain))
+    finally:
+        context.uninstall()
+
+    print()
+    print('overhead without trace: {0:+.1f} ns/callback'.format(
+        idle - baseline))
+    print('overhead with trace:    {0:+.1f} ns/callback'.format(
+        active - baseline))
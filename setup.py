@@ -21,4 +21,10 @@ setup(
         'thrift == 0.8.0',
         'scrivener == 0.2'
     ],
+    extras_require={
+        'asyncio:python_version < "3.4"': ['trollius']
+    },
+    entry_points={
+        'console_scripts': ['tryfer = tryfer.cli:main'],
+    },
 )
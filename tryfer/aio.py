@@ -0,0 +1,681 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tracers for services running on an asyncio event loop rather than the
+Twisted reactor.
+
+The classes here mirror their namesakes in L{tryfer.tracers} and share the
+same formatters, so moving a service between runtimes only changes which
+module its tracers are imported from.  They are written with callbacks
+rather than coroutines so that they work with both C{asyncio} and its
+Python 2 backport C{trollius}.
+
+Errors are logged with the standard library C{logging} module, under the
+C{tryfer} logger, since Twisted's log is not usually observed by asyncio
+services.
+"""
+
+from __future__ import absolute_import
+
+import struct
+import logging
+
+from collections import deque
+from urlparse import urlparse
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from zope.interface import implements
+
+from thrift.Thrift import TMessageType, TApplicationException
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
+
+from scrivener._thrift.scribe import scribe, ttypes as scribe_ttypes
+
+from tryfer import tracers
+from tryfer.interfaces import ITracer
+from tryfer.formatters import json_formatter, base64_thrift_messages_formatter
+
+_log = logging.getLogger('tryfer')
+
+
+def _log_errors(future, message):
+    def _done(future):
+        if not future.cancelled() and future.exception() is not None:
+            _log.error(message, exc_info=future.exception())
+
+    future.add_done_callback(_done)
+    return future
+
+
+def _checked(future, check, loop, *args):
+    """
+    @returns: An C{asyncio.Future} of C{check(result, *args)} once C{future}
+        has a result, or of C{future}'s exception.
+    """
+    checked = asyncio.Future(loop=loop)
+
+    def _done(future):
+        if checked.done():
+            return
+
+        if future.cancelled():
+            checked.cancel()
+        elif future.exception() is not None:
+            checked.set_exception(future.exception())
+        else:
+            try:
+                checked.set_result(check(future.result(), *args))
+            except Exception as e:
+                checked.set_exception(e)
+
+    future.add_done_callback(_done)
+    return checked
+
+
+def _check_scribe_result(result, category):
+    if result == scribe_ttypes.ResultCode.TRY_LATER:
+        raise tracers.DeliveryError(
+            "Scribe asked to try later for category: {0}".format(category))
+
+    return result
+
+
+def drain(tracer, loop=None):
+    """
+    Ask C{tracer} to send everything it has buffered, if it buffers.
+
+    @returns: An C{asyncio.Future} which completes once the tracer's
+        deliveries have finished.
+    """
+    drain = getattr(tracer, 'drain', None)
+    result = drain() if drain is not None else None
+
+    if isinstance(result, asyncio.Future):
+        return result
+
+    future = asyncio.Future(loop=loop)
+    future.set_result(result)
+    return future
+
+
+def _gather(futures, loop):
+    return asyncio.gather(*futures, loop=loop, return_exceptions=True)
+
+
+class BufferingTracer(object):
+    """
+    Buffer traces and defer recording until C{max_traces} have been received
+    or C{max_idle_time} has elapsed since the last trace was recorded.
+
+    The idle flush uses a single C{loop.call_later} timer which is only
+    re-armed when it fires early, rather than being rescheduled for every
+    recorded trace.
+
+    @param tracer: An L{ITracer} provider to record buffered traces to.
+
+    @param max_traces: C{int}.  Default 50.
+
+    @param max_idle_time: C{int} or C{float} seconds.  Default 10.
+
+    @param loop: The event loop.  Default: C{asyncio.get_event_loop()}.
+    """
+    implements(ITracer)
+
+    def __init__(self, tracer, max_traces=50, max_idle_time=10, loop=None):
+        self._tracer = tracer
+        self._max_traces = max_traces
+        self._max_idle_time = max_idle_time
+        self._loop = loop or asyncio.get_event_loop()
+
+        self._buffer = []
+        self._deadline = None
+        self._timer = None
+        self._flush_soon = None
+        self._in_flight = set()
+
+    def _idle(self):
+        self._timer = None
+
+        if self._deadline is None:
+            return
+
+        delay = self._deadline - self._loop.time()
+
+        if delay > 0:
+            self._timer = self._loop.call_later(delay, self._idle)
+        else:
+            self._flush()
+
+    def _flush(self):
+        self._flush_soon = None
+        self._deadline = None
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        flushable = self._buffer
+        self._buffer = []
+
+        if flushable:
+            future = self._tracer.record(flushable)
+
+            if isinstance(future, asyncio.Future) and not future.done():
+                self._in_flight.add(future)
+                future.add_done_callback(self._in_flight.discard)
+
+    def record(self, traces):
+        self._buffer.extend(traces)
+
+        if len(self._buffer) >= self._max_traces or not self._max_idle_time:
+            if self._flush_soon is None:
+                self._flush_soon = self._loop.call_soon(self._flush)
+
+        else:
+            self._deadline = self._loop.time() + self._max_idle_time
+
+            if self._timer is None:
+                self._timer = self._loop.call_later(
+                    self._max_idle_time, self._idle)
+
+    def drain(self):
+        """
+        Flush the buffer now, then drain the next tracer and wait for every
+        delivery still in flight.
+        """
+        if self._flush_soon is not None:
+            self._flush_soon.cancel()
+
+        self._flush()
+
+        return _gather([drain(self._tracer, self._loop)] +
+                       list(self._in_flight), self._loop)
+
+
+class _ResponseProtocol(asyncio.Protocol):
+    """
+    A connection which carries one request at a time, and hands each
+    complete response to C{parse}.
+    """
+
+    def __init__(self, lost):
+        self._lost = lost
+        self._future = None
+        self._buffer = b''
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self, data, future):
+        self._future = future
+        self._buffer = b''
+        self.transport.write(data)
+
+    def data_received(self, data):
+        self._buffer += data
+
+        if self._future is None:
+            return
+
+        try:
+            result = self.parse(self._buffer)
+        except Exception as e:
+            self._finish(exception=e)
+            self.transport.close()
+        else:
+            if result is not None:
+                self._finish(result)
+
+    def _finish(self, result=None, exception=None):
+        future, self._future = self._future, None
+
+        if future.done():
+            return
+
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def connection_lost(self, exc):
+        if self._future is not None:
+            self._finish(exception=exc or ConnectionLost())
+
+        self._lost(self)
+
+
+class ConnectionLost(Exception):
+    """
+    The connection closed before a complete response was received.
+    """
+
+
+def _chunked_complete(body):
+    """
+    @returns: C{True} if C{body} holds a whole chunked message body,
+        including any trailer.
+
+    @raises ValueError: If a chunk size is not hexadecimal.
+    """
+    offset = 0
+
+    while True:
+        end = body.find(b'\r\n', offset)
+
+        if end == -1:
+            return False
+
+        size = int(body[offset:end].split(b';', 1)[0], 16)
+        offset = end + 2
+
+        if size == 0:
+            break
+
+        # Skip the chunk's data and the CRLF which follows it.
+        offset += size + 2
+
+    # The last chunk is followed by trailer lines and an empty line.
+    while True:
+        end = body.find(b'\r\n', offset)
+
+        if end == -1:
+            return False
+
+        if end == offset:
+            return True
+
+        offset = end + 2
+
+
+class _HTTPProtocol(_ResponseProtocol):
+    def parse(self, data):
+        head, sep, body = data.partition(b'\r\n\r\n')
+
+        if not sep:
+            return None
+
+        lines = head.split(b'\r\n')
+        code = int(lines[0].split(None, 2)[1])
+        headers = dict(
+            (name.strip().lower(), value.strip())
+            for (name, _, value) in (line.partition(b':')
+                                     for line in lines[1:]))
+
+        if headers.get(b'transfer-encoding', b'').lower() == b'chunked':
+            if not _chunked_complete(body):
+                return None
+        elif len(body) < int(headers.get(b'content-length', 0)):
+            return None
+
+        if headers.get(b'connection', b'').lower() == b'close':
+            self.transport.close()
+
+        return code
+
+
+class _ScribeProtocol(_ResponseProtocol):
+    def parse(self, data):
+        if len(data) < 4:
+            return None
+
+        (length,) = struct.unpack('!i', data[:4])
+
+        if len(data) < 4 + length:
+            return None
+
+        iprot = TBinaryProtocol.TBinaryProtocol(
+            TTransport.TMemoryBuffer(data[4:4 + length]))
+        (_, mtype, _) = iprot.readMessageBegin()
+
+        if mtype == TMessageType.EXCEPTION:
+            x = TApplicationException()
+            x.read(iprot)
+            raise x
+
+        result = scribe.Log_result()
+        result.read(iprot)
+        return result.success
+
+
+class _PersistentClient(object):
+    """
+    Send requests one at a time over a single reused connection, which is
+    re-established when it closes.
+
+    A request which has not been answered within C{timeout} seconds of being
+    made fails with C{asyncio.TimeoutError}.  If it had already been sent
+    the connection is closed, so that its late response is not taken for the
+    next one's.
+    """
+
+    protocol = None
+
+    def __init__(self, host, port, ssl=None, loop=None, timeout=30):
+        self._host = host
+        self._port = port
+        self._ssl = ssl
+        self._loop = loop or asyncio.get_event_loop()
+        self._timeout = timeout
+
+        self._queue = deque()
+        self._connection = None
+        self._connecting = False
+        self._busy = False
+
+    def request(self, data):
+        """
+        @returns: An C{asyncio.Future} of the parsed response.
+        """
+        future = asyncio.Future(loop=self._loop)
+        self._queue.append((data, future))
+        self._next()
+
+        return asyncio.ensure_future(
+            asyncio.wait_for(future, self._timeout, loop=self._loop),
+            loop=self._loop)
+
+    def _next(self):
+        while self._queue and self._queue[0][1].done():
+            # Timed out while waiting for its turn.
+            self._queue.popleft()
+
+        if self._busy or self._connecting or not self._queue:
+            return
+
+        if self._connection is None:
+            self._connecting = True
+            connect = asyncio.ensure_future(
+                asyncio.wait_for(
+                    self._loop.create_connection(
+                        lambda: self.protocol(self._lost),
+                        self._host, self._port, ssl=self._ssl),
+                    self._timeout, loop=self._loop),
+                loop=self._loop)
+            connect.add_done_callback(self._connected)
+            return
+
+        data, future = self._queue.popleft()
+        self._busy = True
+        future.add_done_callback(self._done)
+        self._connection.send(data, future)
+
+    def _connected(self, connect):
+        self._connecting = False
+
+        if connect.exception() is not None:
+            # Fail the request which prompted the connection attempt rather
+            # than retrying forever while the server is down.
+            if self._queue:
+                data, future = self._queue.popleft()
+
+                if not future.done():
+                    future.set_exception(connect.exception())
+        else:
+            _, self._connection = connect.result()
+
+        self._next()
+
+    def _done(self, future):
+        self._busy = False
+
+        if future.cancelled() and self._connection is not None:
+            self._connection.transport.close()
+            self._connection = None
+
+        self._next()
+
+    def _lost(self, connection):
+        if self._connection is connection:
+            self._connection = None
+
+        self._next()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.transport.close()
+
+
+class HTTPClient(_PersistentClient):
+    """
+    A minimal HTTP/1.1 client which POSTs to one URL over a kept-alive
+    connection.
+    """
+    protocol = _HTTPProtocol
+
+    def __init__(self, url, loop=None, timeout=30):
+        parsed = urlparse(url)
+        https = parsed.scheme == 'https'
+
+        _PersistentClient.__init__(
+            self, parsed.hostname, parsed.port or (443 if https else 80),
+            ssl=https or None, loop=loop, timeout=timeout)
+
+        self._path = (parsed.path or '/') + (
+            '?' + parsed.query if parsed.query else '')
+        self._host_header = parsed.netloc
+
+    def post(self, body):
+        """
+        @returns: An C{asyncio.Future} of the C{int} response code.
+        """
+        return self.request(
+            b'POST {0} HTTP/1.1\r\n'
+            b'Host: {1}\r\n'
+            b'Content-Type: application/json\r\n'
+            b'Content-Length: {2}\r\n'
+            b'\r\n'.format(self._path, self._host_header, len(body)) + body)
+
+
+class ScribeClient(_PersistentClient):
+    """
+    A scribe client speaking framed binary thrift over a reused connection.
+    """
+    protocol = _ScribeProtocol
+
+    def __init__(self, host, port, loop=None, timeout=30):
+        _PersistentClient.__init__(self, host, port, loop=loop,
+                                   timeout=timeout)
+        self._seqid = 0
+
+    def log(self, category, messages):
+        """
+        @returns: An C{asyncio.Future} of the scribe C{ResultCode}.
+        """
+        self._seqid += 1
+
+        trans = TTransport.TMemoryBuffer()
+        oprot = TBinaryProtocol.TBinaryProtocol(trans)
+        oprot.writeMessageBegin('Log', TMessageType.CALL, self._seqid)
+        scribe.Log_args(
+            messages=[scribe_ttypes.LogEntry(category, message)
+                      for message in messages]).write(oprot)
+        oprot.writeMessageEnd()
+
+        frame = trans.getvalue()
+        return self.request(struct.pack('!i', len(frame)) + frame)
+
+
+class RawRESTkinHTTPTracer(object):
+    """
+    Send annotations to RESTkin over HTTP as JSON objects, immediately.
+
+    @param trace_url: The URL to the RESTkin trace API endpoint as a C{str}.
+
+    @param loop: The event loop.  Default: C{asyncio.get_event_loop()}.
+
+    @param timeout: C{int} or C{float} seconds to wait for each request.
+        Default 30.
+    """
+    implements(ITracer)
+
+    formatter = staticmethod(json_formatter)
+
+    def __init__(self, trace_url, loop=None, timeout=30):
+        self._trace_url = trace_url
+        self._loop = loop or asyncio.get_event_loop()
+        self._client = HTTPClient(trace_url, self._loop, timeout)
+
+    def record(self, traces):
+        return self.deliver(self.formatter(traces))
+
+    def _check_code(self, code):
+        if not 200 <= code < 300:
+            raise tracers.DeliveryError("{0} responded with {1}".format(
+                self._trace_url, code))
+
+        return code
+
+    def deliver(self, body):
+        return _log_errors(
+            _checked(self._client.post(body), self._check_code, self._loop),
+            "Error sending trace to: {0}".format(self._trace_url))
+
+
+class RawRESTkinScribeTracer(object):
+    """
+    Send annotations to RESTkin as JSON objects over scribe, immediately.
+
+    @param host: C{str} scribe host.
+    @param port: C{int} scribe port.
+    @param category: The scribe category as a C{str}.  Default 'restkin'.
+    @param loop: The event loop.  Default: C{asyncio.get_event_loop()}.
+    @param timeout: C{int} or C{float} seconds to wait for each request.
+        Default 30.
+    """
+    implements(ITracer)
+
+    formatter = staticmethod(json_formatter)
+
+    def __init__(self, host, port, category=None, loop=None, timeout=30):
+        self._loop = loop or asyncio.get_event_loop()
+        self._client = ScribeClient(host, port, self._loop, timeout)
+        self._category = category or 'restkin'
+
+    def record(self, traces):
+        return self.deliver(self.formatter(traces))
+
+    def _log(self, messages):
+        return _log_errors(
+            _checked(self._client.log(self._category, messages),
+                     _check_scribe_result, self._loop, self._category),
+            "Error sending trace to scribe category: {0}".format(
+                self._category))
+
+    def deliver(self, message):
+        return self._log([message])
+
+
+class RawZipkinTracer(RawRESTkinScribeTracer):
+    """
+    Send annotations to Zipkin as base64 encoded thrift objects over scribe,
+    immediately.
+
+    @param category: The scribe category as a C{str}.  Default 'zipkin'.
+    """
+
+    formatter = staticmethod(base64_thrift_messages_formatter)
+
+    def __init__(self, host, port, category=None, loop=None, timeout=30):
+        RawRESTkinScribeTracer.__init__(
+            self, host, port, category or 'zipkin', loop, timeout)
+
+    def deliver(self, messages):
+        return self._log(messages)
+
+
+class EndAnnotationTracer(tracers.EndAnnotationTracer):
+    """
+    L{tryfer.tracers.EndAnnotationTracer} whose L{drain} returns the next
+    tracer's C{asyncio.Future} rather than a L{Deferred}.
+    """
+
+    def drain(self):
+        self._send_unfinished()
+        return drain(self._tracer)
+
+
+class ZipkinTracer(object):
+    """
+    EndAnnotationTracer(BufferingTracer(RawZipkinTracer(host, port))).
+    """
+    implements(ITracer)
+
+    def __init__(self, host, port, category=None, end_annotations=None,
+                 max_traces=50, max_idle_time=10, loop=None):
+        self._tracer = EndAnnotationTracer(
+            BufferingTracer(
+                RawZipkinTracer(host, port, category, loop),
+                max_traces=max_traces,
+                max_idle_time=max_idle_time,
+                loop=loop),
+            end_annotations=end_annotations)
+
+    def record(self, traces):
+        return self._tracer.record(traces)
+
+    def drain(self):
+        return self._tracer.drain()
+
+
+class RESTkinHTTPTracer(object):
+    """
+    EndAnnotationTracer(BufferingTracer(RawRESTkinHTTPTracer(trace_url))).
+    """
+    implements(ITracer)
+
+    def __init__(self, trace_url, end_annotations=None, max_traces=50,
+                 max_idle_time=10, loop=None):
+        self._tracer = EndAnnotationTracer(
+            BufferingTracer(
+                RawRESTkinHTTPTracer(trace_url, loop),
+                max_traces=max_traces,
+                max_idle_time=max_idle_time,
+                loop=loop),
+            end_annotations=end_annotations)
+
+    def record(self, traces):
+        return self._tracer.record(traces)
+
+    def drain(self):
+        return self._tracer.drain()
+
+
+class RESTkinScribeTracer(object):
+    """
+    EndAnnotationTracer(BufferingTracer(RawRESTkinScribeTracer(host, port))).
+    """
+    implements(ITracer)
+
+    def __init__(self, host, port, category=None, end_annotations=None,
+                 max_traces=50, max_idle_time=10, loop=None):
+        self._tracer = EndAnnotationTracer(
+            BufferingTracer(
+                RawRESTkinScribeTracer(host, port, category, loop),
+                max_traces=max_traces,
+                max_idle_time=max_idle_time,
+                loop=loop),
+            end_annotations=end_annotations)
+
+    def record(self, traces):
+        return self._tracer.record(traces)
+
+    def drain(self):
+        return self._tracer.drain()
@@ -0,0 +1,518 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reassemble recorded spans into whole traces and find out where their time
+went, or look at recently recorded spans, without a round trip to Zipkin.
+"""
+
+import json
+import heapq
+
+from collections import OrderedDict
+
+from zope.interface import implements
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+
+from tryfer import log
+from tryfer.interfaces import ITracer
+from tryfer.tracers import get_flush_scheduler
+from tryfer.formatters import json_span, int_or_none
+
+
+class SpanNode(object):
+    """
+    A span within a L{TraceTree}.
+
+    The client and server halves of a span are recorded separately but
+    share a span id, so they are merged into a single node.
+
+    @ivar trace: The first L{ITrace} provider recorded for this span.
+    @ivar annotations: C{list} of every L{IAnnotation} recorded for it.
+    @ivar children: C{list} of child L{SpanNode}s, ordered by L{start}.
+    @ivar start: C{int} earliest timestamp in microseconds, or C{None}.
+    @ivar end: C{int} latest timestamp in microseconds, or C{None}.
+    @ivar self_time: C{int} microseconds of this span not covered by any of
+        its children.
+    """
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.annotations = []
+        self.children = []
+        self.start = None
+        self.end = None
+        self.self_time = 0
+
+    def add(self, annotations):
+        self.annotations.extend(annotations)
+
+        for annotation in annotations:
+            if annotation.annotation_type != 'timestamp':
+                continue
+
+            if self.start is None or annotation.value < self.start:
+                self.start = annotation.value
+
+            if self.end is None or annotation.value > self.end:
+                self.end = annotation.value
+
+    @property
+    def duration(self):
+        if self.start is None:
+            return 0
+
+        return self.end - self.start
+
+    def __repr__(self):
+        return ('{0.__class__.__name__}({0.trace.name!r}, '
+                'span_id={0.trace.span_id!r}, duration={0.duration!r})'
+                ).format(self)
+
+
+def _self_time(node):
+    """
+    The part of C{node} not covered by the union of its children.
+    """
+    if node.start is None:
+        return 0
+
+    covered = 0
+    cursor = node.start
+
+    for child in node.children:
+        if child.start is None:
+            continue
+
+        start = max(child.start, cursor)
+        end = min(child.end, node.end)
+
+        if end > start:
+            covered += end - start
+            cursor = end
+
+    return node.duration - covered
+
+
+def _critical_path(node):
+    """
+    The spans which determined when C{node} finished: working back from its
+    end, the last child to finish, then the last to finish before that one
+    started, and so on, for each of those children in turn.
+
+    Traces can be deep, so this walks the tree with an explicit stack rather
+    than recursing.
+    """
+    path = []
+    stack = [node]
+
+    while stack:
+        node = stack.pop()
+        path.append(node)
+        cursor = node.end
+
+        for child in sorted(node.children, key=lambda c: c.end, reverse=True):
+            if child.end is None or cursor is None:
+                continue
+
+            if child.end <= cursor:
+                stack.append(child)
+                cursor = child.start
+
+    return path
+
+
+class TraceTree(object):
+    """
+    The spans of one trace arranged by parent.
+
+    @ivar trace_id: C{int}
+    @ivar root: The root L{SpanNode}.  If the real root span was not
+        recorded this is the longest span without a recorded parent.
+    @ivar spans: C{list} of every L{SpanNode} in the trace.
+    @ivar critical_path: C{list} of L{SpanNode}s on the critical path, in
+        order of start time.
+    """
+
+    def __init__(self, trace_id, nodes):
+        self.trace_id = trace_id
+        self.spans = nodes.values()
+
+        roots = []
+
+        for node in self.spans:
+            parent = nodes.get(node.trace.parent_span_id)
+
+            if parent is None or parent is node:
+                roots.append(node)
+            else:
+                parent.children.append(node)
+
+        for node in self.spans:
+            node.children.sort(key=lambda c: c.start)
+            node.self_time = _self_time(node)
+
+        if not roots:
+            # Every span claims a parent, so parent ids form a cycle.  Break
+            # it at the longest span.
+            root = max(self.spans, key=lambda n: n.duration)
+            nodes[root.trace.parent_span_id].children.remove(root)
+            roots.append(root)
+
+        self.root = max(roots, key=lambda n: (
+            n.trace.parent_span_id is None, n.duration))
+
+        self.critical_path = sorted(_critical_path(self.root),
+                                    key=lambda n: n.start)
+
+    @property
+    def duration(self):
+        return self.root.duration
+
+    def format(self):
+        """
+        Render this tree as indented text, one span per line, with spans on
+        the critical path marked with C{*}.
+
+        @returns: C{str}
+        """
+        critical = set(id(node) for node in self.critical_path)
+        lines = []
+
+        stack = [(self.root, 0)]
+
+        while stack:
+            (node, depth) = stack.pop()
+
+            lines.append('{0}{1} {2} {3}us (self {4}us)'.format(
+                '*' if id(node) in critical else ' ',
+                '  ' * depth,
+                node.trace.name,
+                node.duration,
+                node.self_time))
+
+            stack.extend((child, depth + 1)
+                         for child in reversed(node.children))
+
+        return '\n'.join(lines)
+
+
+class _PendingTree(object):
+    def __init__(self, tracer, trace_id):
+        self._tracer = tracer
+        self.trace_id = trace_id
+        self.nodes = {}
+
+    def assemble(self):
+        self._tracer._assemble(self)
+
+
+class TraceTreeTracer(object):
+    """
+    An L{ITracer} which reassembles recorded spans into L{TraceTree}s and
+    keeps the slowest recent ones.
+
+    A trace is assembled once no spans for it have been recorded for
+    C{idle_time} seconds.  To bound memory at most C{max_pending} traces are
+    held awaiting assembly (beyond that the oldest is assembled early), and
+    at most C{max_spans} spans are kept for any one trace.
+
+    Slowest traces are kept for the current and previous C{window}, so
+    L{slowest} reflects recent traffic.
+
+    @param idle_time: C{int} or C{float} seconds.  Default 5.
+    @param max_pending: C{int}.  Default 1000.
+    @param max_spans: C{int}.  Default 1000.
+    @param keep: C{int} number of slowest traces to keep per window.
+        Default 10.
+    @param window: C{int} or C{float} seconds.  Default 60.
+    @param on_tree: Optional callable called with each assembled
+        L{TraceTree}.
+    @param flush_scheduler: See L{tryfer.tracers.BufferingTracer}
+    @param _reactor: An L{IReactorTime} provider.
+    """
+    implements(ITracer)
+
+    def __init__(self, idle_time=5, max_pending=1000, max_spans=1000,
+                 keep=10, window=60, on_tree=None, flush_scheduler=None,
+                 _reactor=None):
+        self._idle_time = idle_time
+        self._max_pending = max_pending
+        self._max_spans = max_spans
+        self._keep = keep
+        self._window = window
+        self._on_tree = on_tree
+
+        self._reactor = _reactor or reactor
+        self._scheduler = flush_scheduler or get_flush_scheduler(
+            self._reactor)
+
+        self._pending = OrderedDict()
+        self._current = []
+        self._previous = []
+        self._window_start = None
+
+        self.assembled = 0
+        self.dropped_spans = 0
+
+    def record(self, traces):
+        for (trace, annotations) in traces:
+            pending = self._pending.get(trace.trace_id)
+
+            if pending is None:
+                if len(self._pending) >= self._max_pending:
+                    self._assemble_early()
+
+                pending = self._pending[trace.trace_id] = _PendingTree(
+                    self, trace.trace_id)
+
+            node = pending.nodes.get(trace.span_id)
+
+            if node is None:
+                if len(pending.nodes) >= self._max_spans:
+                    self.dropped_spans += 1
+                    continue
+
+                node = pending.nodes[trace.span_id] = SpanNode(trace)
+
+            node.add(annotations)
+            self._scheduler.schedule(pending.assemble, self._idle_time)
+
+    def _assemble_early(self):
+        # Called from record, so an error here must not reach the code
+        # recording the trace.
+        try:
+            self._assemble(self._pending.itervalues().next())
+        except Exception:
+            log.err(None, "Error assembling trace.")
+
+    def _assemble(self, pending):
+        self._scheduler.cancel(pending.assemble)
+        del self._pending[pending.trace_id]
+
+        tree = TraceTree(pending.trace_id, pending.nodes)
+        self.assembled += 1
+
+        self._rotate()
+
+        entry = (tree.duration, self.assembled, tree)
+
+        if len(self._current) < self._keep:
+            heapq.heappush(self._current, entry)
+        elif entry > self._current[0]:
+            heapq.heapreplace(self._current, entry)
+
+        if self._on_tree is not None:
+            try:
+                self._on_tree(tree)
+            except Exception:
+                log.err(None, "Error handling assembled trace.")
+
+    def _rotate(self):
+        now = self._reactor.seconds()
+
+        if self._window_start is None:
+            self._window_start = now
+        elif now - self._window_start >= self._window:
+            if now - self._window_start >= 2 * self._window:
+                self._previous = []
+            else:
+                self._previous = self._current
+
+            self._current = []
+            self._window_start = now
+
+    def slowest(self):
+        """
+        @returns: C{list} of up to C{keep} L{TraceTree}s assembled in the
+            current or previous window, slowest first.
+        """
+        self._rotate()
+
+        entries = sorted(self._current + self._previous, reverse=True)
+        return [tree for (_, _, tree) in entries[:self._keep]]
+
+    def flush(self):
+        """
+        Assemble every pending trace now.
+        """
+        for pending in list(self._pending.values()):
+            self._assemble(pending)
+
+
+def _duration(annotations):
+    start = end = None
+
+    for annotation in annotations:
+        if annotation.annotation_type != 'timestamp':
+            continue
+
+        if start is None or annotation.value < start:
+            start = annotation.value
+
+        if end is None or annotation.value > end:
+            end = annotation.value
+
+    if start is None:
+        return 0
+
+    return end - start
+
+
+class RecentSpansTracer(object):
+    """
+    An L{ITracer} which keeps the last C{size} spans recorded to it in a
+    ring buffer, indexed by trace id and span name, for inspecting a live
+    process.  See L{RecentSpansResource}.
+
+    Memory is bounded by C{size} and recording a span costs O(1), as the
+    span it replaces is removed from the indexes.
+
+    Each recorded C{(trace, annotations)} is kept as one span, so to keep
+    only completed spans with all of their annotations, wrap it in an
+    L{EndAnnotationTracer}::
+
+        recent = RecentSpansTracer()
+        push_tracer(EndAnnotationTracer(recent))
+
+    @param size: C{int} number of spans to keep.  Default 1000.
+    """
+    implements(ITracer)
+
+    def __init__(self, size=1000):
+        self._size = size
+        self._slots = [None] * size
+        self._next = 0
+        self._recorded = 0
+
+        self._by_trace_id = {}
+        self._by_name = {}
+
+    def _index(self, index, key, slot):
+        slots = index.get(key)
+
+        if slots is None:
+            slots = index[key] = set()
+
+        slots.add(slot)
+
+    def _unindex(self, index, key, slot):
+        slots = index[key]
+        slots.discard(slot)
+
+        if not slots:
+            del index[key]
+
+    def record(self, traces):
+        for (trace, annotations) in traces:
+            slot = self._next
+            old = self._slots[slot]
+
+            if old is not None:
+                self._unindex(self._by_trace_id, old[1].trace_id, slot)
+                self._unindex(self._by_name, old[1].name, slot)
+
+            self._recorded += 1
+            self._slots[slot] = (self._recorded, trace, annotations,
+                                 _duration(annotations))
+
+            self._index(self._by_trace_id, trace.trace_id, slot)
+            self._index(self._by_name, trace.name, slot)
+
+            self._next = (slot + 1) % self._size
+
+    def spans(self, trace_id=None, name=None, slowest=False, limit=None):
+        """
+        Query the kept spans.
+
+        @param trace_id: C{int} trace id to select spans of, or C{None}.
+        @param name: C{str} span name to select spans of, or C{None}.
+        @param slowest: If C{True} order spans by duration, longest first,
+            rather than most recently recorded first.
+        @param limit: C{int} maximum number of spans, or C{None}.
+
+        @returns: A C{list} of 3-C{tuple}s of L{ITrace} provider, C{list} of
+            L{IAnnotation} providers and C{int} duration in microseconds.
+        """
+        if trace_id is not None:
+            slots = self._by_trace_id.get(trace_id, ())
+
+            if name is not None:
+                slots = [slot for slot in slots
+                         if self._slots[slot][1].name == name]
+
+        elif name is not None:
+            slots = self._by_name.get(name, ())
+        else:
+            slots = [slot for (slot, entry) in enumerate(self._slots)
+                     if entry is not None]
+
+        entries = [self._slots[slot] for slot in slots]
+
+        if slowest:
+            entries.sort(key=lambda entry: (entry[3], entry[0]), reverse=True)
+        else:
+            entries.sort(reverse=True)
+
+        return [(trace, annotations, duration)
+                for (_, trace, annotations, duration) in entries[:limit]]
+
+
+class RecentSpansResource(Resource):
+    """
+    Serve the spans kept by a L{RecentSpansTracer} as JSON, in the format of
+    L{tryfer.formatters.json_formatter} with an added C{duration} field in
+    microseconds.
+
+    Mount it beside your application, for example as
+    C{root.putChild('_spans', RecentSpansResource(recent))}.  The query
+    arguments C{trace_id} (hex) and C{name} select spans, C{sort=slowest}
+    orders them longest first rather than most recent first and C{limit}
+    (default 100) caps how many are returned.
+
+    @param tracer: A L{RecentSpansTracer}.
+    """
+    isLeaf = True
+
+    def __init__(self, tracer):
+        Resource.__init__(self)
+        self._tracer = tracer
+
+    def render_GET(self, request):
+        def _arg(name):
+            return request.args.get(name, [None])[0]
+
+        try:
+            trace_id = int_or_none(_arg('trace_id'))
+            limit = int(_arg('limit') or 100)
+        except ValueError:
+            request.setResponseCode(400)
+            return 'Bad trace_id or limit.'
+
+        request.setHeader('content-type', 'application/json')
+
+        spans = []
+
+        for (trace, annotations, duration) in self._tracer.spans(
+                trace_id=trace_id,
+                name=_arg('name'),
+                slowest=_arg('sort') == 'slowest',
+                limit=limit):
+            span = json_span(trace, annotations)
+            span['duration'] = duration
+            spans.append(span)
+
+        return json.dumps(spans)
@@ -0,0 +1,366 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The C{tryfer} command line tool.
+
+> tryfer replay --http http://localhost:6956/v1.0/22/trace spans.log
+> tryfer collector --scribe-port 1463 --http-port 6956 --latency 0.05
+> tryfer loadgen --zipkin localhost:1463 --rate 500 --duration 60
+"""
+
+from __future__ import print_function
+
+import sys
+import itertools
+
+from twisted.python import usage
+from twisted.internet.defer import Deferred
+from twisted.internet.task import react, deferLater, LoopingCall
+from twisted.internet.endpoints import (
+    TCP4ClientEndpoint,
+    TCP4ServerEndpoint
+)
+from twisted.web.client import Agent
+from twisted.web.server import Site
+
+from tryfer.tracers import (
+    RawZipkinTracer,
+    RawRESTkinHTTPTracer,
+    RawRESTkinScribeTracer,
+    ZipkinTracer,
+    RESTkinHTTPTracer,
+    RESTkinScribeTracer
+)
+from tryfer.replay import Replayer, DECODERS
+from tryfer.loadgen import LoadGenerator
+from tryfer.testing import ScribeCollector, RESTkinCollector
+
+
+def _host_port(value):
+    host, port = value.rsplit(':', 1)
+    return host, int(port)
+
+
+class ReplayOptions(usage.Options):
+    synopsis = '[options] FILE [FILE ...]'
+
+    longdesc = ('Upload spans captured by json_formatter, compact_formatter, '
+                'FileTracer or base64_thrift_formatter (one per line) to a '
+                'collector.  Use - to read from stdin.')
+
+    optFlags = [
+        ['zipkin', None,
+         'Log spans to scribe as base64 thrift for Zipkin rather than as '
+         'JSON for RESTkin.'],
+    ]
+
+    optParameters = [
+        ['http', None, None, 'POST spans as JSON to this RESTkin trace URL.'],
+        ['scribe', None, None, 'Log spans to the scribe server at HOST:PORT.',
+         _host_port],
+        ['category', None, None, 'Scribe category.  Default: zipkin with '
+         '--zipkin, otherwise restkin.'],
+        ['format', None, 'auto',
+         'Input format: ' + ', '.join(sorted(DECODERS)) + '.'],
+        ['batch-size', None, 100, 'Spans per upload.', int],
+        ['concurrency', None, 4, 'Maximum uploads in flight.', int],
+        ['rate', None, None, 'Maximum spans uploaded per second.', float],
+        ['offset', None, 0,
+         'Number of input lines to skip, e.g. the offset reported by an '
+         'interrupted replay.', int],
+        ['report-interval', None, 5.0,
+         'Seconds between progress reports.', float],
+    ]
+
+    def parseArgs(self, *files):
+        if not files:
+            raise usage.UsageError("At least one input file is required.")
+
+        self['files'] = files
+
+    def postOptions(self):
+        if (self['http'] is None) == (self['scribe'] is None):
+            raise usage.UsageError(
+                "Exactly one of --http and --scribe is required.")
+
+        if self['zipkin'] and self['scribe'] is None:
+            raise usage.UsageError("--zipkin requires --scribe.")
+
+        if self['format'] not in DECODERS:
+            raise usage.UsageError(
+                "Unknown format: {0}".format(self['format']))
+
+
+class LoadgenOptions(usage.Options):
+    longdesc = ('Record synthetic trace trees through ZipkinTracer, '
+                'RESTkinScribeTracer or RESTkinHTTPTracer and report the '
+                'span rate achieved and the CPU time it cost.')
+
+    optParameters = [
+        ['zipkin', None, None,
+         'Use ZipkinTracer with the scribe server at HOST:PORT.', _host_port],
+        ['restkin-scribe', None, None,
+         'Use RESTkinScribeTracer with the scribe server at HOST:PORT.',
+         _host_port],
+        ['http', None, None, 'Use RESTkinHTTPTracer with this trace URL.'],
+        ['rate', None, 100.0, 'Trace trees per second.', float],
+        ['depth', None, 3, 'Levels of spans in each tree.', int],
+        ['fanout', None, 2, 'Child spans of each span.', int],
+        ['duration', None, 10.0, 'Seconds to generate load for.', float],
+        ['max-traces', None, 50, 'Spans buffered by the tracer.', int],
+        ['max-idle-time', None, 10.0,
+         'Seconds the tracer may buffer spans for.', float],
+        ['linger', None, None,
+         'Seconds to wait afterwards for buffered spans to be sent.  '
+         'Default: --max-idle-time plus one.', float],
+        ['report-interval', None, 5.0,
+         'Seconds between progress reports.', float],
+    ]
+
+    def postOptions(self):
+        destinations = [d for d in ('zipkin', 'restkin-scribe', 'http')
+                        if self[d] is not None]
+
+        if len(destinations) != 1:
+            raise usage.UsageError(
+                "Exactly one of --zipkin, --restkin-scribe and --http is "
+                "required.")
+
+        if self['linger'] is None:
+            self['linger'] = self['max-idle-time'] + 1
+
+
+class CollectorOptions(usage.Options):
+    longdesc = ('Run stand-in scribe and RESTkin collectors which accept '
+                'spans, optionally slowly or unreliably, and report the span '
+                'rate and end-to-end delay.')
+
+    optParameters = [
+        ['scribe-port', None, None, 'Accept scribe on this port.', int],
+        ['http-port', None, None, 'Accept RESTkin HTTP on this port.', int],
+        ['latency', None, 0.0, 'Seconds to wait before responding.', float],
+        ['error-rate', None, 0.0,
+         'Fraction of requests which fail, between 0 and 1.', float],
+        ['max-rate', None, None,
+         'Spans accepted per second before throttling.', float],
+        ['report-interval', None, 5.0,
+         'Seconds between progress reports.', float],
+    ]
+
+    def postOptions(self):
+        if self['scribe-port'] is None and self['http-port'] is None:
+            raise usage.UsageError(
+                "At least one of --scribe-port and --http-port is required.")
+
+
+class Options(usage.Options):
+    synopsis = 'tryfer COMMAND [options]'
+
+    subCommands = [
+        ['replay', None, ReplayOptions, 'Upload captured spans.'],
+        ['loadgen', None, LoadgenOptions, 'Generate synthetic spans.'],
+        ['collector', None, CollectorOptions, 'Run stand-in collectors.'],
+    ]
+
+    def postOptions(self):
+        if self.subCommand is None:
+            raise usage.UsageError("A command is required.")
+
+
+def _scribe_client(reactor, host_port):
+    from scrivener import ScribeClient
+
+    host, port = host_port
+    return ScribeClient(TCP4ClientEndpoint(reactor, host, port))
+
+
+def build_replay_tracer(reactor, options):
+    """
+    Build the raw tracer described by L{ReplayOptions}.
+    """
+    if options['http'] is not None:
+        return RawRESTkinHTTPTracer(Agent(reactor), options['http'])
+
+    client = _scribe_client(reactor, options['scribe'])
+
+    if options['zipkin']:
+        return RawZipkinTracer(client, options['category'])
+
+    return RawRESTkinScribeTracer(client, options['category'])
+
+
+def _open(path):
+    if path == '-':
+        return sys.stdin
+
+    return open(path)
+
+
+def _report(replayer, out):
+    print('{0} lines, {1} spans, {2:.1f} spans/s, {3} errors, '
+          'offset {4}'.format(replayer.lines, replayer.spans,
+                              replayer.throughput(), replayer.errors,
+                              replayer.offset),
+          file=out)
+
+
+def replay(reactor, options, out=sys.stdout):
+    replayer = Replayer(
+        build_replay_tracer(reactor, options),
+        batch_size=options['batch-size'],
+        concurrency=options['concurrency'],
+        rate=options['rate'],
+        decoder=DECODERS[options['format']],
+        _reactor=reactor)
+
+    report = LoopingCall(_report, replayer, out)
+    report.clock = reactor
+    report.start(options['report-interval'], now=False)
+
+    lines = itertools.chain.from_iterable(
+        _open(path) for path in options['files'])
+
+    def _finished(result):
+        report.stop()
+        _report(replayer, out)
+        return result
+
+    return replayer.replay(lines, options['offset']).addBoth(_finished)
+
+
+def build_loadgen_tracer(reactor, options):
+    """
+    Build the tracer described by L{LoadgenOptions}.
+    """
+    kwargs = {
+        'max_traces': options['max-traces'],
+        'max_idle_time': options['max-idle-time'],
+        '_reactor': reactor
+    }
+
+    if options['zipkin'] is not None:
+        return ZipkinTracer(
+            _scribe_client(reactor, options['zipkin']), **kwargs)
+
+    if options['restkin-scribe'] is not None:
+        return RESTkinScribeTracer(
+            _scribe_client(reactor, options['restkin-scribe']), **kwargs)
+
+    return RESTkinHTTPTracer(Agent(reactor), options['http'], **kwargs)
+
+
+def _report_loadgen(generator, out):
+    elapsed = generator.elapsed()
+    cpu = generator.cpu_time()
+
+    print('{0} traces, {1} spans, {2:.1f} spans/s, {3:.2f}s CPU '
+          '({4:.0%}), {5:.1f}us CPU/span'.format(
+              generator.traces, generator.spans,
+              generator.spans_per_second(), cpu,
+              cpu / elapsed if elapsed else 0,
+              cpu / generator.spans * 1000000 if generator.spans else 0),
+          file=out)
+
+
+def loadgen(reactor, options, out=sys.stdout):
+    generator = LoadGenerator(
+        build_loadgen_tracer(reactor, options),
+        rate=options['rate'],
+        depth=options['depth'],
+        fanout=options['fanout'],
+        _reactor=reactor)
+
+    report = LoopingCall(_report_loadgen, generator, out)
+    report.clock = reactor
+
+    d = generator.start()
+    report.start(options['report-interval'], now=False)
+    reactor.callLater(options['duration'], generator.stop)
+
+    def _finished(result):
+        report.stop()
+        _report_loadgen(generator, out)
+        return deferLater(reactor, options['linger'], lambda: result)
+
+    return d.addBoth(_finished)
+
+
+def _report_collector(name, collector, out):
+    stats = collector.stats
+
+    print('{0}: {1} spans, {2:.1f} spans/s, {3} errors, {4} throttled, '
+          'delay mean {5:.3f}s max {6:.3f}s'.format(
+              name, stats.accepted, stats.spans_per_second(), stats.errors,
+              stats.throttled, stats.mean_delay(), stats.max_delay),
+          file=out)
+
+
+def collector(reactor, options, out=sys.stdout):
+    from scrivener import ScribeServerService
+
+    kwargs = {
+        'latency': options['latency'],
+        'error_rate': options['error-rate'],
+        'max_rate': options['max-rate'],
+        '_reactor': reactor
+    }
+
+    collectors = []
+
+    if options['scribe-port'] is not None:
+        scribe_collector = ScribeCollector(**kwargs)
+        ScribeServerService(
+            TCP4ServerEndpoint(reactor, options['scribe-port']),
+            scribe_collector).startService()
+        collectors.append(('scribe', scribe_collector))
+
+    if options['http-port'] is not None:
+        http_collector = RESTkinCollector(**kwargs)
+        reactor.listenTCP(options['http-port'], Site(http_collector))
+        collectors.append(('http', http_collector))
+
+    def _report():
+        for (name, c) in collectors:
+            _report_collector(name, c, out)
+
+    report = LoopingCall(_report)
+    report.clock = reactor
+    report.start(options['report-interval'], now=False)
+
+    # Run until interrupted.
+    return Deferred()
+
+
+COMMANDS = {
+    'replay': replay,
+    'loadgen': loadgen,
+    'collector': collector,
+}
+
+
+def _main(reactor, argv):
+    options = Options()
+
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError as e:
+        print('{0}\n\n{1}'.format(options, e), file=sys.stderr)
+        raise SystemExit(2)
+
+    return COMMANDS[options.subCommand](reactor, options.subOptions)
+
+
+def main(argv=None):
+    react(_main, [sys.argv[1:] if argv is None else argv])
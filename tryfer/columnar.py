@@ -0,0 +1,179 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compact storage for buffered spans.
+"""
+
+import struct
+
+from array import array
+
+from tryfer.trace import Trace, Annotation
+
+_ids = struct.Struct('!QQQ')
+
+# Timestamps are microseconds since the epoch, which need 64 bits.  Where a
+# C long is smaller use doubles, which hold integers exactly up to 2 ** 53.
+_TIMESTAMP_TYPECODE = 'l' if array('l').itemsize >= 8 else 'd'
+
+_NO_ENDPOINT = -1
+_NOT_TIMESTAMP = -2
+
+_PLACEHOLDER_IDS = _ids.pack(0, 0, 0)
+
+
+def _packed_ids(trace):
+    try:
+        return trace.packed_ids
+    except AttributeError:
+        return _ids.pack(trace.trace_id, trace.span_id,
+                         trace.parent_span_id or 0)
+
+
+def _packable(trace):
+    # Packing negative ids would lose their sign, so they are not packed.
+    return (trace.trace_id >= 0 and trace.span_id >= 0 and
+            (trace.parent_span_id or 0) >= 0)
+
+
+class ColumnarSpanBuffer(object):
+    """
+    A buffer of C{(trace, annotations)} spans which stores them by column
+    rather than as objects.
+
+    Ids are packed into a single C{bytearray}, timestamps into an C{array},
+    and span names, annotation names and endpoints are interned into
+    tables, so a buffered span with timestamp annotations costs a few dozen
+    bytes rather than several Python objects and their dicts.  Annotations
+    which are not integer timestamps are kept as they are, so their values
+    are still rendered lazily, and spans with negative ids are kept whole.
+
+    Spans are rebuilt as new L{Trace} and L{Annotation} objects when the
+    buffer is iterated, normally just before they are formatted.  A parent
+    span id of C{0} is treated as no parent.
+
+    It can be used in place of a C{list} by L{tryfer.tracers.BufferingTracer}
+    by passing C{buffer_factory=ColumnarSpanBuffer}.  See
+    C{benchmarks/columnar.py} for the memory saved.
+    """
+
+    def __init__(self):
+        self._ids = bytearray()
+        self._span_names = array('L')
+        self._starts = array('L')
+
+        self._names = array('L')
+        self._endpoints = array('l')
+        self._timestamps = array(_TIMESTAMP_TYPECODE)
+        self._others = []
+        self._unpacked = {}
+
+        self._strings = []
+        self._string_index = {}
+        self._endpoint_table = []
+        self._endpoint_index = {}
+
+    def _intern(self, string):
+        index = self._string_index.get(string)
+
+        if index is None:
+            index = self._string_index[string] = len(self._strings)
+            self._strings.append(string)
+
+        return index
+
+    def _intern_endpoint(self, endpoint):
+        if endpoint is None:
+            return _NO_ENDPOINT
+
+        # The table keeps a reference to each endpoint so ids are not reused.
+        index = self._endpoint_index.get(id(endpoint))
+
+        if index is None:
+            index = self._endpoint_index[id(endpoint)] = len(
+                self._endpoint_table)
+            self._endpoint_table.append(endpoint)
+
+        return index
+
+    def append(self, span):
+        (trace, annotations) = span
+
+        if not _packable(trace):
+            self._unpacked[len(self._starts)] = span
+            self._ids.extend(_PLACEHOLDER_IDS)
+            self._span_names.append(0)
+            self._starts.append(len(self._names))
+            return
+
+        self._ids.extend(_packed_ids(trace))
+        self._span_names.append(self._intern(trace.name))
+        self._starts.append(len(self._names))
+
+        for annotation in annotations:
+            if (annotation.annotation_type == 'timestamp' and
+                    isinstance(annotation.value, (int, long))):
+                self._names.append(self._intern(annotation.name))
+                self._endpoints.append(
+                    self._intern_endpoint(annotation.endpoint))
+                self._timestamps.append(annotation.value)
+            else:
+                self._names.append(len(self._others))
+                self._endpoints.append(_NOT_TIMESTAMP)
+                self._timestamps.append(0)
+                self._others.append(annotation)
+
+    def extend(self, spans):
+        for span in spans:
+            self.append(span)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __iter__(self):
+        strings = self._strings
+        endpoints = self._endpoint_table
+        unpacked = self._unpacked
+        end = len(self._names)
+
+        for i in xrange(len(self._starts)):
+            if unpacked and i in unpacked:
+                yield unpacked[i]
+                continue
+
+            (trace_id, span_id, parent_span_id) = _ids.unpack_from(
+                self._ids, i * _ids.size)
+
+            trace = Trace(strings[self._span_names[i]], trace_id, span_id,
+                          parent_span_id or None)
+
+            start = self._starts[i]
+            stop = self._starts[i + 1] if i + 1 < len(self._starts) else end
+            annotations = []
+
+            for j in xrange(start, stop):
+                endpoint = self._endpoints[j]
+
+                if endpoint == _NOT_TIMESTAMP:
+                    annotations.append(self._others[self._names[j]])
+                else:
+                    annotations.append(Annotation(
+                        strings[self._names[j]],
+                        int(self._timestamps[j]),
+                        'timestamp',
+                        None if endpoint == _NO_ENDPOINT
+                        else endpoints[endpoint]))
+
+            yield (trace, annotations)
@@ -0,0 +1,197 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Implicit propagation of the current L{ITrace} provider.
+
+The current trace is kept per thread.  L{call_with_trace} makes a trace
+current for the duration of a call, and L{bind} captures the current trace so
+it can be restored when a callback runs later.
+
+Once L{install} has been called every callback added to a L{Deferred} while a
+trace is current is bound to that trace, so the trace follows the Deferred
+chain without having to be passed around by hand.
+
+L{traced} times each call of a function as a child span of the current
+trace.
+"""
+
+import threading
+
+from functools import wraps
+
+from twisted.internet.defer import Deferred, passthru
+from twisted.python.failure import Failure
+
+
+class _State(threading.local):
+    # A class attribute, so every thread starts with no current trace
+    # without a getattr default on each lookup.
+    trace = None
+
+
+_state = _State()
+
+
+def current_trace():
+    """
+    @returns: The current L{ITrace} provider or C{None}.
+    """
+    return _state.trace
+
+
+def call_with_trace(trace, f, *args, **kwargs):
+    """
+    Call C{f} with C{trace} as the current trace, restoring the previous
+    current trace afterwards.
+
+    @param trace: An L{ITrace} provider or C{None}.
+
+    @returns: The result of C{f}.
+    """
+    previous = _state.trace
+    _state.trace = trace
+
+    try:
+        return f(*args, **kwargs)
+    finally:
+        _state.trace = previous
+
+
+class _Bound(object):
+    """
+    A callable which calls C{f} with C{trace} as the current trace.
+    """
+
+    __slots__ = ('_f', '_trace')
+
+    def __init__(self, f, trace):
+        self._f = f
+        self._trace = trace
+
+    def __call__(self, *args, **kwargs):
+        state = _state
+        previous = state.trace
+        state.trace = self._trace
+
+        try:
+            return self._f(*args, **kwargs)
+        finally:
+            state.trace = previous
+
+
+def bind(f, trace=None):
+    """
+    Bind C{f} to C{trace}, or the current trace if none is given, such that
+    it will be the current trace whenever C{f} is called.
+
+    @returns: A callable with the same signature as C{f}.  If there is no
+        trace to bind, C{f} itself.
+    """
+    if trace is None:
+        trace = _state.trace
+
+        if trace is None:
+            return f
+
+    return _Bound(f, trace)
+
+
+def traced(f=None, name=None):
+    """
+    Decorate C{f} so that each call is timed as a child span of the current
+    trace, using L{tryfer.trace.Trace.span}, and runs with that child as the
+    current trace.  If C{f} returns a L{Deferred} the span ends when it fires.
+
+    When no trace is current C{f} is called directly, at the cost of one
+    thread-local lookup.
+
+    May be used as C{@traced} or C{@traced(name='span name')}.
+
+    @param name: C{str} name of the span.  Default: the name of C{f}.
+    """
+    if f is None:
+        return lambda f: traced(f, name)
+
+    span_name = name or f.__name__
+
+    @wraps(f)
+    def _traced(*args, **kwargs):
+        trace = _state.trace
+
+        if trace is None:
+            return f(*args, **kwargs)
+
+        span = trace.span(span_name)
+        child = span.__enter__()
+
+        try:
+            result = call_with_trace(child, f, *args, **kwargs)
+        except Exception as e:
+            span.finish(e)
+            raise
+
+        if isinstance(result, Deferred):
+            def _finish(result):
+                span.finish(
+                    result.value if isinstance(result, Failure) else None)
+                return result
+
+            result.addBoth(_finish)
+        else:
+            span.finish()
+
+        return result
+
+    return _traced
+
+
+_originalAddCallbacks = Deferred.addCallbacks
+
+
+def _addCallbacks(self, callback, errback=None, callbackArgs=None,
+                  callbackKeywords=None, errbackArgs=None,
+                  errbackKeywords=None):
+    trace = _state.trace
+
+    if trace is not None:
+        # addCallback and addErrback fill the other slot with passthru,
+        # which does not need the trace.
+        if callback is not passthru:
+            callback = _Bound(callback, trace)
+
+        if errback is not None and errback is not passthru:
+            errback = _Bound(errback, trace)
+
+    return _originalAddCallbacks(self, callback, errback, callbackArgs,
+                                 callbackKeywords, errbackArgs,
+                                 errbackKeywords)
+
+
+def install():
+    """
+    Bind all callbacks added to a L{Deferred} to the trace which was current
+    when they were added.
+
+    When no trace is current this costs one thread-local lookup per added
+    callback.  See C{benchmarks/context.py} for the overhead when one is.
+    """
+    Deferred.addCallbacks = _addCallbacks
+
+
+def uninstall():
+    """
+    Undo L{install}.
+    """
+    Deferred.addCallbacks = _originalAddCallbacks
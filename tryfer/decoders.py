@@ -0,0 +1,223 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The inverse of L{tryfer.formatters}.  Decoders turn formatted spans back into
+the C{(trace, annotations)} tuples accepted by L{ITracer.record}.
+"""
+
+import json
+import struct
+import socket
+
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
+
+from tryfer.trace import Trace, Annotation, Endpoint
+from tryfer.formatters import int_or_none
+from tryfer._thrift.zipkinCore import ttypes
+
+
+def json_span_decoder(json_trace):
+    """
+    Decode a single span as built by L{tryfer.formatters.json_span}.
+
+    @param json_trace: A C{dict}.
+
+    @returns: A 2-C{tuple} of L{Trace} and C{list} of L{Annotation}.
+    """
+    trace = Trace(
+        json_trace['name'],
+        int_or_none(json_trace['trace_id']),
+        int_or_none(json_trace['span_id']),
+        int_or_none(json_trace.get('parent_span_id')))
+
+    annotations = []
+
+    for json_annotation in json_trace['annotations']:
+        endpoint = None
+        host = json_annotation.get('host')
+
+        if host:
+            endpoint = Endpoint(
+                host['ipv4'], host['port'], host['service_name'])
+
+        annotations.append(Annotation(
+            json_annotation['key'],
+            json_annotation['value'],
+            json_annotation['type'],
+            endpoint))
+
+    return (trace, annotations)
+
+
+def _compact_batch_decoder(batch):
+    strings = batch['strings']
+    endpoints = [Endpoint(ipv4, port, strings[service_name])
+                 for (ipv4, port, service_name) in batch['endpoints']]
+
+    traces = []
+
+    for (trace_id, span_id, parent_span_id, name, base,
+         compact_annotations) in batch['spans']:
+        trace = Trace(strings[name], int_or_none(trace_id),
+                      int_or_none(span_id), int_or_none(parent_span_id))
+
+        annotations = []
+
+        for compact_annotation in compact_annotations:
+            if len(compact_annotation) == 3:
+                (key, delta, endpoint) = compact_annotation
+                value = base + delta
+                annotation_type = 'timestamp'
+            else:
+                (key, annotation_type, value, endpoint) = compact_annotation
+
+            annotations.append(Annotation(
+                strings[key], value, annotation_type,
+                endpoints[endpoint] if endpoint >= 0 else None))
+
+        traces.append((trace, annotations))
+
+    return traces
+
+
+def compact_decoder(data):
+    """
+    Decode the output of L{tryfer.formatters.compact_formatter}.
+
+    @param data: A C{str}.
+
+    @returns: A C{list} of 2-C{tuple}s of L{Trace} and C{list} of
+        L{Annotation}.
+    """
+    return _compact_batch_decoder(json.loads(data))
+
+
+def json_decoder(data):
+    """
+    Decode the output of L{tryfer.formatters.json_formatter}, a single span
+    as written by L{tryfer.tracers.FileTracer}, or the output of
+    L{tryfer.formatters.compact_formatter}.
+
+    @param data: A C{str} containing a JSON list of spans, a single span or
+        a compact batch.
+
+    @returns: A C{list} of 2-C{tuple}s of L{Trace} and C{list} of
+        L{Annotation}.
+    """
+    decoded = json.loads(data)
+
+    if isinstance(decoded, dict):
+        if 'spans' in decoded:
+            return _compact_batch_decoder(decoded)
+
+        decoded = [decoded]
+
+    return [json_span_decoder(json_trace) for json_trace in decoded]
+
+
+def int_to_ipv4(n):
+    return socket.inet_ntoa(struct.pack('!i', n))
+
+
+_binary_annotation_types = {
+    ttypes.AnnotationType.STRING: 'string',
+    ttypes.AnnotationType.BYTES: 'bytes',
+}
+
+
+def thrift_span_decoder(thrift_span):
+    """
+    Decode a L{ttypes.Span}.
+
+    @returns: A 2-C{tuple} of L{Trace} and C{list} of L{Annotation}.
+    """
+    trace = Trace(
+        thrift_span.name,
+        thrift_span.trace_id,
+        thrift_span.id,
+        thrift_span.parent_id)
+
+    def _endpoint(host):
+        if host is None:
+            return None
+
+        return Endpoint(int_to_ipv4(host.ipv4), host.port, host.service_name)
+
+    annotations = [
+        Annotation(a.value, a.timestamp, 'timestamp', _endpoint(a.host))
+        for a in thrift_span.annotations or []]
+
+    for a in thrift_span.binary_annotations or []:
+        annotations.append(Annotation(
+            a.key,
+            a.value,
+            _binary_annotation_types.get(a.annotation_type, 'bytes'),
+            _endpoint(a.host)))
+
+    return (trace, annotations)
+
+
+def thrift_decoder(data):
+    """
+    Decode the output of L{tryfer.formatters.thrift_formatter}.
+
+    @param data: A C{str}.
+
+    @returns: A 2-C{tuple} of L{Trace} and C{list} of L{Annotation}.
+    """
+    trans = TTransport.TMemoryBuffer(data)
+    tbp = TBinaryProtocol.TBinaryProtocol(trans)
+
+    thrift_span = ttypes.Span()
+    thrift_span.read(tbp)
+
+    return thrift_span_decoder(thrift_span)
+
+
+def base64_thrift_decoder(data):
+    """
+    Decode the output of L{tryfer.formatters.base64_thrift_formatter}.
+
+    @param data: A C{str}.
+
+    @returns: A 2-C{tuple} of L{Trace} and C{list} of L{Annotation}.
+    """
+    return thrift_decoder(data.decode('base64'))
+
+
+def thrift_spans_decoder(data):
+    """
+    Decode the output of L{tryfer.formatters.thrift_spans_formatter}.
+
+    @param data: A C{str}.
+
+    @returns: A C{list} of 2-C{tuple}s of L{Trace} and C{list} of
+        L{Annotation}.
+    """
+    trans = TTransport.TMemoryBuffer(data)
+    tbp = TBinaryProtocol.TBinaryProtocol(trans)
+
+    (_, size) = tbp.readListBegin()
+    traces = []
+
+    for i in xrange(size):
+        thrift_span = ttypes.Span()
+        thrift_span.read(tbp)
+        traces.append(thrift_span_decoder(thrift_span))
+
+    tbp.readListEnd()
+
+    return traces
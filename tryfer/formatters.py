@@ -16,6 +16,7 @@ import json
 import struct
 import socket
 
+from thrift.Thrift import TType
 from thrift.protocol import TBinaryProtocol
 from thrift.transport import TTransport
 
@@ -26,52 +27,168 @@ def hex_str(n):
     return '%0.16x' % (n,)
 
 
-def json_formatter(traces, *json_args, **json_kwargs):
-    json_traces = []
+def hex_ids(trace):
+    """
+    @returns: C{tuple} of C{trace}'s trace id, span id and parent span id as
+        hex C{str}s, the last C{None} if it has no parent.  The values cached
+        by L{tryfer.trace.Trace.hex_ids} are used when available.
+    """
+    try:
+        return trace.hex_ids
+    except AttributeError:
+        return (hex_str(trace.trace_id), hex_str(trace.span_id),
+                None if trace.parent_span_id is None
+                else hex_str(trace.parent_span_id))
 
-    for (trace, annotations) in traces:
-        json_trace = {
-            'trace_id': hex_str(trace.trace_id),
-            'span_id': hex_str(trace.span_id),
-            'name': trace.name,
-            'annotations': []
-        }
 
-        if trace.parent_span_id:
-            json_trace['parent_span_id'] = hex_str(trace.parent_span_id)
+def int_or_none(val):
+    if val is None:
+        return None
 
-        for annotation in annotations:
-            json_annotation = {
-                'key': annotation.name,
-                'value': annotation.value,
-                'type': annotation.annotation_type
+    return int(val, 16)
+
+
+def json_span(trace, annotations):
+    """
+    Build the JSON compatible C{dict} representing a single span.
+    """
+    (trace_id, span_id, parent_span_id) = hex_ids(trace)
+
+    json_trace = {
+        'trace_id': trace_id,
+        'span_id': span_id,
+        'name': trace.name,
+        'annotations': []
+    }
+
+    if trace.parent_span_id:
+        json_trace['parent_span_id'] = parent_span_id
+
+    for annotation in annotations:
+        json_annotation = {
+            'key': annotation.name,
+            'value': annotation.value,
+            'type': annotation.annotation_type
+        }
+
+        if annotation.endpoint:
+            json_annotation['host'] = {
+                'ipv4': annotation.endpoint.ipv4,
+                'port': annotation.endpoint.port,
+                'service_name': annotation.endpoint.service_name
             }
 
-            if annotation.endpoint:
-                json_annotation['host'] = {
-                    'ipv4': annotation.endpoint.ipv4,
-                    'port': annotation.endpoint.port,
-                    'service_name': annotation.endpoint.service_name
-                }
+        json_trace['annotations'].append(json_annotation)
 
-            json_trace['annotations'].append(json_annotation)
+    return json_trace
 
-        json_traces.append(json_trace)
+
+def json_formatter(traces, *json_args, **json_kwargs):
+    json_traces = [json_span(trace, annotations)
+                   for (trace, annotations) in traces]
 
     return json.dumps(json_traces, *json_args, **json_kwargs)
 
 
+def compact_formatter(traces):
+    """
+    Format C{traces} as a compact JSON batch.
+
+    Strings (span names, annotation keys and service names) and endpoints
+    are written once per batch in tables and referred to by index, and each
+    span's timestamps are written as deltas from its first timestamp::
+
+        {"strings": [name, ...],
+         "endpoints": [[ipv4, port, service name index], ...],
+         "spans": [[trace_id, span_id, parent_span_id or null,
+                    name index, base timestamp,
+                    [[key index, delta, endpoint index], ...]], ...]}
+
+    Annotations which are not timestamps are written as
+    C{[key index, type, value, endpoint index]}.  An endpoint index of -1
+    means no endpoint.  See L{tryfer.decoders.compact_decoder}.
+
+    @returns: C{str}
+    """
+    strings = []
+    string_index = {}
+    endpoints = []
+    endpoint_index = {}
+
+    def _string(string):
+        index = string_index.get(string)
+
+        if index is None:
+            index = string_index[string] = len(strings)
+            strings.append(string)
+
+        return index
+
+    def _endpoint(endpoint):
+        if not endpoint:
+            return -1
+
+        key = (endpoint.ipv4, endpoint.port, endpoint.service_name)
+        index = endpoint_index.get(key)
+
+        if index is None:
+            index = endpoint_index[key] = len(endpoints)
+            endpoints.append(
+                [endpoint.ipv4, endpoint.port,
+                 _string(endpoint.service_name)])
+
+        return index
+
+    spans = []
+
+    for (trace, annotations) in traces:
+        (trace_id, span_id, parent_span_id) = hex_ids(trace)
+        base = None
+        compact_annotations = []
+
+        for annotation in annotations:
+            if annotation.annotation_type == 'timestamp':
+                if base is None:
+                    base = annotation.value
+
+                compact_annotations.append(
+                    [_string(annotation.name),
+                     annotation.value - base,
+                     _endpoint(annotation.endpoint)])
+            else:
+                compact_annotations.append(
+                    [_string(annotation.name),
+                     annotation.annotation_type,
+                     annotation.value,
+                     _endpoint(annotation.endpoint)])
+
+        spans.append([trace_id, span_id,
+                      parent_span_id if trace.parent_span_id else None,
+                      _string(trace.name), base, compact_annotations])
+
+    return json.dumps(
+        {'strings': strings, 'endpoints': endpoints, 'spans': spans},
+        separators=(',', ':'))
+
+
 def ipv4_to_int(ipv4):
     return struct.unpack('!i', socket.inet_aton(ipv4))[0]
 
 
-def base64_thrift(thrift_obj):
+def binary_thrift(thrift_obj):
+    """
+    @returns: C{str} of C{thrift_obj} encoded with the thrift binary protocol.
+    """
     trans = TTransport.TMemoryBuffer()
     tbp = TBinaryProtocol.TBinaryProtocol(trans)
 
     thrift_obj.write(tbp)
 
-    return trans.getvalue().encode('base64').strip()
+    return trans.getvalue()
+
+
+def base64_thrift(thrift_obj):
+    return binary_thrift(thrift_obj).encode('base64').strip()
 
 
 def binary_annotation_formatter(annotation, host=None):
@@ -94,7 +211,10 @@ def binary_annotation_formatter(annotation, host=None):
         host)
 
 
-def base64_thrift_formatter(trace, annotations):
+def thrift_span(trace, annotations):
+    """
+    Build the thrift C{Span} representing a single span.
+    """
     thrift_annotations = []
     binary_annotations = []
 
@@ -115,7 +235,7 @@ def base64_thrift_formatter(trace, annotations):
             binary_annotations.append(
                 binary_annotation_formatter(annotation, host))
 
-    thrift_trace = ttypes.Span(
+    return ttypes.Span(
         trace_id=trace.trace_id,
         name=trace.name,
         id=trace.span_id,
@@ -124,4 +244,48 @@ def base64_thrift_formatter(trace, annotations):
         binary_annotations=binary_annotations
     )
 
-    return base64_thrift(thrift_trace)
+
+def base64_thrift_formatter(trace, annotations):
+    return base64_thrift(thrift_span(trace, annotations))
+
+
+def thrift_formatter(trace, annotations):
+    """
+    Format a single span as raw thrift binary protocol bytes.
+    """
+    return binary_thrift(thrift_span(trace, annotations))
+
+
+def thrift_spans_formatter(traces):
+    """
+    Format C{traces} as a single thrift binary protocol C{list<Span>}, as
+    accepted by Zipkin's HTTP API with a Content-Type of
+    C{application/x-thrift}.
+
+    Unlike L{base64_thrift_messages_formatter} the spans are not base64
+    encoded, which would make them a third larger.
+
+    @returns: C{str}
+    """
+    trans = TTransport.TMemoryBuffer()
+    tbp = TBinaryProtocol.TBinaryProtocol(trans)
+
+    tbp.writeListBegin(TType.STRUCT, len(traces))
+
+    for (trace, annotations) in traces:
+        thrift_span(trace, annotations).write(tbp)
+
+    tbp.writeListEnd()
+
+    return trans.getvalue()
+
+
+def base64_thrift_messages_formatter(traces):
+    """
+    Format each of C{traces} with L{base64_thrift_formatter}, as scribe
+    messages for Zipkin.
+
+    @returns: A C{list} of C{str}.
+    """
+    return [base64_thrift_formatter(trace, annotations)
+            for (trace, annotations) in traces]
@@ -14,12 +14,24 @@
 
 from zope.interface import implements
 
+from twisted.python.components import proxyForInterface
+from twisted.internet.protocol import Protocol
+from twisted.web.client import ResponseDone
+from twisted.web.http import PotentialDataLoss
 from twisted.web.http_headers import Headers
+from twisted.web.iweb import IResponse
 from twisted.web.resource import IResource
+from twisted.web.server import Request, Site
 
 from tryfer.interfaces import ITrace
 from tryfer.trace import Trace, Annotation, Endpoint
-from tryfer.formatters import hex_str
+from tryfer.context import current_trace, call_with_trace
+from tryfer.formatters import hex_ids, int_or_none
+
+
+B3_MULTI = 'multi'
+B3_SINGLE = 'single'
+B3_BOTH = 'both'
 
 
 class TracingAgent(object):
@@ -27,17 +39,29 @@ class TracingAgent(object):
     An L{Agent} wrapper which traces requests.
     """
 
-    def __init__(self, agent, parent_trace=None, endpoint=None):
+    def __init__(self, agent, parent_trace=None, endpoint=None,
+                 propagation=B3_MULTI):
         """
         @param parent_trace: An L{ITrace} provider which will be used
-            as the parent of all traces.
+            as the parent of all traces.  If C{None} the current trace (see
+            L{tryfer.context}) at the time of each request is used, so a
+            single L{TracingAgent} can be shared by all incoming requests.
 
         @param endpoint: An L{IEndpoint} provider which will be set on
             on all traces.
+
+        @param propagation: How the trace is passed on to the server:
+            L{B3_MULTI} for the X-B3-* headers, L{B3_SINGLE} for the single
+            C{b3} header or L{B3_BOTH}.  Default L{B3_MULTI}.
         """
+        if propagation not in (B3_MULTI, B3_SINGLE, B3_BOTH):
+            raise ValueError(
+                "Unknown propagation: {0!r}".format(propagation))
+
         self._agent = agent
         self._parent_trace = parent_trace
         self._endpoint = endpoint
+        self._propagation = propagation
 
     def request(self, method, uri, headers=None, bodyProducer=None):
         """
@@ -45,10 +69,12 @@ class TracingAgent(object):
 
         @see: L{Agent.request}.
         """
-        if self._parent_trace is None:
+        parent_trace = self._parent_trace or current_trace()
+
+        if parent_trace is None:
             trace = Trace(method)
         else:
-            trace = self._parent_trace.child(method)
+            trace = parent_trace.child(method)
 
         if self._endpoint is not None:
             trace.set_endpoint(self._endpoint)
@@ -61,42 +87,232 @@ class TracingAgent(object):
         #
         # https://github.com/twitter/finagle/blob/master/finagle-http/
         #
-        # Currently not implemented are X-B3-Sampled and X-B3-Flags
-        # Tryfer's underlying Trace implementation has no notion of a Sampled
-        # trace and I haven't figured out what flags are for.
-        headers.setRawHeaders('X-B3-TraceId', [hex_str(trace.trace_id)])
-        headers.setRawHeaders('X-B3-SpanId', [hex_str(trace.span_id)])
+        # Currently not implemented is X-B3-Flags, I haven't figured out what
+        # flags are for.  X-B3-Sampled is only sent for unsampled traces, so
+        # that the decision not to trace a request survives more than one
+        # hop.
+        (trace_id, span_id, parent_span_id) = hex_ids(trace)
+        sampled = getattr(trace, 'sampled', True)
+
+        if self._propagation != B3_SINGLE:
+            headers.setRawHeaders('X-B3-TraceId', [trace_id])
+            headers.setRawHeaders('X-B3-SpanId', [span_id])
+
+            if parent_span_id is not None:
+                headers.setRawHeaders('X-B3-ParentSpanId', [parent_span_id])
 
-        if trace.parent_span_id is not None:
-            headers.setRawHeaders('X-B3-ParentSpanId',
-                                  [hex_str(trace.parent_span_id)])
+            if not sampled:
+                headers.setRawHeaders('X-B3-Sampled', ['0'])
+
+        if self._propagation != B3_MULTI:
+            # https://github.com/openzipkin/b3-propagation#single-header
+            b3 = trace_id + '-' + span_id + ('-1' if sampled else '-0')
+
+            if parent_span_id is not None:
+                b3 += '-' + parent_span_id
+
+            headers.setRawHeaders('b3', [b3])
 
         # Similar to the headers above we use the annotation 'http.uri' for
         # because that is the standard set forth in the finagle http Codec.
-        trace.record(Annotation.string('http.uri', uri))
-        trace.record(Annotation.client_send())
+        #
+        # These annotations are recorded along with the response annotations
+        # in a single batch once the response arrives.  How the body was
+        # delivered, if it is read at all, is recorded as a second batch.
+        request_annotations = (
+            Annotation.string('http.uri', uri),
+            Annotation.client_send())
 
         def _finished(resp):
-            # TODO: It may be advantageous here to return a wrapped response
-            # whose deliverBody can wrap it's protocol and record when the
-            # application has finished reading the contents.
-            trace.record(Annotation.string(
-                'http.responsecode',
-                '{0} {1}'.format(resp.code, resp.phrase)))
-            trace.record(Annotation.client_recv())
-            return resp
+            trace.record(*(request_annotations + (
+                Annotation.string(
+                    'http.responsecode', '{0} {1}', resp.code, resp.phrase),
+                Annotation.client_recv())))
+
+            if resp.length == 0:
+                return resp
+
+            def _body_finished(length, reason):
+                if reason.check(ResponseDone, PotentialDataLoss):
+                    trace.record(
+                        Annotation.timestamp('http.response.body'),
+                        Annotation.string('http.response.size', '{0}', length))
+                else:
+                    trace.record(
+                        Annotation.string('error', '{0}', reason.value),
+                        Annotation.timestamp('http.response.failed'))
+
+            return _TracingResponse(resp, _body_finished)
+
+        def _failed(failure):
+            trace.record(*(request_annotations + (
+                Annotation.string('error', '{0}', failure.value),
+                Annotation.client_recv())))
+            return failure
 
         d = self._agent.request(method, uri, headers, bodyProducer)
-        d.addBoth(_finished)
+        d.addCallbacks(_finished, _failed)
 
         return d
 
 
-def int_or_none(val):
-    if val is None:
-        return None
+class _TracingBodyProtocol(Protocol):
+    """
+    A L{Protocol} wrapper which counts the bytes of a response body and
+    notifies C{finished} with the total and the reason the connection was
+    lost once the body has been delivered.
+    """
+
+    def __init__(self, wrapped, finished):
+        self._wrapped = wrapped
+        self._finished = finished
+        self._length = 0
+
+    def makeConnection(self, transport):
+        Protocol.makeConnection(self, transport)
+        self._wrapped.makeConnection(transport)
+
+    def dataReceived(self, data):
+        self._length += len(data)
+        self._wrapped.dataReceived(data)
+
+    def connectionLost(self, reason):
+        self._finished(self._length, reason)
+        self._wrapped.connectionLost(reason)
+
+
+class _TracingResponse(proxyForInterface(IResponse)):
+    """
+    An L{IResponse} wrapper which records when the application has finished
+    reading the response body.
+    """
+
+    def __init__(self, original, finished):
+        super(_TracingResponse, self).__init__(original)
+        self._finished = finished
+
+    def deliverBody(self, protocol):
+        self.original.deliverBody(
+            _TracingBodyProtocol(protocol, self._finished))
+
+
+def _ids_from_headers(headers):
+    """
+    Extract the trace id, span id and parent span id from the X-B3-* headers
+    that the TracingAgent will send.
+
+    @param headers: A L{Headers} instance.
+
+    @returns: A 3-C{tuple} of C{int} or C{None}.
+    """
+    return (
+        int_or_none(headers.getRawHeaders('X-B3-TraceId', [None])[0]),
+        int_or_none(headers.getRawHeaders('X-B3-SpanId', [None])[0]),
+        int_or_none(headers.getRawHeaders('X-B3-ParentSpanId', [None])[0]))
+
+
+def _is_sampled(headers):
+    """
+    @returns: C{False} if the X-B3-Sampled header explicitly says this
+        request should not be traced, otherwise C{True}.
+    """
+    sampled = headers.getRawHeaders('X-B3-Sampled', [None])[0]
+
+    return sampled not in ('0', 'false')
+
+
+def _id_from_b3(value):
+    # 128-bit trace ids are truncated to their low 64 bits, as Zipkin does.
+    return int(value[-16:], 16)
+
+
+def _trace_context(headers):
+    """
+    Extract the trace ids and sampling decision from the single C{b3}
+    header if it was sent, otherwise from the X-B3-* headers.
+
+    The C{b3} header is C{{trace}-{span}[-{sampled}[-{parent}]]}, or just
+    C{{sampled}}.  A malformed C{b3} header is ignored and a new trace is
+    started.
+
+    @param headers: A L{Headers} instance.
+
+    @returns: A 2-C{tuple} of a 3-C{tuple} of C{int} or C{None} as returned
+        by L{_ids_from_headers}, and C{bool} as returned by L{_is_sampled}.
+    """
+    b3 = headers.getRawHeaders('b3')
+
+    if b3 is None:
+        return (_ids_from_headers(headers), _is_sampled(headers))
+
+    fields = b3[0].split('-')
 
-    return int(val, 16)
+    if len(fields) == 1:
+        return ((None, None, None), fields[0] != '0')
+
+    try:
+        ids = (_id_from_b3(fields[0]),
+               _id_from_b3(fields[1]),
+               _id_from_b3(fields[3]) if len(fields) > 3 else None)
+    except ValueError:
+        return ((None, None, None), True)
+
+    return (ids, len(fields) < 3 or fields[2] != '0')
+
+
+def _response_code(request):
+    """
+    @returns: An L{Annotation} of the response code sent for C{request}, in
+        the same form as L{TracingAgent} records for responses it receives.
+    """
+    return Annotation.string(
+        'http.responsecode', '{0} {1}', request.code, request.code_message)
+
+
+_endpoints = {}
+
+
+def _endpoint(host, port, service_name):
+    """
+    Get a shared L{Endpoint} for C{host}, C{port} and C{service_name}.
+
+    A server only listens on a handful of addresses so this avoids creating
+    a new L{Endpoint} for every request.
+    """
+    key = (host, port, service_name)
+
+    endpoint = _endpoints.get(key)
+    if endpoint is None:
+        endpoint = _endpoints[key] = Endpoint(host, port, service_name)
+
+    return endpoint
+
+
+class _TraceContextResource(object):
+    """
+    An L{IResource} proxy which makes C{trace} the current trace while
+    rendering or looking up children of the wrapped resource.
+    """
+    implements(IResource)
+
+    def __init__(self, wrapped, trace):
+        self._wrapped = wrapped
+        self._trace = trace
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped, name)
+
+    def render(self, request):
+        return call_with_trace(self._trace, self._wrapped.render, request)
+
+    def putChild(self, path, child):
+        return self._wrapped.putChild(path, child)
+
+    def getChildWithDefault(self, path, request):
+        return _TraceContextResource(
+            call_with_trace(
+                self._trace, self._wrapped.getChildWithDefault, path, request),
+            self._trace)
 
 
 class TracingWrapperResource(object):
@@ -125,21 +341,17 @@ class TracingWrapperResource(object):
             "TracingWrapperResource does not support children.")
 
     def getChildWithDefault(self, path, request):
-        headers = request.requestHeaders
-
         # Construct and endpoint from the requested host and port and the
         # passed service name.
         host = request.getHost()
 
-        endpoint = Endpoint(host.host, host.port, self._service_name)
+        endpoint = _endpoint(host.host, host.port, self._service_name)
 
-        # Construct the trace using the headers X-B3-* headers that the
-        # TracingAgent will send.
-        trace = Trace(
-            request.method,
-            int_or_none(headers.getRawHeaders('X-B3-TraceId', [None])[0]),
-            int_or_none(headers.getRawHeaders('X-B3-SpanId', [None])[0]),
-            int_or_none(headers.getRawHeaders('X-B3-ParentSpanId', [None])[0]))
+        # Construct the trace using the b3 or X-B3-* headers that the
+        # TracingAgent will send.  An unsampled trace records nothing but
+        # passes the decision on to any requests made while it is current.
+        (ids, sampled) = _trace_context(request.requestHeaders)
+        trace = Trace(request.method, *ids, sampled=sampled)
 
         trace.set_endpoint(endpoint)
 
@@ -151,11 +363,87 @@ class TracingWrapperResource(object):
         trace.record(Annotation.server_recv())
 
         def _record_finish(_ignore):
-            trace.record(Annotation.server_send())
+            trace.record(_response_code(request), Annotation.server_send())
 
         # notifyFinish returns a deferred that fires when the request is
         # finished this will allow us to record server_send regardless of if
         # the wrapped resource us using deferred rendering.
         request.notifyFinish().addCallback(_record_finish)
 
-        return self._wrapped.getChildWithDefault(path, request)
+        # Make the trace current while the rest of the resource tree is
+        # traversed and rendered so that a shared TracingAgent will use it as
+        # the parent of any outgoing requests.
+        return _TraceContextResource(
+            call_with_trace(
+                trace, self._wrapped.getChildWithDefault, path, request),
+            trace)
+
+
+class TracingRequest(Request):
+    """
+    A L{twisted.web.server.Request} which traces itself.
+
+    Unlike L{TracingWrapperResource} tracing happens at the request level, so
+    the trace is current (see L{tryfer.context}) for the whole of resource
+    traversal and rendering, and C{SERVER_SEND} is recorded directly from
+    L{finish}.
+
+    Requests whose X-B3-Sampled header is C{0} or C{false}, or whose C{b3}
+    header has a sampling state of C{0}, are not traced at all.  An
+    unsampled L{Trace} with their ids is made current instead, so that a
+    L{TracingAgent} passes the decision on rather than starting a new trace.
+
+    The service name used for endpoints is taken from the C{service_name}
+    attribute of the L{Site}, see L{TracingSite}.
+
+    @ivar trace: The L{Trace} for this request or C{None} if it is not being
+        traced.  This is also available as C{ITrace(request, None)}.
+    """
+    trace = None
+
+    def process(self):
+        (ids, sampled) = _trace_context(self.requestHeaders)
+
+        if not sampled:
+            return call_with_trace(
+                Trace(self.method, *ids, sampled=False), Request.process, self)
+
+        host = self.getHost()
+        service_name = getattr(self.channel.site, 'service_name', None)
+
+        trace = Trace(self.method, *ids)
+        trace.set_endpoint(
+            _endpoint(host.host, host.port, service_name or 'http'))
+
+        self.trace = trace
+        self.setComponent(ITrace, trace)
+
+        trace.record(Annotation.server_recv())
+
+        return call_with_trace(trace, Request.process, self)
+
+    def finish(self):
+        record = self.trace is not None and not self.finished
+
+        Request.finish(self)
+
+        if record:
+            self.trace.record(_response_code(self), Annotation.server_send())
+
+
+class TracingSite(Site):
+    """
+    A L{Site} which traces every request using L{TracingRequest}.
+
+    @param resource: The root L{IResource} provider.
+
+    @param service_name: A C{str} name of the service to be used in the
+        L{IEndpoint} for traces from this site.  Default: 'http'
+
+    @param kwargs: Passed on to L{Site}.
+    """
+    requestFactory = TracingRequest
+
+    def __init__(self, resource, service_name=None, **kwargs):
+        Site.__init__(self, resource, **kwargs)
+        self.service_name = service_name or 'http'
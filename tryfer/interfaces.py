@@ -37,7 +37,8 @@ class ITracer(Interface):
             element is an L{ITrace} provider whose second element is a C{list}
             of L{IAnnotation} providers.
 
-        @returns C{None}
+        @returns C{None}, or a L{Deferred} which fires with C{None} once
+            delivery of the traces has finished (whether or not it succeeded).
         """
 
 
@@ -0,0 +1,189 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Synthetic span traffic for capacity testing tracers and collectors.
+"""
+
+import os
+import math
+import random
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+from tryfer.trace import Trace, Annotation, Endpoint
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _endpoint(level):
+    return Endpoint('127.0.0.1', 8000 + level, 'loadgen-{0}'.format(level))
+
+
+def _record(tracer, trace, endpoint, *annotations):
+    for annotation in annotations:
+        annotation.endpoint = endpoint
+
+    tracer.record([(trace, list(annotations))])
+
+
+def _span(tracer, trace, level, start, duration, depth, fanout, rng):
+    endpoint = _endpoint(level)
+    spans = 1
+
+    if level + 1 < depth:
+        slot = duration / fanout
+
+        for i in xrange(fanout):
+            child = trace.child('call-{0}'.format(i))
+            child_start = start + i * slot
+            child_duration = slot * rng.uniform(0.5, 0.9)
+
+            spans += _span(tracer, child, level + 1,
+                           child_start + 1, child_duration - 2,
+                           depth, fanout, rng)
+
+            _record(tracer, child, endpoint,
+                    Annotation.client_send(int(child_start)),
+                    Annotation.client_recv(int(child_start + child_duration)))
+
+    _record(tracer, trace, endpoint,
+            Annotation.server_recv(int(start)),
+            Annotation.server_send(int(start + duration)))
+
+    return spans
+
+
+def record_trace_tree(tracer, name='loadgen', depth=3, fanout=2,
+                      duration=0.1, _random=random, _time=None):
+    """
+    Record a synthetic trace to C{tracer} in which every span below C{depth}
+    calls C{fanout} child spans one after the other, as an application would
+    through L{Trace.child}.  The root span ends now.
+
+    Each call records its client annotations and server annotations
+    separately, so a tree of N spans produces 2N - 1 calls to
+    C{tracer.record}.
+
+    @param duration: C{float} duration of the root span in seconds.
+
+    @returns: C{int} number of spans in the tree.
+    """
+    now = (_time or reactor.seconds)()
+
+    trace = Trace(name, tracers=[tracer])
+
+    return _span(tracer, trace, 0, math.trunc((now - duration) * 1000 * 1000),
+                 duration * 1000 * 1000, depth, fanout, _random)
+
+
+class LoadGenerator(object):
+    """
+    Record synthetic trace trees to an L{ITracer} at a steady rate and
+    measure what it costs.
+
+    @param tracer: An L{ITracer} provider, such as L{ZipkinTracer}.
+
+    @param rate: C{float} number of trace trees to record per second.
+
+    @param depth: See L{record_trace_tree}.
+
+    @param fanout: See L{record_trace_tree}.
+
+    @param interval: C{float} seconds between batches of traces.  Each
+        batch records as many traces as are due.
+
+    @param _reactor: An L{IReactorTime} provider.
+
+    @ivar traces: C{int} number of trace trees recorded.
+    @ivar spans: C{int} number of spans recorded.
+    """
+
+    def __init__(self, tracer, rate=100, depth=3, fanout=2, interval=0.1,
+                 _reactor=None, _random=None):
+        self._tracer = tracer
+        self._rate = rate
+        self._depth = depth
+        self._fanout = fanout
+        self._interval = interval
+        self._reactor = _reactor or reactor
+        self._random = _random or random.Random()
+
+        self._loop = LoopingCall(self._tick)
+        self._loop.clock = self._reactor
+        self._due = 0.0
+        self._last_tick = None
+
+        self._started = None
+        self._started_cpu = None
+
+        self.traces = 0
+        self.spans = 0
+
+    def start(self):
+        """
+        Start recording traces.
+
+        @returns: A L{Deferred} which fires when L{stop} is called.
+        """
+        self._started = self._last_tick = self._reactor.seconds()
+        self._started_cpu = _cpu_time()
+        return self._loop.start(self._interval, now=False)
+
+    def stop(self):
+        self._loop.stop()
+
+    def _tick(self):
+        now = self._reactor.seconds()
+        self._due += (now - self._last_tick) * self._rate
+        self._last_tick = now
+
+        while self._due >= 1:
+            self._due -= 1
+            self.traces += 1
+            self.spans += record_trace_tree(
+                self._tracer, depth=self._depth, fanout=self._fanout,
+                _random=self._random, _time=self._reactor.seconds)
+
+    def elapsed(self):
+        """
+        @returns: C{float} seconds since L{start}.
+        """
+        if self._started is None:
+            return 0.0
+
+        return self._reactor.seconds() - self._started
+
+    def spans_per_second(self):
+        elapsed = self.elapsed()
+
+        if elapsed <= 0:
+            return 0.0
+
+        return self.spans / elapsed
+
+    def cpu_time(self):
+        """
+        @returns: C{float} seconds of user and system CPU time this process
+            has used since L{start}.  This includes the cost of the tracer
+            formatting and sending spans.
+        """
+        if self._started_cpu is None:
+            return 0.0
+
+        return _cpu_time() - self._started_cpu
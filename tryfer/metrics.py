@@ -0,0 +1,604 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Aggregate recorded spans into metrics locally rather than shipping every
+span.
+"""
+
+import json
+import math
+
+from array import array
+from collections import OrderedDict
+
+from zope.interface import implements
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+
+from tryfer import log
+from tryfer.interfaces import ITracer
+from tryfer._thrift.zipkinCore import constants
+
+
+class LatencyHistogram(object):
+    """
+    A fixed size histogram of durations in microseconds, with logarithmic
+    buckets so that every percentile is accurate to within C{error}.
+
+    Durations of up to C{max_value} microseconds are tracked; longer ones are
+    counted in the last bucket.
+
+    @param error: C{float} relative error of reported values.  Default 0.05.
+
+    @param max_value: C{int} largest duration tracked exactly, in
+        microseconds.  Default one hour.
+    """
+
+    def __init__(self, error=0.05, max_value=3600 * 1000 * 1000):
+        self._base = 1 + 2 * error
+        self._log_base = math.log(self._base)
+        self._counts = array('L', [0] * (self._bucket(max_value) + 2))
+
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value):
+        if value < 1:
+            return 0
+
+        return int(math.log(value) / self._log_base) + 1
+
+    def add(self, value):
+        """
+        Add a duration in microseconds.
+        """
+        self._counts[min(self._bucket(value), len(self._counts) - 1)] += 1
+
+        self.count += 1
+        self.total += value
+
+        if self.min is None or value < self.min:
+            self.min = value
+
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Add every duration in C{other}, which must have been created with the
+        same arguments, to this histogram.
+        """
+        for i, count in enumerate(other._counts):
+            self._counts[i] += count
+
+        self.count += other.count
+        self.total += other.total
+
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p):
+        """
+        @param p: C{int} or C{float} percentile between 0 and 100.
+
+        @returns: C{float} duration in microseconds, or C{None} if nothing
+            has been added.
+        """
+        if not self.count:
+            return None
+
+        if p <= 0:
+            return self.min
+
+        if p >= 100:
+            return self.max
+
+        rank = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = 0
+
+        for i, count in enumerate(self._counts):
+            seen += count
+
+            if seen >= rank:
+                break
+
+        if i == 0:
+            value = 0.0
+        elif i == len(self._counts) - 1:
+            value = self.max
+        else:
+            # The geometric middle of the bucket is within error of every
+            # value in it.
+            value = self._base ** (i - 0.5)
+
+        return min(max(value, self.min), self.max)
+
+    def mean(self):
+        if not self.count:
+            return None
+
+        return self.total / float(self.count)
+
+    def snapshot(self, percentiles=(50, 90, 99)):
+        """
+        @returns: A C{dict} of C{count}, C{mean}, C{min}, C{max} and each of
+            C{percentiles} as C{p50} and so on.
+        """
+        result = {
+            'count': self.count,
+            'mean': self.mean(),
+            'min': self.min,
+            'max': self.max
+        }
+
+        for p in percentiles:
+            result['p{0}'.format(p)] = self.percentile(p)
+
+        return result
+
+
+_span_kinds = {
+    constants.CLIENT_SEND: ('client', True),
+    constants.CLIENT_RECV: ('client', False),
+    constants.SERVER_RECV: ('server', True),
+    constants.SERVER_SEND: ('server', False),
+}
+
+
+class _DurationPairer(object):
+    """
+    Match the start and end annotations of client and server spans, which
+    may be recorded in separate calls, and report each completed pair along
+    with the annotations recorded with its end.
+
+    At most C{max_pending} unmatched halves are kept, beyond that the oldest
+    is forgotten.
+    """
+
+    def __init__(self, completed, max_pending=10000):
+        self._completed = completed
+        self._max_pending = max_pending
+        self._pending = OrderedDict()
+
+    def record(self, traces):
+        for (trace, annotations) in traces:
+            for annotation in annotations:
+                kind = _span_kinds.get(annotation.name)
+
+                if kind is None:
+                    continue
+
+                kind, is_start = kind
+                key = (trace.trace_id, trace.span_id, kind)
+
+                other = self._pending.pop(key, None)
+
+                if other is None or other[0] == is_start:
+                    if len(self._pending) >= self._max_pending:
+                        self._pending.popitem(last=False)
+
+                    self._pending[key] = (is_start, annotation, annotations)
+                    continue
+
+                if is_start:
+                    start, (_, end, end_batch) = annotation, other
+                else:
+                    start, end, end_batch = other[1], annotation, annotations
+
+                self._completed(trace, kind, start, end, end_batch)
+
+
+def _service_name(start, end):
+    endpoint = end.endpoint or start.endpoint
+
+    if endpoint is None:
+        return None
+
+    return endpoint.service_name
+
+
+class LatencyTracer(object):
+    """
+    An L{ITracer} which measures client durations from C{cs} to C{cr} and
+    server durations from C{sr} to C{ss}, and aggregates them into a
+    L{LatencyHistogram} per C{(service_name, span name)}.
+
+    The two halves of a span do not need to be recorded together, so this
+    can be pushed as a tracer of its own alongside heavily sampled shipping
+    tracers.
+
+    @param exporter: Optional callable called every C{export_interval}
+        seconds with the result of L{snapshot}, such as L{log_exporter}.
+
+    @param export_interval: C{int} or C{float} seconds.  Default 60.
+
+    @param reset_on_export: C{bool} whether each export covers only the
+        durations recorded since the last one.  Default C{False}.
+
+    @param max_keys: C{int} maximum number of C{(service_name, span name)}
+        pairs tracked.  Durations for further pairs are counted in
+        L{dropped}.  Default 1000.
+
+    @param error: See L{LatencyHistogram}.
+
+    @param _reactor: An L{IReactorTime} provider.
+
+    @ivar dropped: C{int}
+    """
+    implements(ITracer)
+
+    def __init__(self, exporter=None, export_interval=60,
+                 reset_on_export=False, max_keys=1000, error=0.05,
+                 _reactor=None):
+        self._exporter = exporter
+        self._export_interval = export_interval
+        self._reset_on_export = reset_on_export
+        self._max_keys = max_keys
+        self._error = error
+        self._reactor = _reactor or reactor
+
+        self._pairer = _DurationPairer(self._completed)
+        self._histograms = {}
+
+        self._loop = LoopingCall(self.export)
+        self._loop.clock = self._reactor
+
+        self.dropped = 0
+
+    def _completed(self, trace, kind, start, end, annotations):
+        key = (_service_name(start, end), trace.name)
+        histograms = self._histograms.get(key)
+
+        if histograms is None:
+            if len(self._histograms) >= self._max_keys:
+                self.dropped += 1
+                return
+
+            histograms = self._histograms[key] = {
+                'client': LatencyHistogram(self._error),
+                'server': LatencyHistogram(self._error)
+            }
+
+        histograms[kind].add(end.value - start.value)
+
+    def record(self, traces):
+        if self._exporter is not None and not self._loop.running:
+            self._loop.start(self._export_interval, now=False)
+
+        self._pairer.record(traces)
+
+    def histogram(self, service_name, name, kind='server'):
+        """
+        @param kind: C{'client'} or C{'server'}.
+
+        @returns: The L{LatencyHistogram} for a span or C{None}.
+        """
+        histograms = self._histograms.get((service_name, name))
+
+        if histograms is None:
+            return None
+
+        return histograms[kind]
+
+    def percentile(self, service_name, name, p, kind='server'):
+        """
+        @returns: C{float} duration in microseconds or C{None}.  See
+            L{LatencyHistogram.percentile}.
+        """
+        histogram = self.histogram(service_name, name, kind)
+
+        if histogram is None:
+            return None
+
+        return histogram.percentile(p)
+
+    def snapshot(self, percentiles=(50, 90, 99)):
+        """
+        @returns: A C{dict} mapping C{(service_name, span name, kind)} to
+            L{LatencyHistogram.snapshot}s, for every histogram which has
+            durations.
+        """
+        return dict(
+            ((service_name, name, kind), histogram.snapshot(percentiles))
+            for ((service_name, name), histograms)
+            in self._histograms.iteritems()
+            for (kind, histogram) in histograms.iteritems()
+            if histogram.count)
+
+    def export(self):
+        """
+        Pass a L{snapshot} to the exporter now.
+        """
+        snapshot = self.snapshot()
+
+        if self._reset_on_export:
+            self._histograms = {}
+
+        try:
+            self._exporter(snapshot)
+        except Exception:
+            log.err(None, "Error exporting latency histograms.")
+
+    def stop(self):
+        """
+        Stop exporting periodically.
+        """
+        if self._loop.running:
+            self._loop.stop()
+
+
+def log_exporter(snapshot):
+    """
+    Log one line per histogram in a L{LatencyTracer.snapshot}.
+    """
+    for (service_name, name, kind), stats in sorted(snapshot.iteritems()):
+        log.msg(format=("%(service_name)s %(name)s %(kind)s "
+                        "count=%(count)d p50=%(p50).0fus p90=%(p90).0fus "
+                        "p99=%(p99).0fus max=%(max)dus"),
+                system=LatencyTracer.__name__,
+                service_name=service_name, name=name, kind=kind,
+                **stats)
+
+
+def response_code(annotations):
+    """
+    @returns: The C{int} status code from an C{http.responsecode} annotation
+        in C{annotations}, as recorded by L{tryfer.http.TracingAgent} and the
+        server side tracing in L{tryfer.http}, or C{None}.
+    """
+    for annotation in annotations:
+        if annotation.name == 'http.responsecode':
+            try:
+                return int(str(annotation.value).split(None, 1)[0])
+            except (ValueError, IndexError):
+                return None
+
+    return None
+
+
+def is_error(annotations):
+    """
+    The default test for whether a span failed: it has an C{error}
+    annotation, as L{tryfer.http.TracingAgent} records when a request fails
+    outright, or a 5xx C{http.responsecode}.
+    """
+    for annotation in annotations:
+        if annotation.name == 'error':
+            return True
+
+    code = response_code(annotations)
+    return code is not None and code >= 500
+
+
+class _Bucket(object):
+    def __init__(self, index, error):
+        self.index = index
+        self.count = 0
+        self.errors = 0
+        self.durations = LatencyHistogram(error)
+
+
+class _SlidingWindow(object):
+    """
+    Counts and durations over the last C{buckets} periods of C{resolution}
+    seconds.  Old periods are reset as time moves on, so memory is fixed.
+    """
+
+    def __init__(self, resolution, buckets, error):
+        self._resolution = resolution
+        self._error = error
+        self._buckets = [_Bucket(None, error) for _ in xrange(buckets)]
+
+    def add(self, now, duration, error):
+        index = int(now // self._resolution)
+        slot = index % len(self._buckets)
+        bucket = self._buckets[slot]
+
+        if bucket.index != index:
+            bucket = self._buckets[slot] = _Bucket(index, self._error)
+
+        bucket.count += 1
+        bucket.errors += error
+        bucket.durations.add(duration)
+
+    def totals(self, now):
+        """
+        @returns: A 3-C{tuple} of request count, error count and a
+            L{LatencyHistogram} of durations within the window.
+        """
+        index = int(now // self._resolution)
+        durations = LatencyHistogram(self._error)
+        count = errors = 0
+
+        for bucket in self._buckets:
+            if bucket.index is not None and \
+                    0 <= index - bucket.index < len(self._buckets):
+                count += bucket.count
+                errors += bucket.errors
+                durations.merge(bucket.durations)
+
+        return count, errors, durations
+
+
+class REDTracer(object):
+    """
+    An L{ITracer} which derives request rate, error rate and duration
+    metrics per operation from client (C{cs}/C{cr}) and server
+    (C{sr}/C{ss}) spans, over a sliding window.
+
+    Operations are keyed by C{(service_name, span name, kind)} where
+    C{kind} is C{'client'} or C{'server'}.  Whether a span failed is
+    decided from the annotations recorded with its end, which for
+    L{tryfer.http} spans include C{http.responsecode}.
+
+    @param window: C{int} or C{float} seconds covered by the metrics.
+        Default 60.
+
+    @param resolution: C{int} or C{float} seconds by which the window
+        slides.  Default 10.
+
+    @param exporter: Optional callable called every C{export_interval}
+        seconds with the result of L{metrics}, such as L{red_log_exporter}.
+
+    @param export_interval: C{int} or C{float} seconds.  Default
+        C{resolution}.
+
+    @param is_error: A callable given the C{list} of annotations recorded
+        with the end of a span which returns C{True} if it failed.  Default
+        L{is_error}.
+
+    @param max_keys: C{int} maximum number of operations tracked.  Spans for
+        further operations are counted in L{dropped}.  Default 1000.
+
+    @param error: See L{LatencyHistogram}.  Default 0.1.
+
+    @param _reactor: An L{IReactorTime} provider.
+    """
+    implements(ITracer)
+
+    def __init__(self, window=60, resolution=10, exporter=None,
+                 export_interval=None, is_error=is_error, max_keys=1000,
+                 error=0.1, _reactor=None):
+        self._window = window
+        self._resolution = resolution
+        self._buckets = int(math.ceil(window / float(resolution)))
+        self._exporter = exporter
+        self._export_interval = export_interval or resolution
+        self._is_error = is_error
+        self._max_keys = max_keys
+        self._error = error
+        self._reactor = _reactor or reactor
+
+        self._pairer = _DurationPairer(self._completed)
+        self._windows = {}
+
+        self._loop = LoopingCall(self.export)
+        self._loop.clock = self._reactor
+
+        self.dropped = 0
+
+    def _completed(self, trace, kind, start, end, annotations):
+        key = (_service_name(start, end), trace.name, kind)
+        window = self._windows.get(key)
+
+        if window is None:
+            if len(self._windows) >= self._max_keys:
+                self.dropped += 1
+                return
+
+            window = self._windows[key] = _SlidingWindow(
+                self._resolution, self._buckets, self._error)
+
+        window.add(self._reactor.seconds(), end.value - start.value,
+                   bool(self._is_error(annotations)))
+
+    def record(self, traces):
+        if self._exporter is not None and not self._loop.running:
+            self._loop.start(self._export_interval, now=False)
+
+        self._pairer.record(traces)
+
+    def metrics(self, percentiles=(50, 90, 99)):
+        """
+        @returns: A C{dict} mapping C{(service_name, span name, kind)} to a
+            C{dict} of C{count}, C{rate} (per second), C{errors},
+            C{error_rate} (the fraction of requests which failed) and
+            C{duration} (a L{LatencyHistogram.snapshot}) for every operation
+            seen within the window.
+        """
+        now = self._reactor.seconds()
+        result = {}
+
+        for key, window in self._windows.iteritems():
+            count, errors, durations = window.totals(now)
+
+            if not count:
+                continue
+
+            result[key] = {
+                'count': count,
+                'rate': count / float(self._window),
+                'errors': errors,
+                'error_rate': errors / float(count),
+                'duration': durations.snapshot(percentiles)
+            }
+
+        return result
+
+    def export(self):
+        """
+        Pass L{metrics} to the exporter now.
+        """
+        try:
+            self._exporter(self.metrics())
+        except Exception:
+            log.err(None, "Error exporting RED metrics.")
+
+    def stop(self):
+        """
+        Stop exporting periodically.
+        """
+        if self._loop.running:
+            self._loop.stop()
+
+
+def red_log_exporter(metrics):
+    """
+    Log one line per operation in L{REDTracer.metrics}.
+    """
+    for (service_name, name, kind), stats in sorted(metrics.iteritems()):
+        log.msg(format=("%(service_name)s %(name)s %(kind)s "
+                        "rate=%(rate).2f/s errors=%(error_rate).1f%% "
+                        "p50=%(p50).0fus p99=%(p99).0fus"),
+                system=REDTracer.__name__,
+                service_name=service_name, name=name, kind=kind,
+                rate=stats['rate'], error_rate=stats['error_rate'] * 100,
+                p50=stats['duration']['p50'], p99=stats['duration']['p99'])
+
+
+class MetricsResource(Resource):
+    """
+    Serve metrics as JSON, one object per operation with C{service_name},
+    C{name} and C{kind} fields alongside its values.
+
+    @param metrics: A callable taking no arguments which returns a C{dict}
+        keyed by C{(service_name, span name, kind)}, such as
+        L{REDTracer.metrics} or L{LatencyTracer.snapshot}.
+    """
+    isLeaf = True
+
+    def __init__(self, metrics):
+        Resource.__init__(self)
+        self._metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'application/json')
+
+        operations = []
+
+        for (service_name, name, kind), values in sorted(
+                self._metrics().iteritems()):
+            operation = dict(values)
+            operation.update(
+                {'service_name': service_name, 'name': name, 'kind': kind})
+            operations.append(operation)
+
+        return json.dumps(operations)
@@ -0,0 +1,159 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Deliver to several scribe hosts, so one slow or dead host does not hold up
+every span.
+"""
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+
+from scrivener import ScribeClient
+from scrivener._thrift.scribe.ttypes import ResultCode
+
+from tryfer import log
+
+
+class _Host(object):
+    __slots__ = ('client', 'outstanding', 'ejected_until')
+
+    def __init__(self, client):
+        self.client = client
+        self.outstanding = 0
+        self.ejected_until = 0
+
+
+class ScribeClientPool(object):
+    """
+    A pool of scribe clients which can be used anywhere a single
+    L{scrivener.ScribeClient} is, such as by L{tryfer.tracers.ZipkinTracer}
+    or L{tryfer.tracers.RESTkinScribeTracer}.
+
+    Each call to L{log} goes to the healthy client with the fewest
+    outstanding requests.  A client whose request fails, or which answers
+    C{TRY_LATER}, is ejected from the pool for C{eject_time} seconds and the
+    messages are sent to the next least loaded client which has not yet been
+    tried.  When every client has been ejected the one due back soonest is
+    used, so messages are still attempted while all hosts are down.
+
+    @param clients: A C{list} of L{scrivener.ScribeClient} instances, or
+        other objects with a compatible C{log} method.
+
+    @param eject_time: How long in seconds to stop using a client after a
+        failure.
+
+    @param _reactor: An L{IReactorTime} provider, used for testing.
+    """
+    def __init__(self, clients, eject_time=30, _reactor=None):
+        if not clients:
+            raise ValueError("ScribeClientPool needs at least one client.")
+
+        self._hosts = [_Host(client) for client in clients]
+        self._eject_time = eject_time
+        self._reactor = _reactor or reactor
+        self._next = 0
+
+    @classmethod
+    def from_endpoints(cls, endpoints, **kwargs):
+        """
+        Create a pool with a L{scrivener.ScribeClient} for each endpoint.
+
+        @param endpoints: A C{list} of L{IStreamClientEndpoint} providers.
+        """
+        return cls([ScribeClient(endpoint) for endpoint in endpoints],
+                   **kwargs)
+
+    def _choose(self, tried):
+        now = self._reactor.seconds()
+        hosts = [host for host in self._hosts if host not in tried]
+
+        if not hosts:
+            return None
+
+        healthy = [host for host in hosts if host.ejected_until <= now]
+
+        if not healthy:
+            return min(hosts, key=lambda host: host.ejected_until)
+
+        # Rotate where the search starts so equally loaded hosts take turns.
+        self._next = (self._next + 1) % len(healthy)
+        return min(healthy[self._next:] + healthy[:self._next],
+                   key=lambda host: host.outstanding)
+
+    def _eject(self, host, reason):
+        host.ejected_until = self._reactor.seconds() + self._eject_time
+        log.msg(format=("Ejecting scribe client %(client)r for "
+                        "%(eject_time)s seconds: %(reason)s"),
+                system=self.__class__.__name__,
+                client=host.client,
+                eject_time=self._eject_time,
+                reason=reason)
+
+    def log(self, category, messages):
+        """
+        Log C{messages} to C{category} on one of the pooled clients.
+
+        @returns: A L{Deferred} which fires with the C{ResultCode} of the
+            first client to accept the messages, with C{TRY_LATER} if every
+            client asked for them to be retried, or fails with the last
+            client's failure.
+        """
+        result = Deferred()
+        tried = set()
+
+        def _attempt(last, reason=None):
+            host = self._choose(tried)
+
+            if host is None:
+                if last is None:
+                    result.callback(ResultCode.TRY_LATER)
+                else:
+                    result.errback(last)
+                return
+
+            if reason is not None:
+                # Whatever the retry's outcome, this is the only record of
+                # why the previous client did not take the messages.
+                log.msg(format=("Retrying %(category)s messages on scribe "
+                                "client %(client)r after: %(reason)s"),
+                        system=self.__class__.__name__,
+                        category=category,
+                        client=host.client,
+                        reason=reason,
+                        failure=last)
+
+            tried.add(host)
+            host.outstanding += 1
+
+            d = maybeDeferred(host.client.log, category, messages)
+            d.addCallbacks(_logged, _failed,
+                           callbackArgs=(host,), errbackArgs=(host,))
+
+        def _logged(code, host):
+            host.outstanding -= 1
+
+            if code == ResultCode.TRY_LATER:
+                self._eject(host, "TRY_LATER")
+                _attempt(None, "TRY_LATER")
+            else:
+                result.callback(code)
+
+        def _failed(failure, host):
+            host.outstanding -= 1
+            self._eject(host, failure.getErrorMessage())
+            _attempt(failure, failure.getErrorMessage())
+
+        _attempt(None)
+        return result
@@ -0,0 +1,219 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Upload spans captured to files back into a collector.
+"""
+
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    DeferredList,
+    DeferredSemaphore,
+    inlineCallbacks,
+    maybeDeferred,
+    returnValue
+)
+from twisted.internet.task import deferLater
+
+from tryfer import log
+from tryfer.decoders import (
+    json_decoder,
+    compact_decoder,
+    base64_thrift_decoder
+)
+
+
+def base64_thrift_line_decoder(line):
+    return [base64_thrift_decoder(line)]
+
+
+def auto_decoder(line):
+    """
+    Decode a line written by L{tryfer.formatters.json_formatter} (or
+    L{tryfer.tracers.FileTracer}), L{tryfer.formatters.compact_formatter} or
+    L{tryfer.formatters.base64_thrift_formatter}.
+
+    @returns: A C{list} of 2-C{tuple}s of L{Trace} and C{list} of
+        L{Annotation}.
+    """
+    if line[:1] in ('[', '{'):
+        return json_decoder(line)
+
+    return base64_thrift_line_decoder(line)
+
+
+DECODERS = {
+    'auto': auto_decoder,
+    'json': json_decoder,
+    'compact': compact_decoder,
+    'base64_thrift': base64_thrift_line_decoder,
+}
+
+
+class Replayer(object):
+    """
+    Decode spans from lines of text and re-record them to an L{ITracer} in
+    batches, with a bounded number of batches in flight at once.
+
+    @param tracer: An L{ITracer} provider whose C{record} returns a
+        L{Deferred} which fires once delivery has finished, such as
+        L{tryfer.tracers.RawRESTkinHTTPTracer}.  If it has a C{send} method,
+        as the raw tracers do, that is used instead so that failed
+        deliveries are reported rather than only logged.
+
+    @param batch_size: C{int} number of spans to record at once.
+        Default 100.
+
+    @param concurrency: C{int} maximum number of batches in flight.
+        Default 4.
+
+    @param rate: C{float} maximum number of spans recorded per second, or
+        C{None} for no limit.  Default C{None}.
+
+    @param decoder: A callable which turns a line into a C{list} of
+        C{(trace, annotations)} tuples.  Default L{auto_decoder}.
+
+    @param _reactor: An L{IReactorTime} provider.
+
+    @ivar lines: C{int} number of lines read.
+    @ivar spans: C{int} number of spans which have been delivered.
+    @ivar errors: C{int} number of lines which could not be decoded plus
+        batches which could not be delivered.
+    @ivar offset: C{int} number of lines from the start of the input which
+        have been completely delivered.  Replaying again from this offset
+        will not skip any spans.
+    """
+
+    def __init__(self, tracer, batch_size=100, concurrency=4, rate=None,
+                 decoder=auto_decoder, _reactor=None):
+        self._record = getattr(tracer, 'send', None) or tracer.record
+        self._batch_size = batch_size
+        self._semaphore = DeferredSemaphore(concurrency)
+        self._rate = rate
+        self._decoder = decoder
+        self._reactor = _reactor or reactor
+
+        self._in_flight = deque()
+        self._outstanding = set()
+        self._next_send = None
+        self._started = None
+
+        self.lines = 0
+        self.spans = 0
+        self.errors = 0
+        self.offset = 0
+
+    def throughput(self):
+        """
+        @returns: C{float} spans delivered per second so far.
+        """
+        if self._started is None:
+            return 0.0
+
+        elapsed = self._reactor.seconds() - self._started
+        if elapsed <= 0:
+            return 0.0
+
+        return self.spans / elapsed
+
+    def _delivered(self, result, entry, count):
+        entry[1] = True
+        self.spans += count
+
+        while self._in_flight and self._in_flight[0][1]:
+            self.offset = self._in_flight.popleft()[0]
+
+        self._semaphore.release()
+
+    def _failed(self, failure, entry):
+        # The entry stays at the head of the queue once it gets there, so
+        # the offset never moves past the failed batch.
+        self.errors += 1
+        log.err(failure, "Error replaying traces up to line {0}.".format(
+            entry[0]))
+
+        self._semaphore.release()
+
+    @inlineCallbacks
+    def _send(self, batch, end_line):
+        yield self._semaphore.acquire()
+
+        if self._rate:
+            now = self._reactor.seconds()
+            send_at = max(now, self._next_send or now)
+            self._next_send = send_at + len(batch) / float(self._rate)
+
+            if send_at > now:
+                yield deferLater(self._reactor, send_at - now, lambda: None)
+
+        entry = [end_line, False]
+        self._in_flight.append(entry)
+
+        d = maybeDeferred(self._record, batch)
+        d.addCallbacks(self._delivered, self._failed,
+                       callbackArgs=(entry, len(batch)),
+                       errbackArgs=(entry,))
+
+        self._outstanding.add(d)
+        d.addCallback(lambda _: self._outstanding.discard(d))
+
+    @inlineCallbacks
+    def replay(self, lines, offset=0):
+        """
+        Decode and record all spans in C{lines}.
+
+        @param lines: An iterable of C{str} lines, such as an open file.  It
+            is consumed no faster than spans can be delivered.
+
+        @param offset: C{int} number of lines to skip, usually the L{offset}
+            of a previous interrupted replay.
+
+        @returns: A L{Deferred} which fires with this L{Replayer} once all
+            spans have been delivered or have failed.  L{offset} only
+            reaches the end of C{lines} if none failed.
+        """
+        self._started = self._reactor.seconds()
+        self.offset = self.lines = offset
+        batch = []
+
+        for line_number, line in enumerate(lines):
+            if line_number < offset:
+                continue
+
+            line = line.strip()
+
+            if line:
+                try:
+                    batch.extend(self._decoder(line))
+                except Exception:
+                    self.errors += 1
+                    log.err(None, "Error decoding line {0}.".format(
+                        line_number + 1))
+
+            self.lines = line_number + 1
+
+            if len(batch) >= self._batch_size:
+                yield self._send(batch, self.lines)
+                batch = []
+
+        if batch:
+            yield self._send(batch, self.lines)
+
+        yield DeferredList(list(self._outstanding))
+
+        if not self._in_flight:
+            self.offset = self.lines
+        returnValue(self)
@@ -0,0 +1,252 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local stand-ins for trace collectors, for use in tests and capacity testing.
+"""
+
+import json
+import random
+
+from zope.interface import implements
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.task import deferLater
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from scrivener._thrift.scribe import scribe, ttypes as scribe_ttypes
+
+from tryfer.decoders import json_decoder, base64_thrift_decoder
+
+
+class UDPSpanReceiver(DatagramProtocol):
+    """
+    Receive spans sent by L{tryfer.tracers.RawUDPTracer}.
+
+    @ivar spans: A C{list} of every span received, as decoded JSON.
+    @ivar datagrams: A C{list} of the sizes of every datagram received.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.datagrams = []
+        self._waiting = []
+
+    def datagramReceived(self, data, addr):
+        self.datagrams.append(len(data))
+        self.spans.extend(json.loads(data))
+
+        waiting = self._waiting
+        self._waiting = []
+
+        for (count, d) in waiting:
+            if len(self.spans) >= count:
+                d.callback(self.spans)
+            else:
+                self._waiting.append((count, d))
+
+    def wait_for_spans(self, count):
+        """
+        @returns: A L{Deferred} which fires with L{spans} once at least
+            C{count} spans have been received.
+        """
+        if len(self.spans) >= count:
+            return succeed(self.spans)
+
+        d = Deferred()
+        self._waiting.append((count, d))
+        return d
+
+
+class CollectorStats(object):
+    """
+    What a stand-in collector has seen.
+
+    @ivar accepted: C{int} number of spans accepted.
+    @ivar errors: C{int} number of spans rejected with an injected error.
+    @ivar throttled: C{int} number of spans rejected because the collector's
+        C{max_rate} was exceeded.
+    @ivar max_delay: C{float} longest end-to-end delay in seconds.
+    """
+
+    def __init__(self, _reactor=None):
+        self._reactor = _reactor or reactor
+        self._started = self._reactor.seconds()
+        self._total_delay = 0.0
+
+        self.accepted = 0
+        self.errors = 0
+        self.throttled = 0
+        self.max_delay = 0.0
+
+    def accept(self, spans):
+        """
+        Count C{spans} as accepted now, measuring the delay from the last
+        timestamp annotation of each one.
+        """
+        now = self._reactor.seconds()
+
+        for (trace, annotations) in spans:
+            timestamps = [a.value for a in annotations
+                          if a.annotation_type == 'timestamp']
+
+            if timestamps:
+                delay = now - max(timestamps) / 1000000.0
+                self._total_delay += delay
+                self.max_delay = max(self.max_delay, delay)
+
+        self.accepted += len(spans)
+
+    def spans_per_second(self):
+        elapsed = self._reactor.seconds() - self._started
+
+        if elapsed <= 0:
+            return 0.0
+
+        return self.accepted / elapsed
+
+    def mean_delay(self):
+        """
+        @returns: C{float} mean number of seconds between the last timestamp
+            annotation of an accepted span and the collector receiving it.
+        """
+        if not self.accepted:
+            return 0.0
+
+        return self._total_delay / self.accepted
+
+
+class _StandInCollector(object):
+    """
+    Injects latency, errors and throttling into a stand-in collector.
+
+    @param latency: C{float} seconds to wait before responding.
+
+    @param error_rate: C{float} fraction of requests, between 0 and 1, which
+        fail.
+
+    @param max_rate: C{float} maximum number of spans accepted per second,
+        or C{None} for no limit.  Requests which would exceed it are
+        throttled.
+    """
+
+    def __init__(self, latency=0, error_rate=0, max_rate=None,
+                 _reactor=None, _random=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_rate = max_rate
+
+        self._reactor = _reactor or reactor
+        self._random = _random or random.Random()
+
+        self._window = None
+        self._window_spans = 0
+
+        self.stats = CollectorStats(self._reactor)
+
+    def _admit(self, spans):
+        """
+        Decide what to do with a request carrying C{spans}.
+
+        @returns: C{'accepted'}, C{'error'} or C{'throttled'}.
+        """
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.stats.errors += len(spans)
+            return 'error'
+
+        if self.max_rate is not None:
+            window = int(self._reactor.seconds())
+
+            if window != self._window:
+                self._window, self._window_spans = window, 0
+
+            if self._window_spans + len(spans) > self.max_rate:
+                self.stats.throttled += len(spans)
+                return 'throttled'
+
+            self._window_spans += len(spans)
+
+        self.stats.accept(spans)
+        return 'accepted'
+
+    def _respond(self, f, *args):
+        if self.latency:
+            return deferLater(self._reactor, self.latency, f, *args)
+
+        return f(*args)
+
+
+def _scribe_message_decoder(message):
+    if message[:1] == '[':
+        return json_decoder(message)
+
+    return [base64_thrift_decoder(message)]
+
+
+class ScribeCollector(_StandInCollector):
+    """
+    A stand-in for a scribe server feeding Zipkin or RESTkin, for use with
+    L{scrivener.ScribeServerService}.  Accepts spans logged by
+    L{tryfer.tracers.RawZipkinTracer} and
+    L{tryfer.tracers.RawRESTkinScribeTracer}.
+
+    Errors and throttling are both reported to the client as C{TRY_LATER}.
+    """
+    implements(scribe.Iface)
+
+    def Log(self, messages):
+        spans = []
+
+        for entry in messages:
+            spans.extend(_scribe_message_decoder(entry.message))
+
+        if self._admit(spans) == 'accepted':
+            result = scribe_ttypes.ResultCode.OK
+        else:
+            result = scribe_ttypes.ResultCode.TRY_LATER
+
+        return self._respond(lambda: result)
+
+
+class RESTkinCollector(_StandInCollector, Resource):
+    """
+    A stand-in for RESTkin's trace resource.  Accepts spans POSTed by
+    L{tryfer.tracers.RawRESTkinHTTPTracer}.
+
+    Errors are reported with a 500 response and throttling with a 503.
+    """
+    isLeaf = True
+
+    _codes = {
+        'accepted': 202,
+        'error': 500,
+        'throttled': 503
+    }
+
+    def __init__(self, *args, **kwargs):
+        _StandInCollector.__init__(self, *args, **kwargs)
+        Resource.__init__(self)
+
+    def render_POST(self, request):
+        request.setResponseCode(
+            self._codes[self._admit(json_decoder(request.content.read()))])
+
+        if not self.latency:
+            return ''
+
+        self._respond(request.finish)
+        return NOT_DONE_YET
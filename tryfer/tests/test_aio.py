@@ -0,0 +1,414 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import socket
+import struct
+
+import mock
+
+from zope.interface import implements
+
+from twisted.trial.unittest import TestCase
+
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
+
+from scrivener._thrift.scribe import scribe, ttypes as scribe_ttypes
+
+from tryfer.trace import Trace, Annotation
+from tryfer.decoders import base64_thrift_decoder
+from tryfer.tracers import DeliveryError
+
+try:
+    from tryfer import aio
+    from tryfer.aio import asyncio
+except ImportError:
+    aio = None
+
+
+class _HTTPServer(object):
+    def __init__(self, response=None, stall=0):
+        self.bodies = []
+        self.connections = 0
+        self.response = response or (
+            b'HTTP/1.1 202 Accepted\r\nContent-Length: 0\r\n\r\n')
+        self.stall = stall
+
+    def protocol(self):
+        server = self
+
+        class Protocol(asyncio.Protocol):
+            def connection_made(self, transport):
+                server.connections += 1
+                self.transport = transport
+                self.data = b''
+
+            def data_received(self, data):
+                self.data += data
+                head, sep, body = self.data.partition(b'\r\n\r\n')
+
+                if not sep:
+                    return
+
+                length = [int(line.split(b':')[1])
+                          for line in head.split(b'\r\n')
+                          if line.lower().startswith(b'content-length')][0]
+
+                if len(body) >= length:
+                    self.data = body[length:]
+                    server.bodies.append(body[:length])
+
+                    if server.stall:
+                        server.stall -= 1
+                    else:
+                        self.transport.write(server.response)
+
+        return Protocol()
+
+
+class _ScribeServer(object):
+    implements(scribe.Iface)
+
+    def __init__(self, result=scribe_ttypes.ResultCode.OK):
+        self.messages = []
+        self.connections = 0
+        self.result = result
+
+    def Log(self, messages):
+        self.messages.extend(messages)
+        return self.result
+
+    def protocol(self):
+        server = self
+
+        class Protocol(asyncio.Protocol):
+            def connection_made(self, transport):
+                server.connections += 1
+                self.transport = transport
+                self.data = b''
+
+            def data_received(self, data):
+                self.data += data
+
+                while len(self.data) >= 4:
+                    (length,) = struct.unpack('!i', self.data[:4])
+
+                    if len(self.data) < 4 + length:
+                        return
+
+                    frame = self.data[4:4 + length]
+                    self.data = self.data[4 + length:]
+
+                    otrans = TTransport.TMemoryBuffer()
+                    scribe.Processor(server).process(
+                        TBinaryProtocol.TBinaryProtocol(
+                            TTransport.TMemoryBuffer(frame)),
+                        TBinaryProtocol.TBinaryProtocol(otrans))
+
+                    reply = otrans.getvalue()
+                    self.transport.write(
+                        struct.pack('!i', len(reply)) + reply)
+
+        return Protocol()
+
+
+class _LoopTestCase(TestCase):
+    if aio is None:
+        skip = "Neither asyncio nor trollius is installed."
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def run_until(self, future, timeout=5):
+        return self.loop.run_until_complete(
+            asyncio.wait_for(future, timeout, loop=self.loop))
+
+    def listen(self, server):
+        listening = self.run_until(self.loop.create_server(
+            server.protocol, '127.0.0.1', 0))
+        self.addCleanup(listening.close)
+        return listening.sockets[0].getsockname()[1]
+
+    def trace(self):
+        trace = Trace('test', trace_id=1, span_id=2)
+        return (trace, [Annotation.timestamp('test', 1)])
+
+
+class BufferingTracerTests(_LoopTestCase):
+    def setUp(self):
+        super(BufferingTracerTests, self).setUp()
+        self.tracer = mock.Mock()
+        self.tracer.record.return_value = None
+
+    def test_flushes_when_full(self):
+        tracer = aio.BufferingTracer(self.tracer, max_traces=2,
+                                     max_idle_time=None, loop=self.loop)
+        trace = self.trace()
+
+        tracer.record([trace])
+        tracer.record([trace])
+        self.assertEqual(self.tracer.record.call_count, 0)
+
+        self.run_until(asyncio.sleep(0, loop=self.loop))
+        self.tracer.record.assert_called_once_with([trace, trace])
+
+    def test_flushes_when_idle(self):
+        tracer = aio.BufferingTracer(self.tracer, max_traces=10,
+                                     max_idle_time=0.01, loop=self.loop)
+        trace = self.trace()
+
+        tracer.record([trace])
+        self.run_until(asyncio.sleep(0.005, loop=self.loop))
+        tracer.record([trace])
+        self.run_until(asyncio.sleep(0.008, loop=self.loop))
+        self.assertEqual(self.tracer.record.call_count, 0)
+
+        self.run_until(asyncio.sleep(0.02, loop=self.loop))
+        self.tracer.record.assert_called_once_with([trace, trace])
+
+    def test_one_timer_for_many_records(self):
+        tracer = aio.BufferingTracer(self.tracer, max_traces=1000,
+                                     max_idle_time=10, loop=self.loop)
+
+        with mock.patch.object(self.loop, 'call_later',
+                               wraps=self.loop.call_later) as call_later:
+            for i in xrange(100):
+                tracer.record([self.trace()])
+
+        self.assertEqual(call_later.call_count, 1)
+        tracer.drain()
+
+    def test_drain(self):
+        delivered = asyncio.Future(loop=self.loop)
+        self.tracer.record.return_value = delivered
+
+        tracer = aio.BufferingTracer(self.tracer, max_traces=10,
+                                     max_idle_time=10, loop=self.loop)
+        trace = self.trace()
+        tracer.record([trace])
+
+        drained = tracer.drain()
+        self.tracer.record.assert_called_once_with([trace])
+        self.assertFalse(drained.done())
+
+        delivered.set_result(None)
+        self.run_until(drained)
+
+
+class RawRESTkinHTTPTracerTests(_LoopTestCase):
+    def test_posts_json(self):
+        server = _HTTPServer()
+        port = self.listen(server)
+
+        tracer = aio.RawRESTkinHTTPTracer(
+            'http://127.0.0.1:{0}/v1.0/22/trace'.format(port), loop=self.loop)
+
+        code = self.run_until(tracer.record([self.trace()]))
+        self.assertEqual(code, 202)
+
+        [body] = server.bodies
+        self.assertEqual(json.loads(body)[0]['trace_id'], '0000000000000001')
+
+    def test_reuses_connection(self):
+        server = _HTTPServer()
+        port = self.listen(server)
+
+        tracer = aio.RawRESTkinHTTPTracer(
+            'http://127.0.0.1:{0}/'.format(port), loop=self.loop)
+
+        self.run_until(asyncio.gather(
+            *[tracer.record([self.trace()]) for i in xrange(5)],
+            loop=self.loop))
+
+        self.assertEqual(len(server.bodies), 5)
+        self.assertEqual(server.connections, 1)
+
+    def test_reconnects_after_close(self):
+        server = _HTTPServer(
+            b'HTTP/1.1 202 Accepted\r\nContent-Length: 2\r\n'
+            b'Connection: close\r\n\r\nok')
+        port = self.listen(server)
+
+        tracer = aio.RawRESTkinHTTPTracer(
+            'http://127.0.0.1:{0}/'.format(port), loop=self.loop)
+
+        for i in xrange(3):
+            self.assertEqual(
+                self.run_until(tracer.record([self.trace()])), 202)
+
+        self.assertEqual(server.connections, 3)
+
+    def test_chunked_response(self):
+        server = _HTTPServer(
+            b'HTTP/1.1 200 OK\r\n'
+            b'Transfer-Encoding: chunked\r\n\r\n'
+            b'5\r\nfound\r\n0\r\n\r\n')
+        port = self.listen(server)
+
+        tracer = aio.RawRESTkinHTTPTracer(
+            'http://127.0.0.1:{0}/'.format(port), loop=self.loop)
+
+        self.assertEqual(self.run_until(tracer.record([self.trace()])), 200)
+
+    def test_chunked_framing(self):
+        protocol = aio._HTTPProtocol(None)
+        head = b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+
+        # The data of an unfinished chunk ends like a whole body does.
+        self.assertIdentical(
+            protocol.parse(head + b'a\r\n0\r\n\r\n'), None)
+        self.assertIdentical(
+            protocol.parse(head + b'5;ext=1\r\n0\r\n\r\n\r\n0\r\n'), None)
+        self.assertEqual(
+            protocol.parse(head + b'5\r\n0\r\n\r\n\r\n0\r\n\r\n'), 200)
+        self.assertEqual(
+            protocol.parse(head + b'0\r\nExpires: 0\r\n\r\n'), 200)
+
+    def test_error_response(self):
+        server = _HTTPServer(
+            b'HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\n'
+            b'\r\n')
+        port = self.listen(server)
+
+        tracer = aio.RawRESTkinHTTPTracer(
+            'http://127.0.0.1:{0}/'.format(port), loop=self.loop)
+
+        with mock.patch.object(aio, '_log') as _log:
+            self.assertRaises(DeliveryError, self.run_until,
+                              tracer.record([self.trace()]))
+
+        self.assertEqual(_log.error.call_count, 1)
+
+    def test_timeout(self):
+        server = _HTTPServer(stall=1)
+        port = self.listen(server)
+
+        tracer = aio.RawRESTkinHTTPTracer(
+            'http://127.0.0.1:{0}/'.format(port), loop=self.loop,
+            timeout=0.1)
+
+        with mock.patch.object(aio, '_log') as _log:
+            stalled = tracer.record([self.trace()])
+            queued = tracer.record([self.trace()])
+
+            # The timeout counts from when each request is made, so waiting
+            # behind a stalled request uses it up too.
+            self.assertRaises(asyncio.TimeoutError, self.run_until, stalled)
+            self.assertRaises(asyncio.TimeoutError, self.run_until, queued)
+
+        self.assertEqual(_log.error.call_count, 2)
+
+        # The stalled connection was dropped, so the next request is sent on
+        # a new one.
+        self.assertEqual(self.run_until(tracer.record([self.trace()])), 202)
+        self.assertEqual(len(server.bodies), 2)
+        self.assertEqual(server.connections, 2)
+
+    def test_logs_errors(self):
+        unused = socket.socket()
+        unused.bind(('127.0.0.1', 0))
+        port = unused.getsockname()[1]
+        unused.close()
+
+        tracer = aio.RawRESTkinHTTPTracer(
+            'http://127.0.0.1:{0}/'.format(port), loop=self.loop)
+
+        with mock.patch.object(aio, '_log') as _log:
+            self.assertRaises(Exception, self.run_until,
+                              tracer.record([self.trace()]))
+
+        self.assertEqual(_log.error.call_count, 1)
+
+
+class RawZipkinTracerTests(_LoopTestCase):
+    def test_logs_base64_thrift(self):
+        server = _ScribeServer()
+        port = self.listen(server)
+
+        tracer = aio.RawZipkinTracer('127.0.0.1', port, loop=self.loop)
+
+        result = self.run_until(tracer.record([self.trace(), self.trace()]))
+        self.assertEqual(result, scribe_ttypes.ResultCode.OK)
+
+        self.assertEqual([m.category for m in server.messages],
+                         ['zipkin', 'zipkin'])
+
+        [message, _] = server.messages
+        (trace, annotations) = base64_thrift_decoder(message.message)
+        self.assertEqual(trace.trace_id, 1)
+        self.assertEqual(annotations[0].name, 'test')
+
+    def test_reuses_connection(self):
+        server = _ScribeServer()
+        port = self.listen(server)
+
+        tracer = aio.RawZipkinTracer('127.0.0.1', port, loop=self.loop)
+
+        self.run_until(asyncio.gather(
+            *[tracer.record([self.trace()]) for i in xrange(5)],
+            loop=self.loop))
+
+        self.assertEqual(len(server.messages), 5)
+        self.assertEqual(server.connections, 1)
+
+    def test_try_later(self):
+        server = _ScribeServer(scribe_ttypes.ResultCode.TRY_LATER)
+        port = self.listen(server)
+
+        tracer = aio.RawZipkinTracer('127.0.0.1', port, loop=self.loop)
+
+        with mock.patch.object(aio, '_log') as _log:
+            self.assertRaises(DeliveryError, self.run_until,
+                              tracer.record([self.trace()]))
+
+        self.assertEqual(_log.error.call_count, 1)
+
+
+class RawRESTkinScribeTracerTests(_LoopTestCase):
+    def test_logs_json(self):
+        server = _ScribeServer()
+        port = self.listen(server)
+
+        tracer = aio.RawRESTkinScribeTracer('127.0.0.1', port,
+                                            loop=self.loop)
+
+        self.run_until(tracer.record([self.trace(), self.trace()]))
+
+        [message] = server.messages
+        self.assertEqual(message.category, 'restkin')
+        self.assertEqual(len(json.loads(message.message)), 2)
+
+
+class ZipkinTracerTests(_LoopTestCase):
+    def test_end_annotations_and_drain(self):
+        server = _ScribeServer()
+        port = self.listen(server)
+
+        tracer = aio.ZipkinTracer('127.0.0.1', port, loop=self.loop)
+
+        finished = Trace('finished', trace_id=1, span_id=2)
+        unfinished = Trace('unfinished', trace_id=1, span_id=3)
+
+        tracer.record([(finished, [Annotation.client_send(1)])])
+        tracer.record([(finished, [Annotation.client_recv(2)])])
+        tracer.record([(unfinished, [Annotation.client_send(1)])])
+
+        self.run_until(tracer.drain())
+
+        self.assertEqual(
+            sorted(base64_thrift_decoder(m.message)[0].name
+                   for m in server.messages),
+            ['finished', 'unfinished'])
@@ -0,0 +1,349 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import random
+
+import mock
+
+from zope.interface.verify import verifyObject
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+from twisted.web.test.requesthelper import DummyRequest
+
+from tryfer.analysis import (
+    TraceTreeTracer,
+    RecentSpansTracer,
+    RecentSpansResource
+)
+from tryfer.interfaces import ITracer
+from tryfer.loadgen import record_trace_tree
+from tryfer.trace import Trace, Annotation
+from tryfer.tracers import FlushScheduler
+
+
+def _span(name, span_id, parent_span_id, start, end, trace_id=1):
+    return (Trace(name, trace_id, span_id, parent_span_id, tracers=[]),
+            [Annotation.server_recv(start), Annotation.server_send(end)])
+
+
+class TraceTreeTracerTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.trees = []
+        self.tracer = TraceTreeTracer(
+            idle_time=5, on_tree=self.trees.append,
+            flush_scheduler=FlushScheduler(_reactor=self.clock),
+            _reactor=self.clock)
+
+    def names(self, nodes):
+        return [node.trace.name for node in nodes]
+
+    def test_verifyObject(self):
+        verifyObject(ITracer, self.tracer)
+
+    def test_assembles_after_idle_time(self):
+        self.tracer.record([_span('root', 1, None, 0, 100)])
+        self.clock.advance(3)
+        self.tracer.record([_span('child', 2, 1, 10, 50)])
+        self.clock.advance(3)
+
+        self.assertEqual(self.trees, [])
+
+        self.clock.advance(3)
+
+        [tree] = self.trees
+        self.assertEqual(tree.root.trace.name, 'root')
+        self.assertEqual(self.names(tree.root.children), ['child'])
+        self.assertEqual(tree.duration, 100)
+
+    def test_merges_client_and_server_halves(self):
+        trace = Trace('child', 1, 2, 1, tracers=[])
+
+        self.tracer.record([
+            _span('root', 1, None, 0, 100),
+            (trace, [Annotation.server_recv(20), Annotation.server_send(40)]),
+            (trace, [Annotation.client_send(10), Annotation.client_recv(50)])
+        ])
+        self.tracer.flush()
+
+        [tree] = self.trees
+        [child] = tree.root.children
+        self.assertEqual(len(child.annotations), 4)
+        self.assertEqual((child.start, child.end), (10, 50))
+
+    def test_self_time_and_critical_path(self):
+        # root    |0--------------------------100|
+        # a          |10----40|
+        # b               |30------------80|
+        # c                                   |85-95|
+        # b1                  |40--60|
+        self.tracer.record([
+            _span('root', 1, None, 0, 100),
+            _span('a', 2, 1, 10, 40),
+            _span('b', 3, 1, 30, 80),
+            _span('c', 4, 1, 85, 95),
+            _span('b1', 5, 3, 40, 60),
+        ])
+        self.tracer.flush()
+
+        [tree] = self.trees
+        spans = dict((n.trace.name, n) for n in tree.spans)
+
+        self.assertEqual(spans['root'].self_time, 100 - 70 - 10)
+        self.assertEqual(spans['b'].self_time, 30)
+        self.assertEqual(spans['b1'].self_time, 20)
+
+        self.assertEqual(self.names(tree.critical_path),
+                         ['root', 'b', 'b1', 'c'])
+
+    def test_format(self):
+        self.tracer.record([_span('root', 1, None, 0, 100),
+                            _span('child', 2, 1, 10, 50)])
+        self.tracer.flush()
+
+        self.assertEqual(self.trees[0].format(),
+                         '* root 100us (self 60us)\n'
+                         '*   child 40us (self 40us)')
+
+    def test_missing_root(self):
+        self.tracer.record([_span('a', 2, 1, 10, 40),
+                            _span('b', 3, 1, 0, 100),
+                            _span('b1', 4, 3, 20, 30)])
+        self.tracer.flush()
+
+        [tree] = self.trees
+        self.assertEqual(tree.root.trace.name, 'b')
+        self.assertEqual(len(tree.spans), 3)
+
+    def test_parent_cycle(self):
+        self.tracer.record([_span('a', 2, 3, 10, 40),
+                            _span('b', 3, 2, 0, 100)])
+        self.tracer.flush()
+
+        [tree] = self.trees
+        self.assertEqual(tree.root.trace.name, 'b')
+        self.assertEqual(self.names(tree.critical_path), ['b', 'a'])
+
+    def test_generated_trees(self):
+        for x in xrange(3):
+            record_trace_tree(self.tracer, depth=3, fanout=3,
+                              _random=random.Random(x))
+
+        self.tracer.flush()
+
+        self.assertEqual(len(self.trees), 3)
+
+        for tree in self.trees:
+            self.assertEqual(len(tree.spans), 13)
+            self.assertEqual(tree.root.trace.parent_span_id, None)
+            # Children are called one after another, so all of them are on
+            # the critical path.
+            self.assertEqual(len(tree.critical_path), 13)
+
+    def test_max_pending(self):
+        tracer = TraceTreeTracer(max_pending=2, on_tree=self.trees.append,
+                                 _reactor=self.clock)
+
+        for trace_id in (1, 2, 3):
+            tracer.record([_span('root', 1, None, 0, 1, trace_id=trace_id)])
+
+        self.assertEqual([tree.trace_id for tree in self.trees], [1])
+        tracer.flush()
+
+    def test_deep_trace(self):
+        tracer = TraceTreeTracer(max_pending=1, on_tree=self.trees.append,
+                                 _reactor=self.clock)
+
+        tracer.record([_span('span', span_id, span_id - 1 or None,
+                             span_id, 2000 - span_id)
+                       for span_id in xrange(1, 1001)])
+        tracer.record([_span('root', 1, None, 0, 1, trace_id=2)])
+
+        [tree] = self.trees
+
+        self.assertEqual(len(tree.critical_path), 1000)
+        self.assertEqual(len(tree.format().splitlines()), 1000)
+        tracer.flush()
+
+    @mock.patch('tryfer.analysis.TraceTree', side_effect=ValueError)
+    def test_early_assembly_errors_are_logged(self, mock_tree):
+        tracer = TraceTreeTracer(max_pending=1, _reactor=self.clock)
+
+        tracer.record([_span('root', 1, None, 0, 1, trace_id=1)])
+        tracer.record([_span('root', 1, None, 0, 1, trace_id=2)])
+
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        mock_tree.side_effect = None
+        tracer.flush()
+
+    def test_max_spans(self):
+        tracer = TraceTreeTracer(max_spans=2, on_tree=self.trees.append,
+                                 _reactor=self.clock)
+
+        tracer.record([_span('root', 1, None, 0, 100),
+                       _span('a', 2, 1, 0, 10),
+                       _span('b', 3, 1, 0, 10)])
+        tracer.flush()
+
+        self.assertEqual(len(self.trees[0].spans), 2)
+        self.assertEqual(tracer.dropped_spans, 1)
+
+    def test_slowest(self):
+        tracer = TraceTreeTracer(keep=2, window=60, _reactor=self.clock)
+
+        for trace_id, duration in enumerate([30, 10, 50, 20], 1):
+            tracer.record([_span('root', 1, None, 0, duration,
+                                 trace_id=trace_id)])
+        tracer.flush()
+
+        self.assertEqual([tree.duration for tree in tracer.slowest()],
+                         [50, 30])
+
+        self.clock.advance(60)
+        tracer.record([_span('root', 1, None, 0, 5, trace_id=5)])
+        tracer.flush()
+
+        self.assertEqual([tree.duration for tree in tracer.slowest()],
+                         [50, 30])
+
+        self.clock.advance(120)
+
+        self.assertEqual(tracer.slowest(), [])
+
+    def test_on_tree_errors_are_logged(self):
+        tracer = TraceTreeTracer(on_tree=mock.Mock(side_effect=ValueError),
+                                 _reactor=self.clock)
+        tracer.record([_span('root', 1, None, 0, 1)])
+        tracer.flush()
+
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+
+class RecentSpansTracerTests(TestCase):
+    def setUp(self):
+        self.tracer = RecentSpansTracer(size=3)
+
+    def record(self, name, trace_id, span_id, duration):
+        trace = Trace(name, trace_id, span_id, tracers=[])
+        self.tracer.record([(trace, [Annotation.server_recv(100),
+                                     Annotation.server_send(100 + duration)])])
+        return trace
+
+    def test_verifyObject(self):
+        verifyObject(ITracer, self.tracer)
+
+    def test_most_recent_first(self):
+        a = self.record('a', 1, 1, 10)
+        b = self.record('b', 1, 2, 30)
+
+        self.assertEqual([(trace, duration) for (trace, _, duration)
+                          in self.tracer.spans()],
+                         [(b, 30), (a, 10)])
+
+    def test_keeps_last_size_spans(self):
+        traces = [self.record('a', 1, i, i) for i in xrange(1, 6)]
+
+        self.assertEqual([trace for (trace, _, _) in self.tracer.spans()],
+                         traces[:1:-1])
+        self.assertEqual(self.tracer._by_trace_id.keys(), [1])
+        self.assertEqual(len(self.tracer._by_trace_id[1]), 3)
+
+    def test_by_trace_id(self):
+        self.record('a', 1, 1, 10)
+        b = self.record('b', 2, 2, 10)
+        self.record('c', 3, 3, 10)
+
+        self.assertEqual(
+            [trace for (trace, _, _) in self.tracer.spans(trace_id=2)], [b])
+        self.assertEqual(self.tracer.spans(trace_id=4), [])
+
+    def test_by_name(self):
+        a1 = self.record('a', 1, 1, 10)
+        self.record('b', 1, 2, 10)
+        a2 = self.record('a', 1, 3, 10)
+
+        self.assertEqual(
+            [trace for (trace, _, _) in self.tracer.spans(name='a')],
+            [a2, a1])
+        self.assertEqual(
+            [trace for (trace, _, _)
+             in self.tracer.spans(trace_id=1, name='a', limit=1)],
+            [a2])
+
+    def test_evicted_spans_leave_indexes(self):
+        for i in xrange(1, 5):
+            self.record('name-{0}'.format(i), i, i, 10)
+
+        self.assertEqual(self.tracer.spans(trace_id=1), [])
+        self.assertEqual(self.tracer.spans(name='name-1'), [])
+        self.assertEqual(sorted(self.tracer._by_name),
+                         ['name-2', 'name-3', 'name-4'])
+
+    def test_slowest(self):
+        a = self.record('a', 1, 1, 20)
+        b = self.record('b', 1, 2, 30)
+        c = self.record('c', 1, 3, 10)
+
+        self.assertEqual(
+            [trace for (trace, _, _) in self.tracer.spans(slowest=True)],
+            [b, a, c])
+
+
+class RecentSpansResourceTests(TestCase):
+    def setUp(self):
+        self.tracer = RecentSpansTracer()
+        self.resource = RecentSpansResource(self.tracer)
+
+        for (name, span_id, duration) in [('a', 1, 20), ('b', 2, 30)]:
+            self.tracer.record([
+                (Trace(name, 10, span_id, tracers=[]),
+                 [Annotation.client_send(100),
+                  Annotation.client_recv(100 + duration)])])
+
+    def render(self, **args):
+        request = DummyRequest([''])
+        request.args = dict((k, [v]) for (k, v) in args.items())
+        return request, self.resource.render(request)
+
+    def test_recent(self):
+        (request, body) = self.render()
+
+        self.assertEqual(
+            [(span['name'], span['duration']) for span in json.loads(body)],
+            [('b', 30), ('a', 20)])
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-type'),
+            ['application/json'])
+
+    def test_filters(self):
+        (_, body) = self.render(trace_id='a', name='a')
+
+        [span] = json.loads(body)
+        self.assertEqual((span['trace_id'], span['name']),
+                         ('000000000000000a', 'a'))
+
+    def test_slowest_with_limit(self):
+        self.tracer.record([
+            (Trace('c', 10, 3, tracers=[]),
+             [Annotation.client_send(100), Annotation.client_recv(110)])])
+
+        (_, body) = self.render(sort='slowest', limit='2')
+
+        self.assertEqual([span['name'] for span in json.loads(body)],
+                         ['b', 'a'])
+
+    def test_bad_trace_id(self):
+        (request, body) = self.render(trace_id='xyz')
+
+        self.assertEqual(request.responseCode, 400)
@@ -0,0 +1,134 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+
+from tryfer.columnar import ColumnarSpanBuffer
+from tryfer.trace import Trace, Annotation, Endpoint
+from tryfer.tracers import BufferingTracer
+
+
+class ColumnarSpanBufferTests(TestCase):
+    def setUp(self):
+        self.endpoint = Endpoint('127.0.0.1', 8080, 'test')
+
+        self.root = Trace('root', 1, 2, tracers=[])
+        self.child = Trace('child', 1, 3, 2, tracers=[])
+
+        self.spans = [
+            (self.root, [Annotation.server_recv(10),
+                         Annotation.server_send(20)]),
+            (self.child, [Annotation.client_send(11),
+                          Annotation.string('http.uri', '/'),
+                          Annotation.client_recv(19)]),
+            (Trace('empty', 1, 4, 2, tracers=[]), [])]
+
+        for (trace, annotations) in self.spans:
+            for annotation in annotations:
+                annotation.endpoint = self.endpoint
+
+    def test_round_trip(self):
+        buffer = ColumnarSpanBuffer()
+        buffer.extend(self.spans)
+
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(list(buffer), self.spans)
+        self.assertEqual([trace.name for (trace, _) in buffer],
+                         ['root', 'child', 'empty'])
+
+    def test_no_parent(self):
+        buffer = ColumnarSpanBuffer()
+        buffer.append(self.spans[0])
+
+        [(trace, _)] = list(buffer)
+        self.assertEqual(trace.parent_span_id, None)
+
+    def test_interns_names_and_endpoints(self):
+        buffer = ColumnarSpanBuffer()
+        buffer.extend(self.spans * 10)
+
+        self.assertEqual(len(buffer), 30)
+        self.assertEqual(len(buffer._endpoint_table), 1)
+        self.assertEqual(
+            sorted(buffer._strings),
+            ['child', 'cr', 'cs', 'empty', 'root', 'sr', 'ss'])
+
+        annotations = [a for (_, annotations) in buffer for a in annotations]
+        self.assertEqual(set(id(a.endpoint) for a in annotations),
+                         set([id(self.endpoint)]))
+
+    def test_other_annotations_render_lazily(self):
+        render = mock.Mock(return_value='rendered')
+
+        buffer = ColumnarSpanBuffer()
+        buffer.append((self.root, [Annotation('lazy', render, 'string')]))
+
+        [(_, [annotation])] = list(buffer)
+        self.assertEqual(render.call_count, 0)
+        self.assertEqual(annotation.value, 'rendered')
+
+    def test_negative_ids_kept_whole(self):
+        span = (Trace('signed', -1, -2, -3, tracers=[]),
+                [Annotation.client_send(1)])
+
+        buffer = ColumnarSpanBuffer()
+        buffer.extend([self.spans[0], span, self.spans[1]])
+
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(list(buffer), [self.spans[0], span, self.spans[1]])
+
+        [_, (trace, _), _] = list(buffer)
+        self.assertEqual(
+            (trace.trace_id, trace.span_id, trace.parent_span_id),
+            (-1, -2, -3))
+
+    def test_float_timestamps(self):
+        annotation = Annotation.timestamp('cs', 1.5e15)
+
+        buffer = ColumnarSpanBuffer()
+        buffer.append((self.root, [annotation]))
+
+        [(_, [restored])] = list(buffer)
+        self.assertEqual(restored, annotation)
+        self.assertEqual(restored.value, 1.5e15)
+
+    def test_empty(self):
+        buffer = ColumnarSpanBuffer()
+
+        self.assertFalse(buffer)
+        self.assertEqual(list(buffer), [])
+
+
+class ColumnarBufferingTracerTests(TestCase):
+    def test_records_buffered_spans(self):
+        clock = Clock()
+        tracer = mock.Mock()
+
+        buffering = BufferingTracer(
+            tracer, max_traces=2, buffer_factory=ColumnarSpanBuffer,
+            _reactor=clock)
+
+        spans = [(Trace('test', 1, 2, tracers=[]),
+                  [Annotation.client_send(1)]),
+                 (Trace('test', 1, 3, 2, tracers=[]),
+                  [Annotation.client_recv(2)])]
+
+        buffering.record(spans[:1])
+        buffering.record(spans[1:])
+        clock.advance(0)
+
+        tracer.record.assert_called_once_with(spans)
@@ -0,0 +1,276 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+import mock
+
+from twisted.trial.unittest import TestCase
+
+from twisted.internet.defer import Deferred, succeed, fail, passthru
+
+from tryfer.context import (
+    current_trace,
+    call_with_trace,
+    bind,
+    install,
+    uninstall,
+    traced
+)
+from tryfer.trace import Trace
+
+
+class CallWithTraceTests(TestCase):
+    def setUp(self):
+        self.trace = Trace('test', tracers=[])
+
+    def test_no_current_trace(self):
+        self.assertEqual(current_trace(), None)
+
+    def test_current_during_call(self):
+        self.assertEqual(
+            call_with_trace(self.trace, current_trace), self.trace)
+        self.assertEqual(current_trace(), None)
+
+    def test_restores_on_error(self):
+        def _raise():
+            raise ValueError()
+
+        self.assertRaises(ValueError, call_with_trace, self.trace, _raise)
+        self.assertEqual(current_trace(), None)
+
+    def test_nested(self):
+        child = self.trace.child('child')
+
+        def _inner():
+            return (call_with_trace(child, current_trace), current_trace())
+
+        self.assertEqual(
+            call_with_trace(self.trace, _inner), (child, self.trace))
+
+    def test_per_thread(self):
+        seen = []
+
+        def _in_thread():
+            seen.append(current_trace())
+
+        def _start():
+            t = threading.Thread(target=_in_thread)
+            t.start()
+            t.join()
+
+        call_with_trace(self.trace, _start)
+
+        self.assertEqual(seen, [None])
+
+
+class BindTests(TestCase):
+    def setUp(self):
+        self.trace = Trace('test', tracers=[])
+
+    def test_bind_current(self):
+        bound = call_with_trace(self.trace, bind, current_trace)
+
+        self.assertEqual(bound(), self.trace)
+        self.assertEqual(current_trace(), None)
+
+    def test_bind_explicit(self):
+        self.assertEqual(bind(current_trace, self.trace)(), self.trace)
+
+    def test_bind_nothing_current(self):
+        self.assertIdentical(bind(current_trace), current_trace)
+
+
+class InstallTests(TestCase):
+    def setUp(self):
+        self.trace = Trace('test', tracers=[])
+        install()
+        self.addCleanup(uninstall)
+
+    def test_callbacks_see_trace(self):
+        d = Deferred()
+        seen = []
+
+        def _add():
+            d.addCallback(lambda _: seen.append(current_trace()))
+
+        call_with_trace(self.trace, _add)
+        d.callback(None)
+
+        self.assertEqual(seen, [self.trace])
+
+    def test_errbacks_see_trace(self):
+        seen = []
+
+        def _add():
+            d = fail(ValueError())
+            d.addErrback(lambda _: seen.append(current_trace()))
+
+        call_with_trace(self.trace, _add)
+
+        self.assertEqual(seen, [self.trace])
+
+    def test_trace_follows_chain(self):
+        d = Deferred()
+        seen = []
+
+        def _nested(_):
+            inner = succeed(None)
+            inner.addCallback(lambda _: seen.append(current_trace()))
+            return inner
+
+        call_with_trace(self.trace, d.addCallback, _nested)
+        d.callback(None)
+
+        self.assertEqual(seen, [self.trace])
+
+    def test_passthru_not_bound(self):
+        d = Deferred()
+
+        def _add():
+            d.addCallback(lambda result: result)
+            d.addErrback(lambda failure: failure)
+
+        call_with_trace(self.trace, _add)
+
+        [(_, (errback, _, _)), ((callback, _, _), _)] = d.callbacks
+        self.assertIdentical(errback, passthru)
+        self.assertIdentical(callback, passthru)
+
+    def test_callbacks_see_trace_in_other_threads(self):
+        seen = []
+
+        def _run():
+            d = Deferred()
+            call_with_trace(self.trace, d.addCallback,
+                            lambda _: seen.append(current_trace()))
+            d.callback(None)
+            seen.append(current_trace())
+
+        thread = threading.Thread(target=_run)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(seen, [self.trace, None])
+
+    def test_callbacks_without_trace(self):
+        seen = []
+
+        d = succeed(None)
+        d.addCallback(lambda _: seen.append(current_trace()))
+
+        self.assertEqual(seen, [None])
+
+    def test_uninstall(self):
+        uninstall()
+
+        d = Deferred()
+        seen = []
+
+        call_with_trace(
+            self.trace, d.addCallback, lambda _: seen.append(current_trace()))
+        d.callback(None)
+
+        self.assertEqual(seen, [None])
+
+
+class TracedTests(TestCase):
+    def setUp(self):
+        self.tracer = mock.Mock()
+        self.trace = Trace('test', trace_id=1, span_id=1,
+                           tracers=[self.tracer])
+
+    def recorded(self):
+        return [(trace, [a.name for a in annotations])
+                for ((traces,), _) in self.tracer.record.call_args_list
+                for (trace, annotations) in traces]
+
+    def test_no_current_trace(self):
+        @traced
+        def f(x):
+            return x, current_trace()
+
+        self.assertEqual(f(1), (1, None))
+        self.assertEqual(self.tracer.record.call_count, 0)
+
+    def test_records_child_span(self):
+        @traced
+        def f():
+            return current_trace()
+
+        child = call_with_trace(self.trace, f)
+
+        self.assertEqual(child.name, 'f')
+        self.assertEqual(child.parent_span_id, 1)
+        self.assertEqual(self.recorded(), [(child, ['cs', 'cr'])])
+
+    def test_name(self):
+        @traced(name='other')
+        def f():
+            return current_trace()
+
+        self.assertEqual(call_with_trace(self.trace, f).name, 'other')
+        self.assertEqual(f.__name__, 'f')
+
+    def test_nested(self):
+        @traced
+        def inner():
+            return current_trace()
+
+        @traced
+        def outer():
+            return current_trace(), inner()
+
+        (outer_trace, inner_trace) = call_with_trace(self.trace, outer)
+
+        self.assertEqual(inner_trace.parent_span_id, outer_trace.span_id)
+        self.assertEqual(self.recorded(), [(inner_trace, ['cs', 'cr']),
+                                           (outer_trace, ['cs', 'cr'])])
+
+    def test_raises(self):
+        @traced
+        def f():
+            raise ValueError('oops')
+
+        self.assertRaises(ValueError, call_with_trace, self.trace, f)
+
+        [(_, names)] = self.recorded()
+        self.assertEqual(names, ['cs', 'error', 'cr'])
+
+    def test_deferred(self):
+        d = Deferred()
+
+        @traced
+        def f():
+            return d
+
+        self.assertIdentical(call_with_trace(self.trace, f), d)
+        self.assertEqual(self.tracer.record.call_count, 0)
+
+        d.callback('result')
+
+        self.assertEqual(self.successResultOf(d), 'result')
+        [(_, names)] = self.recorded()
+        self.assertEqual(names, ['cs', 'cr'])
+
+    def test_failed_deferred(self):
+        @traced
+        def f():
+            return fail(ValueError('oops'))
+
+        d = call_with_trace(self.trace, f)
+
+        self.failureResultOf(d, ValueError)
+        [(_, names)] = self.recorded()
+        self.assertEqual(names, ['cs', 'error', 'cr'])
@@ -0,0 +1,113 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from twisted.trial.unittest import TestCase
+
+from tryfer import decoders, formatters
+from tryfer.trace import Trace, Annotation, Endpoint
+
+
+class DecoderTests(TestCase):
+    def setUp(self):
+        self.trace = Trace('test', 1, 2, 3, tracers=[])
+        self.endpoint = Endpoint('172.17.1.1', 8080, 'test-service')
+        self.annotations = [
+            Annotation('cs', 1000000, 'timestamp', self.endpoint),
+            Annotation('http.uri', '/', 'string', self.endpoint),
+            Annotation('raw', 'raw', 'bytes')
+        ]
+
+    def assertDecoded(self, decoded):
+        trace, annotations = decoded
+
+        self.assertEqual(
+            (trace.name, trace.trace_id, trace.span_id, trace.parent_span_id),
+            ('test', 1, 2, 3))
+        self.assertEqual(annotations, self.annotations)
+
+    def test_json_decoder(self):
+        data = formatters.json_formatter([(self.trace, self.annotations)])
+        decoded = decoders.json_decoder(data)
+
+        self.assertEqual(len(decoded), 1)
+        self.assertDecoded(decoded[0])
+
+    def test_json_decoder_single_span(self):
+        data = json.dumps(formatters.json_span(self.trace, self.annotations))
+        decoded = decoders.json_decoder(data)
+
+        self.assertEqual(len(decoded), 1)
+        self.assertDecoded(decoded[0])
+
+    def test_json_decoder_root_span(self):
+        data = formatters.json_formatter([(Trace('root', 1, 2, tracers=[]),
+                                           [])])
+        [(trace, annotations)] = decoders.json_decoder(data)
+
+        self.assertEqual(trace.parent_span_id, None)
+        self.assertEqual(annotations, [])
+
+    def test_compact_decoder(self):
+        data = formatters.compact_formatter([(self.trace, self.annotations)])
+        decoded = decoders.compact_decoder(data)
+
+        self.assertEqual(len(decoded), 1)
+        self.assertDecoded(decoded[0])
+
+    def test_compact_round_trip(self):
+        other = Endpoint('127.0.0.1', 80, 'other')
+        traces = [
+            (self.trace, self.annotations),
+            (Trace('root', 1, 3, tracers=[]),
+             [Annotation('sr', 999000, 'timestamp', other),
+              Annotation('ss', 1001000, 'timestamp', other)]),
+            (Trace('empty', 1, 4, 3, tracers=[]), [])]
+
+        decoded = decoders.compact_decoder(
+            formatters.compact_formatter(traces))
+
+        self.assertEqual(decoded, traces)
+        self.assertEqual([t.name for (t, _) in decoded],
+                         ['test', 'root', 'empty'])
+        self.assertEqual(decoded[1][0].parent_span_id, None)
+
+    def test_compact_tables(self):
+        annotations = [Annotation('cs', 1000000 + i, 'timestamp',
+                                  self.endpoint)
+                       for i in xrange(3)]
+        data = json.loads(formatters.compact_formatter(
+            [(self.trace, annotations), (self.trace, annotations)]))
+
+        self.assertEqual(data['strings'], ['cs', 'test-service', 'test'])
+        self.assertEqual(data['endpoints'], [['172.17.1.1', 8080, 1]])
+        self.assertEqual(
+            data['spans'][0],
+            ['0000000000000001', '0000000000000002', '0000000000000003', 2,
+             1000000, [[0, 0, 0], [0, 1, 0], [0, 2, 0]]])
+
+    def test_json_decoder_compact_batch(self):
+        data = formatters.compact_formatter([(self.trace, self.annotations)])
+
+        [decoded] = decoders.json_decoder(data)
+        self.assertDecoded(decoded)
+
+    def test_base64_thrift_decoder(self):
+        data = formatters.base64_thrift_formatter(self.trace, self.annotations)
+
+        self.assertDecoded(decoders.base64_thrift_decoder(data))
+
+    def test_int_to_ipv4(self):
+        for ip in ('127.0.0.1', '172.17.1.1'):
+            self.assertEqual(
+                decoders.int_to_ipv4(formatters.ipv4_to_int(ip)), ip)
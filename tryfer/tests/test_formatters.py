@@ -10,11 +10,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import struct
 
+import mock
+
 from twisted.trial.unittest import TestCase
 
-from tryfer import formatters
+from tryfer import formatters, decoders
+from tryfer.trace import Trace, Annotation
 
 
 class TestFormatters(TestCase):
@@ -36,3 +40,72 @@ class TestFormatters(TestCase):
         # both parsed ips should be packable as signed 32-bit int
         struct.pack('!i', low_ip_as_int)
         struct.pack('!i', high_ip_as_int)
+
+    def test_hex_ids_uses_cached_ids(self):
+        trace = Trace('test', 1, 2, tracers=[])
+        trace.hex_ids
+
+        with mock.patch.object(formatters, 'hex_str') as hex_str:
+            formatted = formatters.json_span(trace, [])
+
+        self.assertEqual(hex_str.call_count, 0)
+        self.assertEqual((formatted['trace_id'], formatted['span_id']),
+                         ('0000000000000001', '0000000000000002'))
+
+    def test_hex_ids_other_traces(self):
+        trace = mock.Mock(['trace_id', 'span_id', 'parent_span_id'])
+        trace.trace_id = 1
+        trace.span_id = 2
+        trace.parent_span_id = None
+
+        self.assertEqual(formatters.hex_ids(trace),
+                         ('0000000000000001', '0000000000000002', None))
+
+    def test_json_formatter_renders_lazy_values(self):
+        render = mock.Mock(return_value='rendered')
+        annotations = [Annotation('lazy', render, 'string'),
+                       Annotation.string('formatted', '{0} {1}', 200, 'OK')]
+
+        self.assertEqual(render.call_count, 0)
+
+        formatted = json.loads(formatters.json_formatter(
+            [(Trace('test', 1, 2, tracers=[]), annotations)]))
+
+        self.assertEqual(
+            [(a['key'], a['value']) for a in formatted[0]['annotations']],
+            [('lazy', 'rendered'), ('formatted', '200 OK')])
+
+    def test_base64_thrift_formatter_renders_lazy_values(self):
+        trace = Trace('test', 1, 2, tracers=[])
+
+        self.assertEqual(
+            formatters.base64_thrift_formatter(
+                trace, [Annotation.string('formatted', '{0} {1}', 200, 'OK')]),
+            formatters.base64_thrift_formatter(
+                trace, [Annotation.string('formatted', '200 OK')]))
+
+    def test_thrift_formatter_is_raw(self):
+        trace = Trace('test', 1, 2, tracers=[])
+        annotations = [Annotation.client_send(1)]
+
+        raw = formatters.thrift_formatter(trace, annotations)
+
+        self.assertEqual(
+            raw.encode('base64').strip(),
+            formatters.base64_thrift_formatter(trace, annotations))
+
+    def test_thrift_spans_formatter(self):
+        traces = [(Trace('test', 1, 2, tracers=[]),
+                   [Annotation.client_send(1)]),
+                  (Trace('test', 1, 3, 2, tracers=[]),
+                   [Annotation.server_recv(2)])]
+
+        raw = formatters.thrift_spans_formatter(traces)
+
+        self.assertEqual(
+            len(raw),
+            5 + sum(len(formatters.thrift_formatter(*trace))
+                    for trace in traces))
+        self.assertEqual(
+            decoders.thrift_spans_decoder(raw),
+            [(trace, annotations) for (trace, annotations) in traces])
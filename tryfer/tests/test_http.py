@@ -20,13 +20,28 @@ from twisted.trial.unittest import TestCase
 
 from twisted.web.resource import Resource, IResource
 from twisted.web.server import Request
+from twisted.web.test.requesthelper import DummyChannel
 from twisted.web.client import Agent
 from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+from twisted.web.client import ResponseDone, ResponseFailed
+from twisted.web.http import PotentialDataLoss
 
-from twisted.internet.defer import succeed
+from twisted.python.failure import Failure
+from twisted.internet.protocol import Protocol
+from twisted.internet.defer import Deferred, succeed, fail
 
+from tryfer.interfaces import ITrace
 from tryfer.trace import Trace, Endpoint
-from tryfer.http import TracingAgent, TracingWrapperResource
+from tryfer.context import call_with_trace, current_trace
+from tryfer.http import (
+    B3_SINGLE,
+    B3_BOTH,
+    TracingAgent,
+    TracingWrapperResource,
+    TracingRequest,
+    TracingSite
+)
 
 
 class TracingAgentTests(TestCase):
@@ -36,18 +51,24 @@ class TracingAgentTests(TestCase):
         self.trace.trace_id = 1
         self.trace.span_id = 2
         self.trace.parent_span_id = 1
+        self.trace.hex_ids = ('0000000000000001', '0000000000000002',
+                              '0000000000000001')
 
         child_trace = self.trace.child.return_value
 
         child_trace.trace_id = 1
         child_trace.span_id = 3
         child_trace.parent_span_id = 2
+        child_trace.hex_ids = ('0000000000000001', '0000000000000003',
+                               '0000000000000002')
 
     @mock.patch('tryfer.http.Trace')
     def test_no_parent(self, mock_trace):
         mock_trace.return_value.trace_id = 1
         mock_trace.return_value.span_id = 2
         mock_trace.return_value.parent_span_id = 3
+        mock_trace.return_value.hex_ids = (
+            '0000000000000001', '0000000000000002', '0000000000000003')
 
         agent = TracingAgent(self.agent)
         agent.request('GET', 'https://google.com')
@@ -62,38 +83,151 @@ class TracingAgentTests(TestCase):
 
         self.trace.child.assert_called_with('GET')
 
-    @mock.patch('tryfer.http.Annotation')
-    def test_uri_annotation(self, mock_annotation):
+    def test_current_trace_is_parent(self):
+        agent = TracingAgent(self.agent)
+
+        call_with_trace(self.trace, agent.request, 'GET', 'https://google.com')
+
+        self.trace.child.assert_called_with('GET')
+
+    def test_explicit_parent_overrides_current_trace(self):
+        other = mock.Mock(Trace)
         agent = TracingAgent(self.agent, self.trace)
 
-        agent.request('GET', 'https://google.com')
+        call_with_trace(other, agent.request, 'GET', 'https://google.com')
 
-        mock_annotation.string.assert_any_call(
-            'http.uri', 'https://google.com')
+        self.trace.child.assert_called_with('GET')
+        self.assertEqual(other.child.call_count, 0)
 
-        self.trace.child.return_value.record.assert_any_call(
-            mock_annotation.string.return_value)
+    def _recorded(self, calls=1):
+        record = self.trace.child.return_value.record
+        self.assertEqual(record.call_count, calls)
 
-    @mock.patch('tryfer.http.Annotation')
-    def test_client_send_annotation(self, mock_annotation):
+        return [(a.name, a.value) for a in record.mock_calls[-1][1]]
+
+    def _response(self, length):
+        response = mock.Mock()
+        response.code = 200
+        response.phrase = 'OK'
+        response.length = length
+        return response
+
+    def test_records_nothing_before_response(self):
+        self.agent.request.return_value = Deferred()
         agent = TracingAgent(self.agent, self.trace)
 
         agent.request('GET', 'https://google.com')
 
-        mock_annotation.client_send.assert_called_with()
-        self.trace.child.return_value.record.assert_any_call(
-            mock_annotation.client_send.return_value)
+        self.assertEqual(self.trace.child.return_value.record.call_count, 0)
 
-    @mock.patch('tryfer.http.Annotation')
-    def test_client_recv_annotation(self, mock_annotation):
-        self.agent.request.return_value = succeed(mock.Mock())
+    @mock.patch('tryfer.trace.time.time')
+    def test_records_single_batch_without_body(self, mock_time):
+        mock_time.return_value = 1
+        response = self._response(0)
+        self.agent.request.return_value = succeed(response)
         agent = TracingAgent(self.agent, self.trace)
 
-        agent.request('GET', 'https://google.com')
+        d = agent.request('GET', 'https://google.com')
+
+        self.assertIdentical(self.successResultOf(d), response)
+        self.assertEqual(
+            self._recorded(),
+            [('http.uri', 'https://google.com'),
+             ('cs', 1000000),
+             ('http.responsecode', '200 OK'),
+             ('cr', 1000000)])
+
+    def _read_body(self, mock_time, reason):
+        mock_time.return_value = 1
+        response = self._response(UNKNOWN_LENGTH)
+        self.agent.request.return_value = succeed(response)
+        agent = TracingAgent(self.agent, self.trace)
+
+        wrapped = self.successResultOf(
+            agent.request('GET', 'https://google.com'))
+
+        protocol = mock.Mock(Protocol)
+        wrapped.deliverBody(protocol)
+
+        body_protocol = response.deliverBody.mock_calls[0][1][0]
+        transport = mock.Mock()
+
+        mock_time.return_value = 2
+        body_protocol.makeConnection(transport)
+        body_protocol.dataReceived('hello ')
+        body_protocol.dataReceived('world')
+        body_protocol.connectionLost(reason)
+
+        protocol.makeConnection.assert_called_once_with(transport)
+        self.assertEqual(
+            protocol.dataReceived.mock_calls,
+            [mock.call('hello '), mock.call('world')])
+        protocol.connectionLost.assert_called_once_with(reason)
+
+    @mock.patch('tryfer.trace.time.time')
+    def test_records_response_before_body(self, mock_time):
+        mock_time.return_value = 1
+        response = self._response(UNKNOWN_LENGTH)
+        self.agent.request.return_value = succeed(response)
+        agent = TracingAgent(self.agent, self.trace)
+
+        wrapped = self.successResultOf(
+            agent.request('GET', 'https://google.com'))
+
+        self.assertEqual(wrapped.code, 200)
+        self.assertEqual(
+            self._recorded(),
+            [('http.uri', 'https://google.com'),
+             ('cs', 1000000),
+             ('http.responsecode', '200 OK'),
+             ('cr', 1000000)])
+
+    @mock.patch('tryfer.trace.time.time')
+    def test_records_body_completion(self, mock_time):
+        self._read_body(mock_time, Failure(ResponseDone()))
+
+        self.assertEqual(
+            self._recorded(calls=2),
+            [('http.response.body', 2000000),
+             ('http.response.size', '11')])
+
+    @mock.patch('tryfer.trace.time.time')
+    def test_records_body_potential_data_loss(self, mock_time):
+        self._read_body(mock_time, Failure(PotentialDataLoss()))
+
+        self.assertEqual(
+            [name for (name, value) in self._recorded(calls=2)],
+            ['http.response.body', 'http.response.size'])
 
-        mock_annotation.client_recv.assert_called_with()
-        self.trace.child.return_value.record.assert_any_call(
-            mock_annotation.client_recv.return_value)
+    @mock.patch('tryfer.trace.time.time')
+    def test_records_body_failure(self, mock_time):
+        self._read_body(mock_time, Failure(ResponseFailed([])))
+
+        self.assertEqual(
+            [name for (name, value) in self._recorded(calls=2)],
+            ['error', 'http.response.failed'])
+
+    def test_wrapped_response_proxies(self):
+        response = self._response(10)
+        self.agent.request.return_value = succeed(response)
+        agent = TracingAgent(self.agent, self.trace)
+
+        wrapped = self.successResultOf(
+            agent.request('GET', 'https://google.com'))
+
+        self.assertEqual(wrapped.code, 200)
+        self.assertEqual(wrapped.headers, response.headers)
+
+    def test_records_on_failure(self):
+        self.agent.request.return_value = fail(ValueError())
+        agent = TracingAgent(self.agent, self.trace)
+
+        d = agent.request('GET', 'https://google.com')
+
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(
+            [name for (name, value) in self._recorded()],
+            ['http.uri', 'cs', 'error', 'cr'])
 
     def test_delgates_to_agent(self):
         agent = TracingAgent(self.agent, self.trace)
@@ -107,8 +241,54 @@ class TracingAgentTests(TestCase):
                      'X-B3-ParentSpanId': ['0000000000000002']}),
             None)
 
+    def test_single_header_propagation(self):
+        agent = TracingAgent(self.agent, self.trace, propagation=B3_SINGLE)
+
+        agent.request('GET', 'https://google.com')
+
+        self.agent.request.assert_called_with(
+            'GET', 'https://google.com',
+            Headers({'b3': ['0000000000000001-0000000000000003-1-'
+                            '0000000000000002']}),
+            None)
+
+    def test_both_propagation(self):
+        agent = TracingAgent(self.agent, self.trace, propagation=B3_BOTH)
+
+        agent.request('GET', 'https://google.com')
+
+        self.agent.request.assert_called_with(
+            'GET', 'https://google.com',
+            Headers({'X-B3-TraceId': ['0000000000000001'],
+                     'X-B3-SpanId': ['0000000000000003'],
+                     'X-B3-ParentSpanId': ['0000000000000002'],
+                     'b3': ['0000000000000001-0000000000000003-1-'
+                            '0000000000000002']}),
+            None)
+
+    @mock.patch('tryfer.http.Trace')
+    def test_single_header_no_parent(self, mock_trace):
+        mock_trace.return_value.hex_ids = (
+            '0000000000000001', '0000000000000002', None)
+
+        agent = TracingAgent(self.agent, propagation=B3_SINGLE)
+
+        agent.request('GET', 'https://google.com')
+
+        self.agent.request.assert_called_with(
+            'GET', 'https://google.com',
+            Headers({'b3': ['0000000000000001-0000000000000002-1']}),
+            None)
+
+    def test_unknown_propagation(self):
+        self.assertRaises(ValueError, TracingAgent, self.agent,
+                          propagation='other')
+
     @mock.patch('tryfer.http.Trace')
     def test_sets_endpoint(self, mock_trace):
+        mock_trace.return_value.hex_ids = (
+            '0000000000000001', '0000000000000002', None)
+
         endpoint = Endpoint('127.0.0.1', 0, 'client')
         agent = TracingAgent(self.agent, endpoint=endpoint)
 
@@ -139,18 +319,54 @@ class TracingWrapperResourceTests(TestCase):
             NotImplementedError, self.resource.render, mock.Mock())
 
     def test_getChildWithDefault_calls_wrapped(self):
-        self.assertEqual(
-            self.resource.getChildWithDefault('foo', self.request),
-            self.wrapped.getChildWithDefault.return_value)
+        child = self.resource.getChildWithDefault('foo', self.request)
 
         self.wrapped.getChildWithDefault.assert_called_with(
             'foo', self.request)
 
+        wrapped_child = self.wrapped.getChildWithDefault.return_value
+
+        self.assertEqual(
+            child.render(self.request),
+            wrapped_child.render.return_value)
+        wrapped_child.render.assert_called_with(self.request)
+
+    def test_child_rendered_with_current_trace(self):
+        traces = []
+
+        child = mock.Mock(Resource)
+        child.render.side_effect = lambda request: traces.append(
+            current_trace())
+        self.wrapped.getChildWithDefault.return_value = child
+
+        self.resource.getChildWithDefault('foo', self.request).render(
+            self.request)
+
+        trace = self.request.setComponent.mock_calls[0][1][1]
+        self.assertEqual(traces, [trace])
+        self.assertEqual(current_trace(), None)
+
+    def test_grandchildren_rendered_with_current_trace(self):
+        traces = []
+
+        grandchild = mock.Mock(Resource)
+        grandchild.render.side_effect = lambda request: traces.append(
+            current_trace())
+        child = self.wrapped.getChildWithDefault.return_value
+        child.getChildWithDefault.return_value = grandchild
+
+        resource = self.resource.getChildWithDefault('foo', self.request)
+        resource.getChildWithDefault('bar', self.request).render(
+            self.request)
+
+        self.request.setComponent.assert_called_with(ITrace, traces[0])
+
     @mock.patch('tryfer.http.Trace')
     def test_constructsTrace(self, mock_trace):
         self.resource.getChildWithDefault('foo', self.request)
 
-        mock_trace.assert_called_with('GET', None, None, None)
+        mock_trace.assert_called_with('GET', None, None, None,
+                                      sampled=True)
 
     @mock.patch('tryfer.http.Annotation')
     @mock.patch('tryfer.http.Trace')
@@ -178,7 +394,8 @@ class TracingWrapperResourceTests(TestCase):
 
         self.resource.getChildWithDefault('foo', self.request)
 
-        mock_trace.assert_called_with('GET', 10, 11, 12)
+        mock_trace.assert_called_with('GET', 10, 11, 12,
+                                      sampled=True)
 
     @mock.patch('tryfer.http.Trace')
     def test_uses_trace_headers_no_parent(self, mock_trace):
@@ -187,7 +404,76 @@ class TracingWrapperResourceTests(TestCase):
 
         self.resource.getChildWithDefault('foo', self.request)
 
-        mock_trace.assert_called_with('GET', 10, 11, None)
+        mock_trace.assert_called_with('GET', 10, 11, None,
+                                      sampled=True)
+
+    @mock.patch('tryfer.http.Trace')
+    def test_uses_single_header(self, mock_trace):
+        self.request.requestHeaders.setRawHeaders('b3', ['a-b-1-c'])
+
+        self.resource.getChildWithDefault('foo', self.request)
+
+        mock_trace.assert_called_with('GET', 10, 11, 12,
+                                      sampled=True)
+
+    @mock.patch('tryfer.http.Trace')
+    def test_single_header_preferred(self, mock_trace):
+        self.request.requestHeaders.setRawHeaders('b3', ['a-b'])
+        self.request.requestHeaders.setRawHeaders('X-B3-TraceId', ['d'])
+        self.request.requestHeaders.setRawHeaders('X-B3-SpanId', ['e'])
+
+        self.resource.getChildWithDefault('foo', self.request)
+
+        mock_trace.assert_called_with('GET', 10, 11, None,
+                                      sampled=True)
+
+    @mock.patch('tryfer.http.Trace')
+    def test_single_header_128_bit_trace_id(self, mock_trace):
+        self.request.requestHeaders.setRawHeaders(
+            'b3', ['463ac35c9f6413ad48485a3953bb6124-b-1'])
+
+        self.resource.getChildWithDefault('foo', self.request)
+
+        mock_trace.assert_called_with('GET', 0x48485a3953bb6124, 11, None,
+                                      sampled=True)
+
+    @mock.patch('tryfer.http.Trace')
+    def test_single_header_unsampled(self, mock_trace):
+        self.request.requestHeaders.setRawHeaders('b3', ['a-b-0-c'])
+
+        self.resource.getChildWithDefault('foo', self.request)
+
+        mock_trace.assert_called_with('GET', 10, 11, 12, sampled=False)
+
+    def test_single_header_unsampled_round_trip(self):
+        agent = mock.Mock(Agent)
+        tracing_agent = TracingAgent(agent, propagation=B3_SINGLE)
+
+        child = mock.Mock(Resource)
+        child.render.side_effect = lambda request: tracing_agent.request(
+            'GET', 'http://backend/')
+        self.wrapped.getChildWithDefault.return_value = child
+
+        self.request.requestHeaders.setRawHeaders(
+            'b3', ['000000000000000a-000000000000000b-0'])
+
+        self.resource.getChildWithDefault('foo', self.request).render(
+            self.request)
+
+        [b3] = agent.request.call_args[0][2].getRawHeaders('b3')
+        (trace_id, span_id, sampled, parent_span_id) = b3.split('-')
+
+        self.assertEqual((trace_id, sampled, parent_span_id),
+                         ('000000000000000a', '0', '000000000000000b'))
+
+    @mock.patch('tryfer.http.Trace')
+    def test_malformed_single_header(self, mock_trace):
+        self.request.requestHeaders.setRawHeaders('b3', ['x-y-1'])
+
+        self.resource.getChildWithDefault('foo', self.request)
+
+        mock_trace.assert_called_with('GET', None, None, None,
+                                      sampled=True)
 
     @mock.patch('tryfer.http.Trace')
     def test_sets_endpoint(self, mock_trace):
@@ -215,3 +501,180 @@ class TracingWrapperResourceTests(TestCase):
         self.assertEqual(endpoint.ipv4, '127.0.0.1')
         self.assertEqual(endpoint.port, 8080)
         self.assertEqual(endpoint.service_name, 'test-http')
+
+
+class _RecordingResource(Resource):
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.traces = []
+
+    def render(self, request):
+        self.traces.append(current_trace())
+        return 'hello'
+
+
+class TracingRequestTests(TestCase):
+    def setUp(self):
+        self.tracer = mock.Mock()
+        self.resource = _RecordingResource()
+        self.site = TracingSite(self.resource, service_name='test-http')
+
+        self.trace_patcher = mock.patch(
+            'tryfer.http.Trace',
+            side_effect=lambda *args, **kwargs: Trace(
+                *args, tracers=[self.tracer], **kwargs))
+        self.trace_patcher.start()
+        self.addCleanup(self.trace_patcher.stop)
+
+    def _process(self, headers=None):
+        channel = DummyChannel()
+        channel.site = self.site
+
+        request = TracingRequest(channel, False)
+        request.gotLength(0)
+
+        for name, value in (headers or {}).items():
+            request.requestHeaders.setRawHeaders(name, [value])
+
+        request.requestReceived('GET', '/', 'HTTP/1.1')
+        return request
+
+    def _recorded_names(self):
+        return [a.name
+                for c in self.tracer.record.mock_calls
+                for (trace, annotations) in c[1][0]
+                for a in annotations]
+
+    def test_site_uses_tracing_request(self):
+        self.assertIdentical(self.site.requestFactory, TracingRequest)
+        self.assertEqual(self.site.service_name, 'test-http')
+
+    def test_default_service_name(self):
+        self.assertEqual(TracingSite(self.resource).service_name, 'http')
+
+    def test_records_server_annotations(self):
+        self._process()
+
+        self.assertEqual(self._recorded_names(),
+                         ['sr', 'http.responsecode', 'ss'])
+
+    def test_records_response_code(self):
+        self._process()
+
+        [code] = [a.value
+                  for c in self.tracer.record.mock_calls
+                  for (trace, annotations) in c[1][0]
+                  for a in annotations if a.name == 'http.responsecode']
+
+        self.assertEqual(code, '200 OK')
+
+    def test_uses_trace_headers(self):
+        request = self._process({'X-B3-TraceId': 'a',
+                                 'X-B3-SpanId': 'b',
+                                 'X-B3-ParentSpanId': 'c'})
+
+        self.assertEqual(
+            (request.trace.trace_id,
+             request.trace.span_id,
+             request.trace.parent_span_id),
+            (10, 11, 12))
+
+    def test_trace_is_component(self):
+        request = self._process()
+
+        self.assertIdentical(ITrace(request), request.trace)
+
+    def test_trace_current_while_rendering(self):
+        request = self._process()
+
+        self.assertEqual(self.resource.traces, [request.trace])
+        self.assertEqual(current_trace(), None)
+
+    def test_sets_endpoint(self):
+        request = self._process()
+
+        self.assertEqual(
+            request.trace._endpoint, Endpoint('10.0.0.1', 80, 'test-http'))
+
+    def test_endpoints_are_cached(self):
+        first = self._process()
+        second = self._process()
+
+        self.assertIdentical(first.trace._endpoint, second.trace._endpoint)
+
+    def test_unsampled_not_traced(self):
+        request = self._process({'X-B3-TraceId': 'a',
+                                 'X-B3-SpanId': 'b',
+                                 'X-B3-Sampled': '0'})
+
+        self.assertEqual(request.trace, None)
+        self.assertEqual(ITrace(request, None), None)
+        self.assertEqual(self.tracer.record.call_count, 0)
+
+    def test_unsampled_trace_current_while_rendering(self):
+        self._process({'X-B3-TraceId': 'a',
+                       'X-B3-SpanId': 'b',
+                       'X-B3-Sampled': '0'})
+
+        [trace] = self.resource.traces
+
+        self.assertFalse(trace.sampled)
+        self.assertEqual((trace.trace_id, trace.span_id), (10, 11))
+        self.assertEqual(current_trace(), None)
+
+    def test_unsampled_propagated_by_agent(self):
+        agent = mock.Mock(Agent)
+        tracing_agent = TracingAgent(agent)
+
+        def render(request):
+            tracing_agent.request('GET', 'http://backend/')
+            return 'hello'
+
+        self.resource.render = render
+
+        self._process({'X-B3-TraceId': 'a',
+                       'X-B3-SpanId': 'b',
+                       'X-B3-Sampled': '0'})
+
+        headers = agent.request.call_args[0][2]
+
+        self.assertEqual(headers.getRawHeaders('X-B3-TraceId'),
+                         ['000000000000000a'])
+        self.assertEqual(headers.getRawHeaders('X-B3-ParentSpanId'),
+                         ['000000000000000b'])
+        self.assertEqual(headers.getRawHeaders('X-B3-Sampled'), ['0'])
+        self.assertEqual(self.tracer.record.call_count, 0)
+
+    def test_uses_single_header(self):
+        request = self._process({'b3': 'a-b-1-c'})
+
+        self.assertEqual(
+            (request.trace.trace_id,
+             request.trace.span_id,
+             request.trace.parent_span_id),
+            (10, 11, 12))
+
+    def test_single_header_unsampled_not_traced(self):
+        for b3 in ['a-b-0', 'a-b-0-c', '0']:
+            request = self._process({'b3': b3})
+            self.assertEqual(request.trace, None)
+
+        self.assertEqual(self.tracer.record.call_count, 0)
+
+    def test_single_header_sampling_only(self):
+        request = self._process({'b3': '1'})
+
+        self.assertNotEqual(request.trace, None)
+        self.assertEqual(request.trace.parent_span_id, None)
+
+    def test_server_send_recorded_once(self):
+        request = self._process()
+        names = self._recorded_names()
+
+        request.finish()
+
+        self.assertEqual(self._recorded_names(), names)
+        self.assertEqual(names.count('ss'), 1)
+        self.flushWarnings()
@@ -0,0 +1,308 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+import mock
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.endpoints import (
+    TCP4ServerEndpoint,
+    TCP4ClientEndpoint
+)
+from twisted.internet.task import Clock, deferLater
+from twisted.internet.error import ConnectionDone
+from twisted.python import usage
+from twisted.web.client import Agent
+from twisted.web.server import Site
+from twisted.web.test.requesthelper import DummyRequest
+
+from scrivener import ScribeClient, ScribeServerService
+from scrivener._thrift.scribe import ttypes as scribe_ttypes
+
+from tryfer import cli
+from tryfer.formatters import json_formatter, base64_thrift_formatter
+from tryfer.loadgen import record_trace_tree, LoadGenerator
+from tryfer.testing import ScribeCollector, RESTkinCollector
+from tryfer.trace import Trace, Annotation
+from tryfer.tracers import (
+    EndAnnotationTracer,
+    RawZipkinTracer,
+    RawRESTkinHTTPTracer
+)
+from tryfer._thrift.zipkinCore import constants
+
+
+def _span(timestamp):
+    return (Trace('test', 1, 2, tracers=[]),
+            [Annotation.timestamp('cs', timestamp)])
+
+
+class RecordTraceTreeTests(TestCase):
+    def setUp(self):
+        self.tracer = mock.Mock()
+
+    def spans(self):
+        collector = mock.Mock()
+        end = EndAnnotationTracer(collector)
+
+        for call in self.tracer.record.call_args_list:
+            end.record(*call[0])
+
+        return [traces[0] for ((traces,), _) in
+                collector.record.call_args_list]
+
+    def test_tree_shape(self):
+        count = record_trace_tree(self.tracer, depth=3, fanout=2,
+                                  _random=random.Random(0),
+                                  _time=lambda: 10)
+
+        self.assertEqual(count, 7)
+        self.assertEqual(self.tracer.record.call_count, 13)
+
+        spans = self.spans()
+        [root] = [t for (t, _) in spans if t.parent_span_id is None]
+        span_ids = set(t.span_id for (t, _) in spans)
+
+        self.assertEqual(len(span_ids), 7)
+        self.assertEqual(set(t.trace_id for (t, _) in spans),
+                         set([root.trace_id]))
+        self.assertTrue(all(t.parent_span_id in span_ids
+                            for (t, _) in spans if t is not root))
+
+    def test_root_ends_now(self):
+        record_trace_tree(self.tracer, depth=2, fanout=1, duration=1,
+                          _random=random.Random(0), _time=lambda: 10)
+
+        timestamps = dict(
+            (a.name, a.value) for (t, annotations) in self.spans()
+            if t.parent_span_id is None for a in annotations)
+
+        self.assertEqual(timestamps[constants.SERVER_RECV], 9000000)
+        self.assertEqual(timestamps[constants.SERVER_SEND], 10000000)
+
+    def test_children_within_parent(self):
+        record_trace_tree(self.tracer, depth=4, fanout=3,
+                          _random=random.Random(0), _time=lambda: 10)
+
+        server = {}
+        client = {}
+
+        for (trace, annotations) in self.spans():
+            names = dict((a.name, a.value) for a in annotations)
+            if constants.SERVER_RECV in names:
+                server[trace.span_id] = (names[constants.SERVER_RECV],
+                                         names[constants.SERVER_SEND])
+            else:
+                client[trace.span_id] = (trace.parent_span_id,
+                                         names[constants.CLIENT_SEND],
+                                         names[constants.CLIENT_RECV])
+
+        for span_id, (parent_id, cs, cr) in client.items():
+            sr, ss = server[span_id]
+            parent_sr, parent_ss = server[parent_id]
+
+            self.assertTrue(parent_sr <= cs <= sr <= ss <= cr <= parent_ss)
+
+
+class LoadGeneratorTests(TestCase):
+    def test_rate(self):
+        clock = Clock()
+        tracer = mock.Mock()
+
+        generator = LoadGenerator(tracer, rate=25, depth=2, fanout=1,
+                                  interval=0.1, _reactor=clock)
+        d = generator.start()
+
+        clock.pump([0.1] * 20)
+        generator.stop()
+
+        self.successResultOf(d)
+        self.assertEqual(generator.traces, 50)
+        self.assertEqual(generator.spans, 100)
+        self.assertAlmostEqual(generator.spans_per_second(), 50.0)
+
+    def test_cpu_time(self):
+        generator = LoadGenerator(mock.Mock(), _reactor=Clock())
+
+        self.assertEqual(generator.cpu_time(), 0.0)
+
+        with mock.patch('tryfer.loadgen._cpu_time', side_effect=[1.0, 1.5]):
+            generator.start()
+            self.assertEqual(generator.cpu_time(), 0.5)
+
+        generator.stop()
+
+
+class ScribeCollectorTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(20)
+
+    def entry(self, message):
+        return scribe_ttypes.LogEntry(category='zipkin', message=message)
+
+    def test_accepts_both_formats(self):
+        collector = ScribeCollector(_reactor=self.clock)
+
+        result = collector.Log([
+            self.entry(base64_thrift_formatter(*_span(10000000))),
+            self.entry(json_formatter([_span(15000000), _span(15000000)]))
+        ])
+
+        self.assertEqual(result, scribe_ttypes.ResultCode.OK)
+        self.assertEqual(collector.stats.accepted, 3)
+        self.assertAlmostEqual(collector.stats.mean_delay(), 20 / 3.0)
+        self.assertEqual(collector.stats.max_delay, 10)
+
+    def test_latency(self):
+        collector = ScribeCollector(latency=2, _reactor=self.clock)
+        d = collector.Log([self.entry(json_formatter([_span(1)]))])
+
+        self.assertNoResult(d)
+        self.clock.advance(2)
+        self.assertEqual(self.successResultOf(d),
+                         scribe_ttypes.ResultCode.OK)
+
+    def test_errors(self):
+        collector = ScribeCollector(error_rate=1, _reactor=self.clock)
+
+        self.assertEqual(
+            collector.Log([self.entry(json_formatter([_span(1)]))]),
+            scribe_ttypes.ResultCode.TRY_LATER)
+        self.assertEqual(collector.stats.errors, 1)
+        self.assertEqual(collector.stats.accepted, 0)
+
+    def test_throttling(self):
+        collector = ScribeCollector(max_rate=2, _reactor=self.clock)
+        message = json_formatter([_span(1)])
+
+        results = [collector.Log([self.entry(message)]) for _ in xrange(3)]
+
+        self.assertEqual(results, [scribe_ttypes.ResultCode.OK] * 2 +
+                         [scribe_ttypes.ResultCode.TRY_LATER])
+
+        self.clock.advance(1)
+        self.assertEqual(collector.Log([self.entry(message)]),
+                         scribe_ttypes.ResultCode.OK)
+
+        self.assertEqual(collector.stats.accepted, 3)
+        self.assertEqual(collector.stats.throttled, 1)
+
+
+class RESTkinCollectorTests(TestCase):
+    def post(self, collector, spans):
+        request = DummyRequest([''])
+        request.method = 'POST'
+        request.content = mock.Mock()
+        request.content.read.return_value = json_formatter(spans)
+
+        result = collector.render(request)
+        return request, result
+
+    def test_accepts(self):
+        collector = RESTkinCollector(_reactor=Clock())
+        request, result = self.post(collector, [_span(1)])
+
+        self.assertEqual(result, '')
+        self.assertEqual(request.responseCode, 202)
+        self.assertEqual(collector.stats.accepted, 1)
+
+    def test_errors_and_throttling(self):
+        collector = RESTkinCollector(error_rate=1, _reactor=Clock())
+        request, _ = self.post(collector, [_span(1)])
+        self.assertEqual(request.responseCode, 500)
+
+        collector = RESTkinCollector(max_rate=1, _reactor=Clock())
+        request, _ = self.post(collector, [_span(1), _span(1)])
+        self.assertEqual(request.responseCode, 503)
+
+    def test_latency(self):
+        clock = Clock()
+        collector = RESTkinCollector(latency=1, _reactor=clock)
+        request, _ = self.post(collector, [_span(1)])
+
+        self.assertEqual(request.finished, 0)
+        clock.advance(1)
+        self.assertEqual(request.finished, 1)
+
+
+class EndToEndTests(TestCase):
+    @inlineCallbacks
+    def test_scribe(self):
+        collector = ScribeCollector()
+        service = ScribeServerService(
+            TCP4ServerEndpoint(reactor, 0, interface='127.0.0.1'), collector)
+        service.startService()
+        self.addCleanup(service.stopService)
+
+        port = service._port.getHost().port
+        client = ScribeClient(TCP4ClientEndpoint(reactor, '127.0.0.1', port))
+        tracer = EndAnnotationTracer(RawZipkinTracer(client))
+
+        count = record_trace_tree(tracer, depth=2, fanout=2)
+
+        while collector.stats.accepted < count * 2 - 1:
+            yield deferLater(reactor, 0.01, lambda: None)
+
+        client._client.transport.loseConnection()
+        yield deferLater(reactor, 0, lambda: None)
+        self.flushLoggedErrors(ConnectionDone)
+
+    @inlineCallbacks
+    def test_http(self):
+        collector = RESTkinCollector()
+        port = reactor.listenTCP(0, Site(collector), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+
+        tracer = RawRESTkinHTTPTracer(
+            Agent(reactor),
+            'http://127.0.0.1:{0}/'.format(port.getHost().port))
+
+        yield tracer.record([_span(1), _span(2)])
+
+        self.assertEqual(collector.stats.accepted, 2)
+
+
+class OptionsTests(TestCase):
+    def parse(self, *argv):
+        options = cli.Options()
+        options.parseOptions(list(argv))
+        return options.subOptions
+
+    def test_loadgen(self):
+        options = self.parse('loadgen', '--zipkin', 'localhost:1463',
+                             '--rate', '50', '--max-idle-time', '2')
+
+        self.assertEqual(options['zipkin'], ('localhost', 1463))
+        self.assertEqual(options['rate'], 50.0)
+        self.assertEqual(options['linger'], 3.0)
+
+    def test_loadgen_requires_one_destination(self):
+        self.assertRaises(usage.UsageError, self.parse, 'loadgen')
+        self.assertRaises(usage.UsageError, self.parse, 'loadgen',
+                          '--zipkin', 'localhost:1463',
+                          '--http', 'http://localhost/')
+
+    def test_collector(self):
+        options = self.parse('collector', '--http-port', '6956',
+                             '--latency', '0.5', '--max-rate', '1000')
+
+        self.assertEqual(options['http-port'], 6956)
+        self.assertEqual(options['scribe-port'], None)
+        self.assertEqual(options['latency'], 0.5)
+        self.assertEqual(options['max-rate'], 1000.0)
+
+    def test_collector_requires_a_port(self):
+        self.assertRaises(usage.UsageError, self.parse, 'collector')
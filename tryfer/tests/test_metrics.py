@@ -0,0 +1,349 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import random
+
+import mock
+
+from zope.interface.verify import verifyObject
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+from twisted.web.test.requesthelper import DummyRequest
+
+from tryfer.interfaces import ITracer
+from tryfer.metrics import (
+    LatencyHistogram,
+    LatencyTracer,
+    log_exporter,
+    REDTracer,
+    red_log_exporter,
+    MetricsResource,
+    response_code,
+    is_error
+)
+from tryfer.trace import Trace, Annotation, Endpoint
+
+
+class LatencyHistogramTests(TestCase):
+    def test_empty(self):
+        histogram = LatencyHistogram()
+
+        self.assertEqual(histogram.percentile(50), None)
+        self.assertEqual(histogram.mean(), None)
+
+    def test_percentiles_within_error(self):
+        rng = random.Random(0)
+        values = sorted(rng.randint(1, 10 ** 7) for _ in xrange(10000))
+
+        histogram = LatencyHistogram(error=0.05)
+        for value in values:
+            histogram.add(value)
+
+        for p in (1, 50, 90, 99, 99.9):
+            exact = values[int(len(values) * p / 100.0) - 1]
+            self.assertTrue(
+                abs(histogram.percentile(p) - exact) <= exact * 0.06,
+                (p, histogram.percentile(p), exact))
+
+        self.assertEqual(histogram.percentile(100), values[-1])
+        self.assertEqual(histogram.percentile(0), values[0])
+
+    def test_fixed_size(self):
+        histogram = LatencyHistogram(max_value=1000)
+        size = len(histogram._counts)
+
+        histogram.add(0)
+        histogram.add(10 ** 12)
+
+        self.assertEqual(len(histogram._counts), size)
+        self.assertEqual(histogram.percentile(100), 10 ** 12)
+        self.assertEqual(histogram.percentile(50), 0)
+
+    def test_merge(self):
+        a = LatencyHistogram()
+        b = LatencyHistogram()
+
+        for value in (10, 20):
+            a.add(value)
+        for value in (30, 4000):
+            b.add(value)
+
+        a.merge(b)
+
+        self.assertEqual((a.count, a.total, a.min, a.max),
+                         (4, 4060, 10, 4000))
+
+    def test_snapshot(self):
+        histogram = LatencyHistogram()
+        histogram.add(100)
+
+        self.assertEqual(
+            histogram.snapshot(percentiles=(50,)),
+            {'count': 1, 'mean': 100.0, 'min': 100, 'max': 100, 'p50': 100})
+
+
+def _annotation(factory, timestamp, service_name='service'):
+    annotation = factory(timestamp)
+    annotation.endpoint = Endpoint('127.0.0.1', 80, service_name)
+    return annotation
+
+
+class LatencyTracerTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.tracer = LatencyTracer(_reactor=self.clock)
+        self.trace = Trace('GET', 1, 2, tracers=[])
+
+    def test_verifyObject(self):
+        verifyObject(ITracer, self.tracer)
+
+    def test_pairs_separately_recorded_annotations(self):
+        self.tracer.record(
+            [(self.trace, [_annotation(Annotation.server_recv, 100)])])
+        self.tracer.record(
+            [(self.trace, [_annotation(Annotation.client_send, 50)])])
+        self.tracer.record(
+            [(self.trace, [_annotation(Annotation.server_send, 400)])])
+        self.tracer.record(
+            [(self.trace, [_annotation(Annotation.client_recv, 500)])])
+
+        self.assertEqual(
+            self.tracer.percentile('service', 'GET', 50, 'server'), 300)
+        self.assertEqual(
+            self.tracer.percentile('service', 'GET', 50, 'client'), 450)
+
+    def test_pairs_within_one_record(self):
+        self.tracer.record([(self.trace, [
+            _annotation(Annotation.client_send, 0),
+            _annotation(Annotation.client_recv, 1000)])])
+
+        self.assertEqual(
+            self.tracer.histogram('service', 'GET', 'client').count, 1)
+        self.assertEqual(
+            self.tracer.histogram('service', 'GET', 'server').count, 0)
+
+    def test_keyed_by_service_and_name(self):
+        for (span_id, name, service_name) in [(2, 'GET', 'a'),
+                                              (3, 'GET', 'b'),
+                                              (4, 'POST', 'a')]:
+            trace = Trace(name, 1, span_id, tracers=[])
+            self.tracer.record([(trace, [
+                _annotation(Annotation.server_recv, 0, service_name),
+                _annotation(Annotation.server_send, span_id, service_name)])])
+
+        self.assertEqual(sorted(self.tracer.snapshot()),
+                         [('a', 'GET', 'server'), ('a', 'POST', 'server'),
+                          ('b', 'GET', 'server')])
+        self.assertEqual(self.tracer.percentile('b', 'GET', 50), 3)
+        self.assertEqual(self.tracer.percentile('c', 'GET', 50), None)
+
+    def test_unmatched_halves_are_bounded(self):
+        self.tracer._pairer._max_pending = 2
+
+        for span_id in xrange(5):
+            trace = Trace('GET', 1, span_id + 1, tracers=[])
+            self.tracer.record(
+                [(trace, [_annotation(Annotation.server_recv, 0)])])
+
+        self.assertEqual(len(self.tracer._pairer._pending), 2)
+
+    def test_max_keys(self):
+        tracer = LatencyTracer(max_keys=1, _reactor=self.clock)
+
+        for name in ('GET', 'POST'):
+            tracer.record([(Trace(name, 1, 2, tracers=[]), [
+                _annotation(Annotation.server_recv, 0),
+                _annotation(Annotation.server_send, 1)])])
+
+        self.assertEqual(tracer.dropped, 1)
+        self.assertEqual(tracer.histogram('service', 'POST'), None)
+
+    def test_periodic_export(self):
+        exporter = mock.Mock()
+        tracer = LatencyTracer(exporter=exporter, export_interval=10,
+                               reset_on_export=True, _reactor=self.clock)
+
+        tracer.record([(self.trace, [
+            _annotation(Annotation.server_recv, 0),
+            _annotation(Annotation.server_send, 100)])])
+
+        self.clock.advance(10)
+
+        [snapshot] = exporter.call_args[0]
+        self.assertEqual(snapshot[('service', 'GET', 'server')]['count'], 1)
+
+        self.clock.advance(10)
+        exporter.assert_called_with({})
+
+        tracer.stop()
+
+    def test_export_errors_are_logged(self):
+        tracer = LatencyTracer(exporter=mock.Mock(side_effect=ValueError),
+                               _reactor=self.clock)
+        tracer.export()
+
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_log_exporter(self):
+        self.tracer.record([(self.trace, [
+            _annotation(Annotation.server_recv, 0),
+            _annotation(Annotation.server_send, 100)])])
+
+        with mock.patch('tryfer.metrics.log') as log:
+            log_exporter(self.tracer.snapshot())
+
+        self.assertEqual(log.msg.call_count, 1)
+        self.assertEqual(log.msg.call_args[1]['p99'], 100)
+
+
+def _code(code):
+    return Annotation.string('http.responsecode', '{0} {1}', code, 'Phrase')
+
+
+class ErrorDetectionTests(TestCase):
+    def test_response_code(self):
+        self.assertEqual(response_code([_code(404)]), 404)
+        self.assertEqual(response_code([]), None)
+        self.assertEqual(
+            response_code([Annotation.string('http.responsecode', '')]),
+            None)
+
+    def test_is_error(self):
+        self.assertFalse(is_error([_code(200)]))
+        self.assertFalse(is_error([_code(404)]))
+        self.assertTrue(is_error([_code(503)]))
+        self.assertTrue(is_error([Annotation.string('error', 'refused')]))
+        self.assertFalse(is_error([]))
+
+
+class REDTracerTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.tracer = REDTracer(window=60, resolution=10, _reactor=self.clock)
+        self.span_id = 0
+
+    def request(self, name='GET', duration=100, code=200, kind='server',
+                tracer=None):
+        self.span_id += 1
+        trace = Trace(name, 1, self.span_id, tracers=[])
+
+        if kind == 'server':
+            start, end = Annotation.server_recv, Annotation.server_send
+        else:
+            start, end = Annotation.client_send, Annotation.client_recv
+
+        (tracer or self.tracer).record(
+            [(trace, [_annotation(start, 0)])])
+        (tracer or self.tracer).record(
+            [(trace, [_code(code), _annotation(end, duration)])])
+
+    def test_verifyObject(self):
+        verifyObject(ITracer, self.tracer)
+
+    def test_rate_errors_and_duration(self):
+        for x in xrange(9):
+            self.request(duration=100)
+        self.request(duration=1000, code=500)
+        self.request(kind='client', code=502)
+
+        metrics = self.tracer.metrics()
+
+        server = metrics[('service', 'GET', 'server')]
+        self.assertEqual(server['count'], 10)
+        self.assertEqual(server['rate'], 10 / 60.0)
+        self.assertEqual(server['errors'], 1)
+        self.assertEqual(server['error_rate'], 0.1)
+        self.assertTrue(90 <= server['duration']['p50'] <= 110)
+        self.assertEqual(server['duration']['max'], 1000)
+
+        client = metrics[('service', 'GET', 'client')]
+        self.assertEqual(client['error_rate'], 1.0)
+
+    def test_window_slides(self):
+        self.request()
+        self.clock.advance(30)
+        self.request()
+        self.request()
+
+        self.assertEqual(
+            self.tracer.metrics()[('service', 'GET', 'server')]['count'], 3)
+
+        self.clock.advance(35)
+        self.assertEqual(
+            self.tracer.metrics()[('service', 'GET', 'server')]['count'], 2)
+
+        self.clock.advance(30)
+        self.assertEqual(self.tracer.metrics(), {})
+
+    def test_reused_buckets_are_reset(self):
+        self.request()
+        self.clock.advance(60)
+        self.request()
+
+        self.assertEqual(
+            self.tracer.metrics()[('service', 'GET', 'server')]['count'], 1)
+
+    def test_custom_is_error(self):
+        tracer = REDTracer(is_error=lambda annotations: True,
+                           _reactor=self.clock)
+        self.request(tracer=tracer)
+
+        self.assertEqual(
+            tracer.metrics()[('service', 'GET', 'server')]['errors'], 1)
+
+    def test_max_keys(self):
+        tracer = REDTracer(max_keys=1, _reactor=self.clock)
+        self.request('GET', tracer=tracer)
+        self.request('POST', tracer=tracer)
+
+        self.assertEqual(tracer.dropped, 1)
+        self.assertEqual(len(tracer.metrics()), 1)
+
+    def test_callback_exporter(self):
+        exporter = mock.Mock()
+        tracer = REDTracer(resolution=10, exporter=exporter,
+                           _reactor=self.clock)
+        self.request(tracer=tracer)
+
+        self.clock.advance(10)
+
+        [metrics] = exporter.call_args[0]
+        self.assertEqual(metrics[('service', 'GET', 'server')]['count'], 1)
+
+        tracer.stop()
+
+    def test_log_exporter(self):
+        self.request()
+
+        with mock.patch('tryfer.metrics.log') as log:
+            red_log_exporter(self.tracer.metrics())
+
+        self.assertEqual(log.msg.call_count, 1)
+        self.assertEqual(log.msg.call_args[1]['rate'], 1 / 60.0)
+
+    def test_resource(self):
+        self.request()
+
+        request = DummyRequest([''])
+        resource = MetricsResource(self.tracer.metrics)
+
+        [operation] = json.loads(resource.render(request))
+
+        self.assertEqual(
+            (operation['service_name'], operation['name'],
+             operation['kind'], operation['count']),
+            ('service', 'GET', 'server', 1))
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-type'),
+            ['application/json'])
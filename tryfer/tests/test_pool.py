@@ -0,0 +1,186 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+from scrivener._thrift.scribe.ttypes import ResultCode
+
+from tryfer.pool import ScribeClientPool
+from tryfer.trace import Trace, Annotation
+from tryfer.tracers import RawZipkinTracer
+
+
+class ScribeClientPoolTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.pending = []
+        self.clients = [mock.Mock(name='client{0}'.format(i))
+                        for i in range(3)]
+
+        self.sent_to = []
+
+        for client in self.clients:
+            client.log.side_effect = self._pending(client)
+
+        self.pool = ScribeClientPool(self.clients, eject_time=10,
+                                     _reactor=self.clock)
+
+    def _pending(self, client):
+        def _log(category, messages):
+            d = Deferred()
+            self.pending.append(d)
+            self.sent_to.append(client)
+            return d
+        return _log
+
+    def _calls(self):
+        return [client.log.call_count for client in self.clients]
+
+    def test_requires_clients(self):
+        self.assertRaises(ValueError, ScribeClientPool, [])
+
+    def test_least_outstanding(self):
+        self.pool.log('zipkin', ['a'])
+        self.pool.log('zipkin', ['b'])
+        self.pool.log('zipkin', ['c'])
+
+        self.assertEqual(self._calls(), [1, 1, 1])
+
+        self.pending[1].callback(ResultCode.OK)
+        self.pool.log('zipkin', ['d'])
+
+        self.assertEqual(self.sent_to[3], self.sent_to[1])
+        self.assertEqual(self.sent_to[3].log.call_count, 2)
+
+    def test_fires_with_result(self):
+        d = self.pool.log('zipkin', ['a'])
+        self.pending[0].callback(ResultCode.OK)
+
+        self.assertEqual(self.successResultOf(d), ResultCode.OK)
+
+    def test_failure_redistributes_and_ejects(self):
+        d = self.pool.log('zipkin', ['a'])
+        first = self.sent_to[0]
+
+        self.pending[0].errback(Exception('connection refused'))
+
+        self.assertNotEqual(self.sent_to[1], first)
+        self.assertNoResult(d)
+
+        self.pending[1].callback(ResultCode.OK)
+        self.assertEqual(self.successResultOf(d), ResultCode.OK)
+
+        for i in range(4):
+            self.pool.log('zipkin', ['b'])
+
+        self.assertEqual(first.log.call_count, 1)
+
+        self.clock.advance(10)
+        self.pool.log('zipkin', ['c'])
+
+        self.assertEqual(first.log.call_count, 2)
+
+    @mock.patch('tryfer.pool.log')
+    def test_logs_ejection(self, mock_log):
+        self.pool.log('zipkin', ['a'])
+        self.pending[0].errback(Exception('connection refused'))
+
+        kwargs = mock_log.msg.mock_calls[0][2]
+
+        self.assertEqual(kwargs['system'], 'ScribeClientPool')
+        self.assertEqual(kwargs['reason'], 'connection refused')
+        self.assertEqual(kwargs['eject_time'], 10)
+        self.assertIdentical(kwargs['client'], self.sent_to[0])
+
+    @mock.patch('tryfer.pool.log')
+    def test_logs_failure_before_retrying(self, mock_log):
+        d = self.pool.log('zipkin', ['a'])
+        error = Exception('connection refused')
+        self.pending[0].errback(error)
+
+        kwargs = mock_log.msg.mock_calls[-1][2]
+
+        self.assertEqual(kwargs['system'], 'ScribeClientPool')
+        self.assertEqual(kwargs['category'], 'zipkin')
+        self.assertEqual(kwargs['reason'], 'connection refused')
+        self.assertIdentical(kwargs['failure'].value, error)
+        self.assertIdentical(kwargs['client'], self.sent_to[1])
+
+        self.pending[1].callback(ResultCode.OK)
+        self.successResultOf(d)
+
+    @mock.patch('tryfer.pool.log')
+    def test_logs_try_later_before_retrying(self, mock_log):
+        self.pool.log('zipkin', ['a'])
+        self.pending[0].callback(ResultCode.TRY_LATER)
+
+        kwargs = mock_log.msg.mock_calls[-1][2]
+
+        self.assertEqual(kwargs['reason'], 'TRY_LATER')
+        self.assertIdentical(kwargs['failure'], None)
+        self.assertIdentical(kwargs['client'], self.sent_to[1])
+
+    def test_try_later_redistributes(self):
+        d = self.pool.log('zipkin', ['a'])
+        self.pending[0].callback(ResultCode.TRY_LATER)
+        self.pending[1].callback(ResultCode.OK)
+
+        self.assertEqual(self.successResultOf(d), ResultCode.OK)
+        self.assertEqual(sum(self._calls()), 2)
+
+    def test_all_fail(self):
+        d = self.pool.log('zipkin', ['a'])
+
+        for i in range(3):
+            self.pending[i].errback(Exception('down {0}'.format(i)))
+
+        self.assertEqual(self._calls(), [1, 1, 1])
+        self.failureResultOf(d).trap(Exception)
+
+    def test_all_try_later(self):
+        d = self.pool.log('zipkin', ['a'])
+
+        for i in range(3):
+            self.pending[i].callback(ResultCode.TRY_LATER)
+
+        self.assertEqual(self.successResultOf(d), ResultCode.TRY_LATER)
+
+    def test_all_ejected_uses_soonest(self):
+        for (i, client) in enumerate(self.clients):
+            self.pool._hosts[i].ejected_until = 5 - i
+
+        self.pool.log('zipkin', ['a'])
+
+        self.assertEqual(self._calls(), [0, 0, 1])
+
+    def test_synchronous_exception(self):
+        self.clients[0].log.side_effect = Exception('boom')
+        self.clients[1].log.side_effect = Exception('boom')
+        self.clients[2].log.side_effect = Exception('boom')
+
+        d = self.pool.log('zipkin', ['a'])
+
+        self.failureResultOf(d).trap(Exception)
+
+    def test_zipkin_tracer(self):
+        tracer = RawZipkinTracer(self.pool)
+        tracer.record([(Trace('test', 1, 2, tracers=[]),
+                        [Annotation.client_send(1)])])
+
+        [client] = self.sent_to
+        self.assertEqual(client.log.call_args[0][0], 'zipkin')
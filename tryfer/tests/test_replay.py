@@ -0,0 +1,256 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from StringIO import StringIO
+
+import mock
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.internet.task import Clock
+from twisted.python import usage
+
+from tryfer import cli
+from tryfer.formatters import (
+    json_formatter,
+    json_span,
+    base64_thrift_formatter
+)
+from tryfer.replay import Replayer, auto_decoder
+from tryfer.trace import Trace, Annotation
+
+
+def _lines(count):
+    return [json.dumps(json_span(Trace('test', 1, i, tracers=[]), []))
+            for i in xrange(count)]
+
+
+class AutoDecoderTests(TestCase):
+    def test_json(self):
+        trace = Trace('test', 1, 2, tracers=[])
+
+        [(decoded, annotations)] = auto_decoder(
+            json_formatter([(trace, [])]))
+
+        self.assertEqual(decoded.span_id, 2)
+
+    def test_base64_thrift(self):
+        trace = Trace('test', 1, 2, tracers=[])
+        annotation = Annotation.string('key', 'value')
+
+        [(decoded, annotations)] = auto_decoder(
+            base64_thrift_formatter(trace, [annotation]).replace('\n', ''))
+
+        self.assertEqual(decoded.span_id, 2)
+        self.assertEqual(annotations, [annotation])
+
+
+class ReplayerTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.tracer = mock.Mock(['record'])
+        self.pending = []
+
+        def _record(traces):
+            d = Deferred()
+            self.pending.append((traces, d))
+            return d
+
+        self.tracer.record.side_effect = _record
+
+    def deliver(self, index=0):
+        traces, d = self.pending.pop(index)
+        d.callback(None)
+        return traces
+
+    def test_batches(self):
+        replayer = Replayer(self.tracer, batch_size=2, _reactor=self.clock)
+        d = replayer.replay(_lines(5))
+
+        self.assertEqual([len(traces) for traces, _ in self.pending],
+                         [2, 2, 1])
+
+        while self.pending:
+            self.deliver()
+
+        self.assertEqual(self.successResultOf(d), replayer)
+        self.assertEqual(replayer.spans, 5)
+        self.assertEqual(replayer.offset, 5)
+
+    def test_concurrency(self):
+        replayer = Replayer(self.tracer, batch_size=1, concurrency=2,
+                            _reactor=self.clock)
+        d = replayer.replay(_lines(4))
+
+        self.assertEqual(len(self.pending), 2)
+        self.assertNoResult(d)
+
+        self.deliver()
+        self.assertEqual(self.tracer.record.call_count, 3)
+
+        while self.pending:
+            self.deliver()
+
+        self.successResultOf(d)
+        self.assertEqual(self.tracer.record.call_count, 4)
+
+    def test_offset_only_counts_contiguous_deliveries(self):
+        replayer = Replayer(self.tracer, batch_size=1, _reactor=self.clock)
+        replayer.replay(_lines(3))
+
+        self.deliver(1)
+        self.assertEqual(replayer.offset, 0)
+
+        self.deliver(0)
+        self.assertEqual(replayer.offset, 2)
+
+    def test_resume_from_offset(self):
+        replayer = Replayer(self.tracer, batch_size=10, _reactor=self.clock)
+        replayer.replay(_lines(5), offset=3)
+
+        traces = self.deliver()
+
+        self.assertEqual([trace.span_id for trace, _ in traces], [3, 4])
+        self.assertEqual(replayer.lines, 5)
+        self.assertEqual(replayer.offset, 5)
+
+    def test_rate(self):
+        self.tracer.record.side_effect = lambda traces: succeed(None)
+
+        replayer = Replayer(self.tracer, batch_size=2, rate=2,
+                            _reactor=self.clock)
+        d = replayer.replay(_lines(6))
+
+        self.assertEqual(self.tracer.record.call_count, 1)
+
+        self.clock.advance(1)
+        self.assertEqual(self.tracer.record.call_count, 2)
+
+        self.clock.advance(1)
+        self.successResultOf(d)
+        self.assertEqual(self.tracer.record.call_count, 3)
+        self.assertEqual(replayer.throughput(), 3.0)
+
+    def test_decode_errors_are_counted(self):
+        self.tracer.record.side_effect = lambda traces: succeed(None)
+
+        replayer = Replayer(self.tracer, _reactor=self.clock)
+        d = replayer.replay(['{not json'] + _lines(1) + [''])
+
+        self.successResultOf(d)
+        self.assertEqual(replayer.errors, 1)
+        self.assertEqual(replayer.spans, 1)
+        self.assertEqual(replayer.lines, 3)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_delivery_errors_are_counted(self):
+        self.tracer.record.side_effect = (
+            lambda traces: fail(RuntimeError('upload failed')))
+
+        replayer = Replayer(self.tracer, _reactor=self.clock)
+        d = replayer.replay(_lines(1))
+
+        self.successResultOf(d)
+        self.assertEqual(replayer.offset, 0)
+        self.assertEqual(replayer.errors, 1)
+        self.assertEqual(replayer.spans, 0)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+    def test_offset_stops_before_failed_batch(self):
+        replayer = Replayer(self.tracer, batch_size=1, _reactor=self.clock)
+        d = replayer.replay(_lines(3))
+
+        self.deliver(0)
+        self.pending.pop(0)[1].errback(RuntimeError('upload failed'))
+        self.deliver(0)
+
+        self.successResultOf(d)
+        self.assertEqual(replayer.offset, 1)
+        self.assertEqual(replayer.spans, 2)
+        self.assertEqual(replayer.errors, 1)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+    def test_uses_send(self):
+        tracer = mock.Mock(['record', 'send'])
+        tracer.send.return_value = succeed(None)
+
+        replayer = Replayer(tracer, _reactor=self.clock)
+        self.successResultOf(replayer.replay(_lines(2)))
+
+        self.assertEqual(tracer.send.call_count, 1)
+        self.assertFalse(tracer.record.called)
+        self.assertEqual(replayer.offset, 2)
+
+
+class ReplayOptionsTests(TestCase):
+    def parse(self, *argv):
+        options = cli.Options()
+        options.parseOptions(list(argv))
+        return options.subOptions
+
+    def test_http(self):
+        options = self.parse('replay', '--http', 'http://localhost/', 'a.log')
+
+        self.assertEqual(options['http'], 'http://localhost/')
+        self.assertEqual(options['files'], ('a.log',))
+        self.assertEqual(options['batch-size'], 100)
+
+    def test_scribe(self):
+        options = self.parse('replay', '--scribe', 'localhost:1463',
+                             '--zipkin', '--rate', '10', '-')
+
+        self.assertEqual(options['scribe'], ('localhost', 1463))
+        self.assertEqual(options['rate'], 10.0)
+        self.assertTrue(options['zipkin'])
+
+    def test_requires_one_destination(self):
+        self.assertRaises(usage.UsageError, self.parse, 'replay', 'a.log')
+        self.assertRaises(usage.UsageError, self.parse, 'replay',
+                          '--http', 'http://localhost/',
+                          '--scribe', 'localhost:1463', 'a.log')
+
+    def test_requires_files(self):
+        self.assertRaises(usage.UsageError, self.parse, 'replay',
+                          '--http', 'http://localhost/')
+
+    def test_unknown_format(self):
+        self.assertRaises(usage.UsageError, self.parse, 'replay',
+                          '--http', 'http://localhost/', '--format', 'xml',
+                          'a.log')
+
+    def test_zipkin_requires_scribe(self):
+        self.assertRaises(usage.UsageError, self.parse, 'replay',
+                          '--http', 'http://localhost/', '--zipkin', 'a.log')
+
+
+class ReplayCommandTests(TestCase):
+    def test_replay_reports_progress(self):
+        clock = Clock()
+        tracer = mock.Mock()
+        tracer.record.return_value = succeed(None)
+        out = StringIO()
+
+        path = self.mktemp()
+        with open(path, 'w') as f:
+            f.write('\n'.join(_lines(3)))
+
+        options = cli.Options()
+        options.parseOptions(['replay', '--http', 'http://localhost/', path])
+
+        with mock.patch('tryfer.cli.build_replay_tracer',
+                        return_value=tracer):
+            d = cli.replay(clock, options.subOptions, out)
+
+        self.successResultOf(d)
+        self.assertIn('3 lines, 3 spans', out.getvalue())
+        self.assertIn('offset 3', out.getvalue())
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import math
+import struct
 
 import mock
 
@@ -51,6 +52,53 @@ class TraceTests(TestCase):
         self.assertEqual(c.parent_span_id, 1)
         self.assertNotEqual(c.span_id, 1)
 
+    def test_Trace_child_shares_tracers(self):
+        tracer = mock.Mock()
+        t = Trace('test_trace', trace_id=1, span_id=1, tracers=[tracer])
+
+        c = t.child('child_test_trace')
+        c.record(Annotation.client_send(timestamp=0))
+
+        self.assertEqual(tracer.record.call_count, 1)
+
+    def test_unsampled_records_nothing(self):
+        tracer = mock.Mock()
+        t = Trace('test_trace', trace_id=1, span_id=1, tracers=[tracer],
+                  sampled=False)
+
+        c = t.child('child_test_trace')
+        t.record(Annotation.client_send(timestamp=0))
+        c.record(Annotation.client_send(timestamp=0))
+
+        self.assertFalse(c.sampled)
+        self.assertEqual(c.trace_id, 1)
+        self.assertEqual(tracer.record.call_count, 0)
+
+    def test_hex_ids(self):
+        t = Trace('test_trace', trace_id=1, span_id=2, parent_span_id=255)
+
+        self.assertEqual(
+            t.hex_ids,
+            ('0000000000000001', '0000000000000002', '00000000000000ff'))
+        self.assertIdentical(t.hex_ids, t.hex_ids)
+
+    def test_hex_ids_no_parent(self):
+        t = Trace('test_trace', trace_id=1, span_id=2)
+
+        self.assertEqual(t.hex_ids[2], None)
+
+    def test_packed_ids(self):
+        t = Trace('test_trace', trace_id=1, span_id=2)
+
+        self.assertEqual(t.packed_ids, struct.pack('!QQQ', 1, 2, 0))
+        self.assertIdentical(t.packed_ids, t.packed_ids)
+
+    def test_packed_ids_negative(self):
+        t = Trace('test_trace', trace_id=-1, span_id=2, parent_span_id=-2)
+
+        self.assertEqual(t.packed_ids,
+                         struct.pack('!qqq', -1, 2, -2))
+
     def test_record_invokes_tracer(self):
         tracer = mock.Mock()
 
@@ -101,6 +149,73 @@ class TraceTests(TestCase):
             "Trace('test_trace', trace_id=1, span_id=1, parent_span_id=1)")
 
 
+class SpanTests(TestCase):
+    def setUp(self):
+        self.tracer = mock.Mock()
+        self.trace = Trace('test_trace', trace_id=1, span_id=1,
+                           tracers=[self.tracer])
+
+        self.time_patcher = mock.patch('tryfer.trace.time.time')
+        self.time = self.time_patcher.start()
+        self.time.side_effect = [1, 2]
+
+    def tearDown(self):
+        self.time_patcher.stop()
+
+    def test_records_child_span(self):
+        with self.trace.span('block') as child:
+            pass
+
+        self.assertEqual(child.name, 'block')
+        self.assertEqual(child.trace_id, 1)
+        self.assertEqual(child.parent_span_id, 1)
+
+        self.tracer.record.assert_called_once_with(
+            [(child, (Annotation.client_send(1000000),
+                      Annotation.client_recv(2000000)))])
+
+    def test_one_clock_read_per_end(self):
+        with self.trace.span('block'):
+            self.assertEqual(self.time.call_count, 1)
+
+        self.assertEqual(self.time.call_count, 2)
+
+    def test_child_inherits_endpoint(self):
+        endpoint = Endpoint('127.0.0.1', 8080, 'test')
+        self.trace.set_endpoint(endpoint)
+
+        with self.trace.span('block'):
+            pass
+
+        [((traces,), _)] = self.tracer.record.call_args_list
+        self.assertEqual(
+            [a.endpoint for a in traces[0][1]], [endpoint, endpoint])
+
+    def test_records_error(self):
+        def _fail():
+            with self.trace.span('block'):
+                raise ValueError('oops')
+
+        self.assertRaises(ValueError, _fail)
+
+        [((traces,), _)] = self.tracer.record.call_args_list
+        self.assertEqual(
+            [(a.name, a.value) for a in traces[0][1]],
+            [('cs', 1000000), ('error', 'oops'), ('cr', 2000000)])
+
+    def test_no_tracers(self):
+        with mock.patch('tryfer.trace.get_tracers', return_value=[]):
+            trace = Trace('test_trace')
+
+        with mock.patch.object(trace, 'child') as child:
+            with trace.span('block') as target:
+                pass
+
+        self.assertIdentical(target, trace)
+        self.assertEqual(child.call_count, 0)
+        self.assertEqual(self.time.call_count, 0)
+
+
 class AnnotationTests(TestCase):
     def setUp(self):
         self.time_patcher = mock.patch('tryfer.trace.time.time')
@@ -143,6 +258,38 @@ class AnnotationTests(TestCase):
         self.assertEqual(a.name, 'sr')
         self.assertEqual(a.annotation_type, 'timestamp')
 
+    def test_string(self):
+        a = Annotation.string('test', 'value')
+        self.assertEqual(a.value, 'value')
+        self.assertEqual(a.name, 'test')
+        self.assertEqual(a.annotation_type, 'string')
+
+    def test_string_format_is_lazy(self):
+        value = mock.Mock()
+        value.__format__ = mock.Mock(return_value='formatted')
+
+        a = Annotation.string('test', '{0}!', value)
+        self.assertEqual(value.__format__.call_count, 0)
+
+        self.assertEqual(a.value, 'formatted!')
+        self.assertEqual(a.value, 'formatted!')
+        self.assertEqual(value.__format__.call_count, 1)
+
+    def test_callable_value_is_lazy(self):
+        render = mock.Mock(return_value='rendered')
+
+        a = Annotation('test', render, 'string')
+        self.assertEqual(render.call_count, 0)
+
+        self.assertEqual(a.value, 'rendered')
+        self.assertEqual(a.value, 'rendered')
+        render.assert_called_once_with()
+
+    def test_lazy_equality(self):
+        self.assertEqual(
+            Annotation.string('foo', '{0}', 'bar'),
+            Annotation('foo', 'bar', 'string'))
+
     def test_equality(self):
         self.assertEqual(
             Annotation('foo', 'bar', 'string'),
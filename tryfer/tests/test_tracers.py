@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import sys
+import threading
 
 from StringIO import StringIO
 
@@ -24,11 +26,21 @@ from zope.interface.verify import verifyObject
 
 from twisted.trial.unittest import TestCase
 
-from twisted.internet.task import Clock
-from twisted.internet.defer import succeed
+from twisted.internet import reactor
+from twisted.internet.task import Clock, deferLater
+from twisted.internet.threads import deferToThread
+from twisted.internet.defer import (
+    Deferred,
+    DeferredList,
+    inlineCallbacks,
+    succeed,
+    fail
+)
 
 from twisted.web.http_headers import Headers
 
+from scrivener._thrift.scribe.ttypes import ResultCode
+
 from tryfer.tracers import get_tracers, set_tracers, push_tracer
 from tryfer.tracers import (
     EndAnnotationTracer,
@@ -36,15 +48,30 @@ from tryfer.tracers import (
     ZipkinTracer,
     RawRESTkinHTTPTracer,
     RESTkinHTTPTracer,
+    RawZipkinHTTPTracer,
+    ZipkinHTTPTracer,
     RawRESTkinScribeTracer,
     RESTkinScribeTracer,
+    RawUDPTracer,
+    UDPTracer,
+    FileTracer,
     DebugTracer,
-    BufferingTracer
+    BufferingTracer,
+    FanOutTracer,
+    ThreadSafeTracer,
+    FlushScheduler,
+    get_flush_scheduler,
+    drain,
+    drain_on_shutdown,
+    DeliveryError
 )
 
+from tryfer import formatters
+from tryfer.decoders import thrift_spans_decoder
 from tryfer.interfaces import ITracer
 
 from tryfer.trace import Trace, Annotation
+from tryfer.testing import UDPSpanReceiver
 
 
 class GlobalTracerTests(TestCase):
@@ -89,6 +116,24 @@ class EndAnnotationTracerTests(TestCase):
 
         self.tracer.record.assert_called_once_with([(t, [cs, ce])])
 
+    def test_delegates_response_body_annotations(self):
+        tracer = EndAnnotationTracer(self.tracer)
+
+        t = Trace('test_body', tracers=[tracer])
+
+        cr = Annotation.client_recv()
+        body = Annotation.timestamp('http.response.body')
+        failed = Annotation.timestamp('http.response.failed')
+
+        t.record(cr)
+        t.record(body)
+        t.record(failed)
+
+        self.assertEqual(self.tracer.record.mock_calls,
+                         [mock.call([(t, [cr])]),
+                          mock.call([(t, [body])]),
+                          mock.call([(t, [failed])])])
+
     def test_non_default_end(self):
         tracer = EndAnnotationTracer(self.tracer, end_annotations=['timeout'])
 
@@ -186,6 +231,32 @@ class RawZipkinTracerTests(TestCase):
              'MAAAAAgoAAQAA\nAAAAAAABCwACAAAAAmNzAAoAAQAAAAAAAAACCwACAAAAAmNy'
              'AA8ACAwAAAAAAA=='])
 
+    def test_send_fails_on_try_later(self):
+        self.scribe.log.return_value = succeed(ResultCode.TRY_LATER)
+        tracer = RawZipkinTracer(self.scribe)
+
+        d = tracer.send([(Trace('test', 1, 2, tracers=[]), [])])
+
+        self.failureResultOf(d, DeliveryError)
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+    def test_send_fails_on_error(self):
+        self.scribe.log.return_value = fail(RuntimeError('refused'))
+        tracer = RawZipkinTracer(self.scribe)
+
+        d = tracer.send([(Trace('test', 1, 2, tracers=[]), [])])
+
+        self.failureResultOf(d, RuntimeError)
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+    def test_record_logs_try_later(self):
+        self.scribe.log.return_value = succeed(ResultCode.TRY_LATER)
+        tracer = RawZipkinTracer(self.scribe)
+
+        tracer.record([(Trace('test', 1, 2, tracers=[]), [])])
+
+        self.assertEqual(len(self.flushLoggedErrors(DeliveryError)), 1)
+
 
 class RawRESTkinScribeTracerTests(TestCase):
     def setUp(self):
@@ -328,6 +399,431 @@ class RawRESTkinHTTPTracerTests(TestCase):
                   {'type': 'timestamp', 'value': 4, 'key': 'cr'}
               ]}])
 
+    def test_send_fails_on_error_status(self):
+        self.agent.request.return_value = succeed(
+            mock.Mock(code=503, phrase='Service Unavailable'))
+
+        d = self.tracer.send([(self.trace, [Annotation.client_send(1)])])
+
+        failure = self.failureResultOf(d, DeliveryError)
+        self.assertIn('503', failure.getErrorMessage())
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+    def test_send_fires_with_response(self):
+        response = mock.Mock(code=202)
+        self.agent.request.return_value = succeed(response)
+
+        d = self.tracer.send([(self.trace, [Annotation.client_send(1)])])
+
+        self.assertIdentical(self.successResultOf(d), response)
+
+
+class RawZipkinHTTPTracerTests(TestCase):
+    def setUp(self):
+        self.agent = mock.Mock()
+
+        self.tracer = RawZipkinHTTPTracer(self.agent, 'http://zipkin/spans')
+
+    def test_verifyObject(self):
+        verifyObject(ITracer, self.tracer)
+
+    def test_posts_thrift_list(self):
+        t1 = Trace('test', 1, 2)
+        t2 = Trace('test2', 3, 4, 2)
+
+        self.tracer.record([(t1, [Annotation.client_send(1)]),
+                            (t2, [Annotation.string('key', 'value')])])
+
+        self.assertEqual(self.agent.request.call_count, 1)
+
+        args = self.agent.request.mock_calls[0][1]
+        self.assertEqual(
+            ('POST', 'http://zipkin/spans',
+             Headers({'Content-Type': ['application/x-thrift']})),
+            args[:3])
+
+        output = StringIO()
+
+        def _check_body(_):
+            [(trace1, annotations1), (trace2, annotations2)] = (
+                thrift_spans_decoder(output.getvalue()))
+
+            self.assertEqual((trace1, trace2), (t1, t2))
+            self.assertEqual(annotations1, [Annotation.client_send(1)])
+            self.assertEqual(annotations2, [Annotation.string('key', 'value')])
+
+        return args[3].startProducing(output).addCallback(_check_body)
+
+
+class _UDPClock(Clock):
+    def __init__(self):
+        Clock.__init__(self)
+        self.listenUDP = mock.Mock(side_effect=self._listenUDP)
+
+    def _listenUDP(self, port, protocol):
+        protocol.makeConnection(self.transport)
+        return mock.Mock()
+
+
+class RawUDPTracerTests(TestCase):
+    def setUp(self):
+        self.reactor = _UDPClock()
+        self.transport = self.reactor.transport = mock.Mock()
+
+        self.tracer = RawUDPTracer(
+            '127.0.0.1', 9410, max_datagram_size=400, _reactor=self.reactor)
+
+    def _sent(self):
+        for c in self.transport.write.mock_calls:
+            self.assertEqual(c[1][1], ('127.0.0.1', 9410))
+
+        return [json.loads(c[1][0]) for c in self.transport.write.mock_calls]
+
+    def test_verifyObject(self):
+        verifyObject(ITracer, self.tracer)
+
+    def test_sends_immediately(self):
+        t = Trace('test', 1, 2, tracers=[self.tracer])
+        t.record(Annotation.client_send(1))
+
+        self.assertEqual(
+            self._sent(),
+            [[{'trace_id': '0000000000000001',
+               'span_id': '0000000000000002',
+               'name': 'test',
+               'annotations': [
+                   {'type': 'timestamp', 'value': 1, 'key': 'cs'}]}]])
+
+    def test_listens_once(self):
+        trace = (Trace('test', 1, 2), [Annotation.client_send(1)])
+
+        self.tracer.record([trace])
+        self.tracer.record([trace])
+
+        self.reactor.listenUDP.assert_called_once_with(
+            0, self.tracer._protocol)
+
+    def test_packs_spans_into_datagrams(self):
+        traces = [(Trace('test', 1, x + 1), [Annotation.client_send(x)])
+                  for x in xrange(10)]
+
+        self.tracer.record(traces)
+
+        datagrams = [c[1][0] for c in self.transport.write.mock_calls]
+
+        self.assertTrue(1 < len(datagrams) < 10)
+        for datagram in datagrams:
+            self.assertTrue(len(datagram) <= 400)
+
+        self.assertEqual(
+            [span['span_id'] for datagram in self._sent()
+             for span in datagram],
+            ['%016x' % (x + 1,) for x in xrange(10)])
+
+    def test_drops_oversized_spans(self):
+        self.tracer.record(
+            [(Trace('test', 1, 2), [Annotation.string('big', 'x' * 400)]),
+             (Trace('test', 1, 3), [Annotation.client_send(1)])])
+
+        self.assertEqual(
+            [[span['span_id'] for span in datagram]
+             for datagram in self._sent()],
+            [['0000000000000003']])
+
+    def test_send_errors_logged(self):
+        self.transport.write.side_effect = ValueError()
+
+        self.tracer.record([(Trace('test', 1, 2), [])])
+
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_close_stops_listening(self):
+        trace = (Trace('test', 1, 2), [Annotation.client_send(1)])
+
+        self.tracer.record([trace])
+        port = self.tracer._port
+
+        self.successResultOf(self.tracer.close())
+        port.stopListening.assert_called_once_with()
+
+        self.tracer.record([trace])
+        self.assertEqual(self.reactor.listenUDP.call_count, 2)
+
+    def test_close_before_record(self):
+        self.successResultOf(self.tracer.close())
+
+    def test_drain_stops_listening(self):
+        self.tracer.record([(Trace('test', 1, 2), [])])
+        port = self.tracer._port
+
+        self.successResultOf(drain(self.tracer))
+        port.stopListening.assert_called_once_with()
+
+
+class UDPDeliveryTests(TestCase):
+    def setUp(self):
+        self.receiver = UDPSpanReceiver()
+        self.port = reactor.listenUDP(0, self.receiver, interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+
+        self.tracer = RawUDPTracer(
+            '127.0.0.1', self.port.getHost().port, max_datagram_size=512)
+        self.addCleanup(self.tracer.close)
+
+    def test_delivers_to_receiver(self):
+        traces = [(Trace('test', 1, x + 1), [Annotation.client_send(x),
+                                             Annotation.client_recv(x + 1)])
+                  for x in xrange(20)]
+
+        self.tracer.record(traces)
+
+        def _check(spans):
+            self.assertEqual(len(spans), 20)
+            self.assertTrue(1 < len(self.receiver.datagrams) < 20)
+
+        return self.receiver.wait_for_spans(20).addCallback(_check)
+
+    @inlineCallbacks
+    def test_close_releases_port(self):
+        self.tracer.record([(Trace('test', 1, 2), [])])
+        port = self.tracer._port
+
+        yield self.tracer.close()
+
+        self.assertFalse(port.connected)
+
+    def test_record_right_after_close(self):
+        trace = (Trace('test', 1, 2), [Annotation.client_send(1)])
+
+        self.tracer.record([trace])
+        self.tracer.close()
+        self.tracer.record([trace])
+
+        return self.receiver.wait_for_spans(2)
+
+
+class FileTracerTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.path = self.mktemp()
+
+    def _tracer(self, **kwargs):
+        tracer = FileTracer(self.path, _reactor=self.clock, **kwargs)
+        self.addCleanup(tracer.close)
+        return tracer
+
+    def _trace(self, span_id=2):
+        return (Trace('test', 1, span_id), [Annotation.client_send(1)])
+
+    def _lines(self, path=None):
+        with open(path or self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_verifyObject(self):
+        verifyObject(ITracer, self._tracer())
+
+    def test_unknown_fsync_policy(self):
+        self.assertRaises(ValueError, FileTracer, self.path, fsync='always')
+
+    def test_writes_one_compact_span_per_line(self):
+        tracer = self._tracer()
+        tracer.record([self._trace(2), self._trace(3)])
+        tracer.flush()
+
+        with open(self.path) as f:
+            data = f.read()
+
+        self.assertEqual(data.count('\n'), 2)
+        self.assertNotIn(' ', data)
+        self.assertEqual(
+            self._lines(),
+            [{'trace_id': '0000000000000001',
+              'span_id': '0000000000000002',
+              'name': 'test',
+              'annotations': [
+                  {'type': 'timestamp', 'value': 1, 'key': 'cs'}]},
+             {'trace_id': '0000000000000001',
+              'span_id': '0000000000000003',
+              'name': 'test',
+              'annotations': [
+                  {'type': 'timestamp', 'value': 1, 'key': 'cs'}]}])
+
+    def test_buffers_until_flush_interval(self):
+        tracer = self._tracer(flush_interval=5)
+        tracer.record([self._trace()])
+
+        self.clock.advance(3)
+        tracer.record([self._trace()])
+        self.assertEqual(self._lines(), [])
+
+        self.clock.advance(2)
+        self.assertEqual(len(self._lines()), 2)
+
+    def test_flushes_on_buffer_size(self):
+        tracer = self._tracer(max_buffer_size=200)
+
+        tracer.record([self._trace()])
+        self.assertEqual(self._lines(), [])
+
+        tracer.record([self._trace()])
+        self.assertEqual(len(self._lines()), 2)
+
+    def test_appends_to_existing_file(self):
+        with open(self.path, 'w') as f:
+            f.write('{}\n')
+
+        tracer = self._tracer()
+        tracer.record([self._trace()])
+        tracer.flush()
+
+        self.assertEqual(len(self._lines()), 2)
+
+    def _rotated(self):
+        directory, name = os.path.split(os.path.abspath(self.path))
+        return sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                      if f.startswith(name + '.'))
+
+    def test_rotates_by_size(self):
+        tracer = self._tracer(max_file_size=200)
+
+        tracer.record([self._trace(2)])
+        tracer.flush()
+        tracer.record([self._trace(3)])
+        tracer.flush()
+
+        rotated = self._rotated()
+        self.assertEqual(len(rotated), 1)
+        self.assertEqual(
+            [span['span_id'] for span in self._lines(rotated[0])],
+            ['0000000000000002'])
+        self.assertEqual(
+            [span['span_id'] for span in self._lines()],
+            ['0000000000000003'])
+
+    def test_rename_fails(self):
+        tracer = self._tracer(max_file_size=200)
+
+        tracer.record([self._trace(2)])
+        tracer.flush()
+
+        with mock.patch('tryfer.tracers.os.rename',
+                        side_effect=OSError('read-only')):
+            tracer.record([self._trace(3)])
+            tracer.flush()
+
+        self.assertEqual(len(self.flushLoggedErrors(OSError)), 1)
+
+        self.assertEqual(self._rotated(), [])
+        self.assertEqual(
+            [span['span_id'] for span in self._lines()],
+            ['0000000000000002', '0000000000000003'])
+
+        tracer.record([self._trace(4)])
+        tracer.flush()
+
+        [rotated] = self._rotated()
+        self.assertEqual(
+            [span['span_id'] for span in self._lines(rotated)],
+            ['0000000000000002', '0000000000000003'])
+        self.assertEqual(
+            [span['span_id'] for span in self._lines()],
+            ['0000000000000004'])
+
+    def test_reopen_fails(self):
+        tracer = self._tracer(max_file_size=200)
+
+        tracer.record([self._trace(2)])
+        tracer.flush()
+
+        with mock.patch('tryfer.tracers.open', create=True,
+                        side_effect=IOError('no space')):
+            tracer.record([self._trace(3)])
+            tracer.flush()
+
+        self.assertEqual(len(self.flushLoggedErrors(IOError)), 1)
+
+        tracer.record([self._trace(4)])
+        tracer.flush()
+
+        self.assertEqual(
+            [span['span_id'] for span in self._lines()],
+            ['0000000000000004'])
+
+    def test_close_after_reopen_fails(self):
+        tracer = self._tracer(max_file_size=200, fsync='rotate')
+
+        tracer.record([self._trace(2)])
+        tracer.flush()
+
+        with mock.patch('tryfer.tracers.open', create=True,
+                        side_effect=IOError('no space')):
+            tracer.record([self._trace(3)])
+            tracer.flush()
+            tracer.record([self._trace(4)])
+            tracer.close()
+
+        self.assertEqual(len(self.flushLoggedErrors(IOError)), 2)
+
+    def test_rotates_by_age(self):
+        tracer = self._tracer(max_file_age=60)
+
+        tracer.record([self._trace(2)])
+        tracer.flush()
+
+        self.clock.advance(30)
+        tracer.record([self._trace(3)])
+        tracer.flush()
+        self.assertEqual(self._rotated(), [])
+
+        self.clock.advance(30)
+        tracer.record([self._trace(4)])
+        tracer.flush()
+
+        rotated = self._rotated()
+        self.assertEqual(len(rotated), 1)
+        self.assertEqual(len(self._lines(rotated[0])), 2)
+        self.assertEqual(len(self._lines()), 1)
+
+    def test_rotated_names_unique(self):
+        tracer = self._tracer(max_file_size=1)
+
+        for x in xrange(3):
+            tracer.record([self._trace()])
+            tracer.flush()
+
+        self.assertEqual(len(self._rotated()), 2)
+
+    @mock.patch('tryfer.tracers.os.fsync')
+    def test_fsync_on_flush(self, mock_fsync):
+        tracer = self._tracer(fsync='flush')
+        tracer.record([self._trace()])
+        tracer.flush()
+
+        self.assertEqual(mock_fsync.call_count, 1)
+
+    @mock.patch('tryfer.tracers.os.fsync')
+    def test_fsync_on_rotate(self, mock_fsync):
+        tracer = self._tracer(fsync='rotate', max_file_size=1)
+        tracer.record([self._trace()])
+        tracer.flush()
+
+        self.assertEqual(mock_fsync.call_count, 0)
+
+        tracer.record([self._trace()])
+        tracer.flush()
+
+        self.assertEqual(mock_fsync.call_count, 1)
+
+    @mock.patch('tryfer.tracers.os.fsync')
+    def test_no_fsync_by_default(self, mock_fsync):
+        tracer = self._tracer(max_file_size=1)
+
+        for x in xrange(2):
+            tracer.record([self._trace()])
+            tracer.flush()
+
+        self.assertEqual(mock_fsync.call_count, 0)
+
 
 class DebugTracerTests(TestCase):
     def setUp(self):
@@ -354,6 +850,175 @@ class DebugTracerTests(TestCase):
                   {'type': 'timestamp', 'value': 1, 'key': 'cs'}]}])
 
 
+class _BlockingDestination(object):
+    def __init__(self):
+        self.written = []
+        self.unblocked = threading.Event()
+
+    def write(self, data):
+        self.unblocked.wait()
+        self.written.append(data)
+
+    def flush(self):
+        pass
+
+
+class BackgroundDebugTracerTests(TestCase):
+    def setUp(self):
+        self.destination = _BlockingDestination()
+
+    def _tracer(self, **kwargs):
+        tracer = DebugTracer(self.destination, background=True, **kwargs)
+        self.addCleanup(tracer.stop)
+        self.addCleanup(self.destination.unblocked.set)
+        return tracer
+
+    def test_unknown_overflow_policy(self):
+        self.assertRaises(
+            ValueError, DebugTracer, background=True, overflow='explode')
+
+    def test_writes_in_background(self):
+        tracer = self._tracer()
+        t = Trace('test', 1, 2, tracers=[tracer])
+
+        t.record(Annotation.client_send(1))
+        self.assertEqual(self.destination.written, [])
+
+        self.destination.unblocked.set()
+        tracer.stop()
+
+        self.assertEqual(
+            json.loads(''.join(self.destination.written)),
+            [{'trace_id': '0000000000000001',
+              'span_id': '0000000000000002',
+              'name': 'test',
+              'annotations': [
+                  {'type': 'timestamp', 'value': 1, 'key': 'cs'}]}])
+
+    def test_drops_on_overflow(self):
+        tracer = self._tracer(max_pending=2)
+        trace = (Trace('test', 1, 2), [Annotation.client_send(1)])
+
+        for x in xrange(10):
+            tracer.record([trace])
+
+        # One batch may have been taken by the writer thread already.
+        self.assertIn(tracer._writer.dropped, (7, 8))
+
+        self.destination.unblocked.set()
+        tracer.stop()
+
+        self.assertEqual(
+            len(self.destination.written), 10 - tracer._writer.dropped)
+
+    def test_blocks_on_overflow(self):
+        tracer = self._tracer(max_pending=1, overflow='block')
+        trace = (Trace('test', 1, 2), [Annotation.client_send(1)])
+
+        self.destination.unblocked.set()
+
+        for x in xrange(10):
+            tracer.record([trace])
+
+        tracer.stop()
+
+        self.assertEqual(len(self.destination.written), 10)
+        self.assertEqual(tracer._writer.dropped, 0)
+
+    def _wait_for_writer(self, writer):
+        for x in xrange(200):
+            if not writer._queue.unfinished_tasks:
+                return
+            threading.Event().wait(0.01)
+
+    def test_drain_waits_for_writer(self):
+        clock = Clock()
+        tracer = self._tracer(_reactor=clock)
+        tracer.record([(Trace('test', 1, 2), [Annotation.client_send(1)])])
+
+        d = drain(tracer)
+        clock.advance(1)
+        self.assertNoResult(d)
+
+        self.destination.unblocked.set()
+        self._wait_for_writer(tracer._writer)
+        clock.advance(0.01)
+
+        self.successResultOf(d)
+        self.assertEqual(len(self.destination.written), 1)
+
+    def test_drain_is_bounded(self):
+        clock = Clock()
+        tracer = self._tracer(_reactor=clock)
+        tracer.record([(Trace('test', 1, 2), [Annotation.client_send(1)])])
+
+        d = tracer.drain(timeout=2)
+        clock.advance(1)
+        self.assertNoResult(d)
+
+        clock.advance(1)
+        self.successResultOf(d)
+
+    def test_drain_in_foreground(self):
+        tracer = DebugTracer(StringIO())
+
+        self.successResultOf(tracer.drain())
+
+    def test_stop_with_stuck_destination_and_full_queue(self):
+        tracer = self._tracer(max_pending=1)
+        trace = (Trace('test', 1, 2), [Annotation.client_send(1)])
+
+        for x in xrange(3):
+            tracer.record([trace])
+
+        self.assertTrue(tracer._writer._queue.full())
+
+        stopping = threading.Thread(target=tracer.stop, args=(0.1,))
+        stopping.daemon = True
+        stopping.start()
+        stopping.join(2)
+
+        self.assertFalse(stopping.is_alive())
+
+    def test_stop_after_full_queue_writes_everything(self):
+        tracer = self._tracer(max_pending=1)
+        trace = (Trace('test', 1, 2), [Annotation.client_send(1)])
+
+        for x in xrange(3):
+            tracer.record([trace])
+
+        thread = tracer._writer._thread
+        tracer.stop(0)
+
+        self.destination.unblocked.set()
+        thread.join(2)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(
+            len(self.destination.written), 3 - tracer._writer.dropped)
+
+    def test_no_second_writer_while_stuck(self):
+        tracer = self._tracer()
+        trace = (Trace('test', 1, 2), [Annotation.client_send(1)])
+
+        tracer.record([trace])
+        thread = tracer._writer._thread
+        tracer.stop(0)
+
+        tracer.record([trace])
+
+        self.assertIdentical(tracer._writer._thread, thread)
+        self.assertEqual(tracer._writer.dropped, 1)
+
+        self.destination.unblocked.set()
+        thread.join(2)
+
+        tracer.record([trace])
+        tracer.stop()
+
+        self.assertEqual(len(self.destination.written), 2)
+
+
 class BufferingTracerTests(TestCase):
     def setUp(self):
         self.mock_tracer = mock.Mock()
@@ -429,6 +1094,28 @@ class BufferingTracerTests(TestCase):
         tracer = BufferingTracer(mock.Mock())
         tracer.record([(mock.Mock(), [mock.Mock()])])
         self.assertEqual(mock_reactor.callLater.call_count, 1)
+        self.assertIdentical(
+            tracer._scheduler, get_flush_scheduler(mock_reactor))
+
+    def test_records_do_not_touch_reactor(self):
+        trace = (mock.Mock(), [mock.Mock()])
+
+        self.tracer.record([trace])
+        calls = self.clock.getDelayedCalls()
+
+        self.tracer.record([trace])
+        self.tracer.record([trace])
+
+        self.assertEqual(self.clock.getDelayedCalls(), calls)
+
+    def test_shares_flush_scheduler(self):
+        other = BufferingTracer(mock.Mock(), _reactor=self.clock)
+
+        self.tracer.record([(mock.Mock(), [mock.Mock()])])
+        other.record([(mock.Mock(), [mock.Mock()])])
+
+        self.assertIdentical(self.tracer._scheduler, other._scheduler)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
 
     def test_timer_reset_after_flush(self):
         trace = (mock.Mock(), [mock.Mock()])
@@ -452,12 +1139,131 @@ class BufferingTracerTests(TestCase):
             [trace for x in xrange(8)])
 
 
+class FlushSchedulerTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.scheduler = FlushScheduler(_reactor=self.clock)
+
+    def test_calls_after_delay(self):
+        f = mock.Mock()
+
+        self.scheduler.schedule(f, 5)
+        self.clock.advance(4)
+        self.assertEqual(f.call_count, 0)
+
+        self.clock.advance(1)
+        f.assert_called_once_with()
+
+    def test_reschedule_replaces_deadline(self):
+        f = mock.Mock()
+
+        self.scheduler.schedule(f, 5)
+        self.clock.advance(3)
+        self.scheduler.schedule(f, 5)
+        self.clock.advance(3)
+
+        self.assertEqual(f.call_count, 0)
+
+        self.clock.advance(2)
+        f.assert_called_once_with()
+
+    def test_cancel(self):
+        f = mock.Mock()
+
+        self.scheduler.schedule(f, 5)
+        self.scheduler.cancel(f)
+        self.clock.advance(10)
+
+        self.assertEqual(f.call_count, 0)
+
+    def test_flush_cancels_another_due_flush(self):
+        calls = []
+
+        def first():
+            calls.append(first)
+            self.scheduler.cancel(second)
+
+        def second():
+            calls.append(second)
+            self.scheduler.cancel(first)
+
+        third = mock.Mock()
+        later = mock.Mock()
+
+        self.scheduler.schedule(first, 1)
+        self.scheduler.schedule(second, 1)
+        self.scheduler.schedule(third, 1)
+        self.scheduler.schedule(later, 5)
+
+        self.clock.advance(1)
+
+        self.assertEqual(len(calls), 1)
+        third.assert_called_once_with()
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+        self.clock.advance(4)
+        later.assert_called_once_with()
+
+    def test_flush_schedules_another_flush(self):
+        inner = mock.Mock()
+
+        def outer():
+            self.scheduler.cancel(outer)
+            self.scheduler.schedule(inner, 1)
+
+        self.scheduler.schedule(outer, 1)
+        self.clock.advance(1)
+
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(1)
+
+        inner.assert_called_once_with()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+    def test_single_timer_for_many_functions(self):
+        for x in xrange(10):
+            self.scheduler.schedule(mock.Mock(), x + 1)
+
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_stops_when_idle(self):
+        self.scheduler.schedule(mock.Mock(), 1)
+        self.clock.advance(1)
+
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        f = mock.Mock()
+        self.scheduler.schedule(f, 1)
+        self.clock.advance(1)
+
+        f.assert_called_once_with()
+
+    def test_errors_do_not_stop_other_functions(self):
+        f = mock.Mock(side_effect=ValueError())
+        g = mock.Mock()
+
+        self.scheduler.schedule(f, 1)
+        self.scheduler.schedule(g, 1)
+        self.clock.advance(1)
+
+        g.assert_called_once_with()
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+
 class _StandardTracerTestMixin(object):
     clock = Clock()
 
     def test_verifyObject(self):
         verifyObject(ITracer, self.tracer)
 
+    def test_record_returns_result(self):
+        with mock.patch.object(self.tracer._tracer, 'record') as record:
+            result = self.tracer.record([])
+
+        self.assertIdentical(result, record.return_value)
+
     def test_no_unfinished_traces(self):
         unfinished_trace = (Trace('unfinished'), [Annotation.client_send(1)])
         self.tracer.record([unfinished_trace])
@@ -494,7 +1300,7 @@ class _StandardTracerTestMixin(object):
 class RESTkinScribeTracerTests(TestCase, _StandardTracerTestMixin):
     def setUp(self):
         self.scribe = mock.Mock()
-        self.scribe.log.return_value = succeed(True)
+        self.scribe.log.return_value = succeed(ResultCode.OK)
         self.tracer = RESTkinScribeTracer(self.scribe, _reactor=self.clock)
         self.record_function = self.scribe.log
 
@@ -502,16 +1308,365 @@ class RESTkinScribeTracerTests(TestCase, _StandardTracerTestMixin):
 class RESTkinHTTPTracerTests(TestCase, _StandardTracerTestMixin):
     def setUp(self):
         self.agent = mock.Mock()
-        self.agent.request.return_value = succeed(mock.Mock())
+        self.agent.request.return_value = succeed(mock.Mock(code=200))
         self.record_function = self.agent.request
 
         self.tracer = RESTkinHTTPTracer(
             self.agent, 'http://trace.io/', _reactor=self.clock)
 
 
+class ZipkinHTTPTracerTests(TestCase, _StandardTracerTestMixin):
+    def setUp(self):
+        self.agent = mock.Mock()
+        self.agent.request.return_value = succeed(mock.Mock(code=200))
+        self.record_function = self.agent.request
+
+        self.tracer = ZipkinHTTPTracer(
+            self.agent, 'http://zipkin/spans', _reactor=self.clock)
+
+
+class UDPTracerTests(TestCase, _StandardTracerTestMixin):
+    clock = _UDPClock()
+
+    def setUp(self):
+        self.clock.transport = mock.Mock()
+        self.record_function = self.clock.transport.write
+
+        # Large enough for a full buffer to be sent as a single datagram.
+        self.tracer = UDPTracer('127.0.0.1', 9410, max_datagram_size=65507,
+                                _reactor=self.clock)
+
+
 class ZipkinTracerTests(TestCase, _StandardTracerTestMixin):
     def setUp(self):
         self.scribe = mock.Mock()
-        self.scribe.log.return_value = succeed(True)
+        self.scribe.log.return_value = succeed(ResultCode.OK)
         self.tracer = ZipkinTracer(self.scribe, _reactor=self.clock)
         self.record_function = self.scribe.log
+
+
+class FanOutTracerMixinTests(TestCase, _StandardTracerTestMixin):
+    def setUp(self):
+        self.scribe = mock.Mock()
+        self.scribe.log.return_value = succeed(ResultCode.OK)
+        self.tracer = FanOutTracer([RawZipkinTracer(self.scribe)],
+                                   _reactor=self.clock)
+        self.record_function = self.scribe.log
+
+
+class FanOutTracerTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.scribe = mock.Mock()
+        self.scribe.log.return_value = succeed(ResultCode.OK)
+        self.agent = mock.Mock()
+        self.agent.request.return_value = succeed(mock.Mock(code=200))
+
+        self.completed_trace = (Trace('completed', 1, 2),
+                                [Annotation.client_send(1),
+                                 Annotation.client_recv(2)])
+
+    def test_verifyObject(self):
+        verifyObject(ITracer, FanOutTracer([], _reactor=self.clock))
+
+    def test_serializes_each_format_once(self):
+        tracer = FanOutTracer(
+            [RawRESTkinHTTPTracer(self.agent, 'http://trace.io/'),
+             RawRESTkinScribeTracer(self.scribe),
+             RawZipkinTracer(self.scribe)],
+            max_idle_time=0, _reactor=self.clock)
+
+        with mock.patch('tryfer.formatters.json_span',
+                        wraps=formatters.json_span) as json_span:
+            tracer.record([self.completed_trace])
+            self.clock.advance(0)
+
+        self.assertEqual(json_span.call_count, 1)
+        self.assertEqual(self.agent.request.call_count, 1)
+
+        self.assertEqual(
+            [c[0] for c in self.scribe.log.call_args_list],
+            [('restkin', [formatters.json_formatter([self.completed_trace])]),
+             ('zipkin',
+              RawZipkinTracer.formatter([self.completed_trace]))])
+
+    def test_shares_encoded_payload(self):
+        first = mock.Mock(spec=['formatter', 'deliver'])
+        second = mock.Mock(spec=['formatter', 'deliver'])
+        first.formatter = second.formatter = mock.Mock(return_value='data')
+
+        tracer = FanOutTracer([first, second], max_idle_time=0,
+                              _reactor=self.clock)
+        tracer.record([self.completed_trace])
+        self.clock.advance(0)
+
+        first.formatter.assert_called_once_with([self.completed_trace])
+        first.deliver.assert_called_once_with('data')
+        second.deliver.assert_called_once_with('data')
+
+    def test_records_to_plain_tracers(self):
+        plain = mock.Mock(spec=['record'])
+
+        tracer = FanOutTracer([plain], max_idle_time=0, _reactor=self.clock)
+        tracer.record([self.completed_trace])
+        self.clock.advance(0)
+
+        plain.record.assert_called_once_with([self.completed_trace])
+
+    def test_slow_sink_does_not_stall_others(self):
+        slow = mock.Mock(spec=['record'])
+        slow.record.return_value = Deferred()
+        fast = mock.Mock(spec=['record'])
+
+        tracer = FanOutTracer([slow, fast], max_idle_time=0, max_pending=2,
+                              _reactor=self.clock)
+
+        for x in xrange(4):
+            tracer.record([self.completed_trace])
+            self.clock.advance(0)
+
+        self.assertEqual(slow.record.call_count, 1)
+        self.assertEqual(fast.record.call_count, 4)
+        self.assertEqual(tracer.dropped(), [1, 0])
+
+    def test_slow_sink_catches_up(self):
+        pending = []
+
+        def _record(traces):
+            d = Deferred()
+            pending.append(d)
+            return d
+
+        slow = mock.Mock(spec=['record'])
+        slow.record.side_effect = _record
+
+        tracer = FanOutTracer([slow], max_idle_time=0, _reactor=self.clock)
+
+        for x in xrange(3):
+            tracer.record([self.completed_trace])
+            self.clock.advance(0)
+
+        self.assertEqual(slow.record.call_count, 1)
+
+        pending[0].callback(None)
+        self.assertEqual(slow.record.call_count, 2)
+
+        pending[1].errback(RuntimeError('failed'))
+        self.assertEqual(slow.record.call_count, 3)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+
+class DrainTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.scribe = mock.Mock()
+        self.pending = []
+
+        def _log(category, messages):
+            d = Deferred()
+            self.pending.append(d)
+            return d
+
+        self.scribe.log.side_effect = _log
+
+        self.unfinished = (Trace('unfinished', 1, 2),
+                           [Annotation.client_send(1)])
+        self.completed = (Trace('completed', 1, 3),
+                          [Annotation.client_send(1),
+                           Annotation.client_recv(2)])
+
+    def test_drain_without_drain_method(self):
+        self.successResultOf(drain(mock.Mock(spec=['record'])))
+
+    def test_end_annotation_tracer_sends_unfinished(self):
+        inner = mock.Mock(spec=['record'])
+        tracer = EndAnnotationTracer(inner)
+
+        tracer.record([self.unfinished])
+        self.successResultOf(drain(tracer))
+
+        inner.record.assert_called_once_with([self.unfinished])
+        self.assertEqual(tracer._traces, {})
+
+        drain(tracer)
+        self.assertEqual(inner.record.call_count, 1)
+
+    def test_buffering_tracer_waits_for_deliveries(self):
+        tracer = ZipkinTracer(self.scribe, _reactor=self.clock)
+
+        tracer.record([self.completed, self.unfinished])
+        self.assertEqual(self.scribe.log.call_count, 0)
+
+        d = drain(tracer)
+
+        self.assertEqual(self.scribe.log.call_count, 1)
+        self.assertEqual(len(self.scribe.log.call_args[0][1]), 2)
+        self.assertNoResult(d)
+
+        self.pending[0].callback(ResultCode.OK)
+        self.successResultOf(d)
+
+    def test_failed_deliveries_still_drain(self):
+        tracer = BufferingTracer(RawRESTkinScribeTracer(self.scribe),
+                                 _reactor=self.clock)
+        tracer.record([self.completed])
+
+        d = drain(tracer)
+        self.pending[0].errback(RuntimeError('collector down'))
+
+        self.successResultOf(d)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+    def test_fan_out_tracer_waits_for_sinks(self):
+        tracer = FanOutTracer([RawZipkinTracer(self.scribe),
+                               RawRESTkinScribeTracer(self.scribe)],
+                              _reactor=self.clock)
+
+        tracer.record([self.completed])
+        d = drain(tracer)
+
+        self.assertEqual(self.scribe.log.call_count, 2)
+        self.pending[0].callback(ResultCode.OK)
+        self.assertNoResult(d)
+
+        self.pending[1].callback(ResultCode.OK)
+        self.successResultOf(d)
+
+    def test_file_tracer_flushes(self):
+        path = self.mktemp()
+        tracer = FileTracer(path, _reactor=self.clock)
+        self.addCleanup(tracer.close)
+
+        tracer.record([self.completed])
+        self.successResultOf(drain(tracer))
+
+        with open(path) as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+    def test_drain_on_shutdown(self):
+        _reactor = mock.Mock()
+        _reactor.callLater = self.clock.callLater
+
+        tracer = ZipkinTracer(self.scribe, _reactor=self.clock)
+        tracer.record([self.completed])
+
+        drain_on_shutdown([tracer], timeout=5, _reactor=_reactor)
+
+        (phase, event, f), _ = _reactor.addSystemEventTrigger.call_args
+        self.assertEqual((phase, event), ('before', 'shutdown'))
+
+        d = f()
+        self.assertNoResult(d)
+
+        self.pending[0].callback(ResultCode.OK)
+        self.successResultOf(d)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_drain_on_shutdown_is_bounded(self):
+        _reactor = mock.Mock()
+        _reactor.callLater = self.clock.callLater
+
+        tracer = ZipkinTracer(self.scribe, _reactor=self.clock)
+        tracer.record([self.completed])
+
+        drain_on_shutdown([tracer], timeout=5, _reactor=_reactor)
+        d = _reactor.addSystemEventTrigger.call_args[0][2]()
+
+        self.clock.advance(4)
+        self.assertNoResult(d)
+
+        self.clock.advance(1)
+        self.successResultOf(d)
+
+    def test_drain_on_shutdown_uses_global_tracers(self):
+        _reactor = mock.Mock()
+        _reactor.callLater = self.clock.callLater
+
+        tracer = mock.Mock(spec=['record', 'drain'])
+        tracer.drain.return_value = succeed(None)
+
+        drain_on_shutdown(_reactor=_reactor)
+
+        self.patch(sys.modules['tryfer.tracers'], '_globalTracers', [tracer])
+        self.successResultOf(_reactor.addSystemEventTrigger.call_args[0][2]())
+
+        tracer.drain.assert_called_once_with()
+
+
+def _in_thread(f, *args):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(f(*args)))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+class ThreadSafeTracerTests(TestCase):
+    def setUp(self):
+        self.reactor = mock.Mock()
+        self.inner = mock.Mock(spec=['record'])
+        self.tracer = ThreadSafeTracer(self.inner, _reactor=self.reactor)
+        self.trace = (Trace('test', 1, 2), [Annotation.client_send(1)])
+
+    def test_verifyObject(self):
+        verifyObject(ITracer, self.tracer)
+
+    def test_records_directly_in_reactor_thread(self):
+        self.tracer.record([self.trace])
+
+        self.inner.record.assert_called_once_with([self.trace])
+        self.assertEqual(self.reactor.callFromThread.call_count, 0)
+
+    def test_batches_records_from_other_threads(self):
+        for x in xrange(3):
+            _in_thread(self.tracer.record, [self.trace])
+
+        self.assertEqual(self.inner.record.call_count, 0)
+        self.reactor.callFromThread.assert_called_once_with(
+            self.tracer._drain)
+
+        self.tracer._drain()
+
+        self.inner.record.assert_called_once_with([self.trace] * 3)
+
+        _in_thread(self.tracer.record, [self.trace])
+        self.assertEqual(self.reactor.callFromThread.call_count, 2)
+
+    def test_drain(self):
+        _in_thread(self.tracer.record, [self.trace])
+
+        self.successResultOf(drain(self.tracer))
+        self.inner.record.assert_called_once_with([self.trace])
+
+    @inlineCallbacks
+    def test_many_threads(self):
+        threads = 20
+        records = 500
+        recorded = []
+
+        inner = mock.Mock(spec=['record'])
+        inner.record.side_effect = recorded.extend
+        tracer = ThreadSafeTracer(inner)
+
+        def _record(thread):
+            for span_id in xrange(records):
+                tracer.record(
+                    [(Trace('test', thread + 1, span_id + 1), [])])
+
+        pool = reactor.getThreadPool()
+        pool.adjustPoolsize(threads, threads)
+        self.addCleanup(pool.adjustPoolsize, 0, 10)
+
+        yield DeferredList([deferToThread(_record, thread)
+                            for thread in xrange(threads)],
+                           fireOnOneErrback=True)
+
+        while len(recorded) < threads * records:
+            yield deferLater(reactor, 0.01, lambda: None)
+
+        self.assertEqual(
+            sorted((t.trace_id, t.span_id) for (t, _) in recorded),
+            [(thread + 1, span_id + 1)
+             for thread in xrange(threads) for span_id in xrange(records)])
+        self.assertTrue(inner.record.call_count < threads * records)
+        self.assertFalse(tracer._queue)
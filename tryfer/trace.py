@@ -15,6 +15,9 @@
 import math
 import time
 import random
+import struct
+
+from functools import partial
 
 from zope.interface import implements
 
@@ -23,6 +26,9 @@ from tryfer.tracers import get_tracers
 from tryfer._thrift.zipkinCore import constants
 
 
+_ID_MASK = (2 ** 64) - 1
+
+
 def _uniq_id():
     """
     Create a random 64-bit signed integer appropriate
@@ -47,7 +53,7 @@ class Trace(object):
     implements(ITrace)
 
     def __init__(self, name, trace_id=None, span_id=None,
-                 parent_span_id=None, tracers=None):
+                 parent_span_id=None, tracers=None, sampled=True):
         """
         @param name: C{str} describing the current span.
         @param trace_id: C{int} or C{None}
@@ -56,6 +62,11 @@ class Trace(object):
 
         @param tracers: C{list} of L{ITracer} providers, primarily useful
             for unit testing.
+
+        @param sampled: C{bool} whether this trace is recorded.  An unsampled
+            trace has no tracers and its children are unsampled too, so it
+            only carries its ids and the decision not to sample on to other
+            services.  Default C{True}.
         """
         self.name = name
         # If no trace_id and span_id are given we want to generate new
@@ -67,13 +78,21 @@ class Trace(object):
         # and leave it as None.
         self.parent_span_id = parent_span_id
 
+        self.sampled = sampled
+
         # If no tracers are given we get the global list of tracers.
-        self._tracers = tracers or get_tracers()
+        if sampled:
+            self._tracers = tracers or get_tracers()
+        else:
+            self._tracers = []
 
         # By default no endpoint will be associated with annotations recorded
         # to this trace.
         self._endpoint = None
 
+        self._hex_ids = None
+        self._packed_ids = None
+
     def __eq__(self, other):
         return ITrace.providedBy(other) and (
             (self.trace_id, self.span_id, self.parent_span_id) ==
@@ -88,6 +107,40 @@ class Trace(object):
             'span_id={0.span_id!r}, parent_span_id={0.parent_span_id!r})'
         ).format(self)
 
+    @property
+    def hex_ids(self):
+        """
+        C{tuple} of this trace's trace id, span id and parent span id as 16
+        digit hex C{str}s, as used in X-B3-* headers and JSON spans.  The
+        parent span id is C{None} if there is no parent.
+
+        Computed on first use and cached, so ids must not be changed once it
+        has been read.
+        """
+        if self._hex_ids is None:
+            self._hex_ids = (
+                '%0.16x' % (self.trace_id,),
+                '%0.16x' % (self.span_id,),
+                None if self.parent_span_id is None
+                else '%0.16x' % (self.parent_span_id,))
+
+        return self._hex_ids
+
+    @property
+    def packed_ids(self):
+        """
+        This trace's trace id, span id and parent span id (0 if there is no
+        parent) packed as three unsigned 64-bit big-endian integers.  Negative
+        ids, such as the signed 64-bit ids used by thrift, are packed as
+        their two's complement.  Cached like L{hex_ids}.
+        """
+        if self._packed_ids is None:
+            self._packed_ids = struct.pack(
+                '!QQQ', self.trace_id & _ID_MASK, self.span_id & _ID_MASK,
+                (self.parent_span_id or 0) & _ID_MASK)
+
+        return self._packed_ids
+
     def child(self, name):
         """
         Create a new instance of this class derived from the current instance
@@ -96,8 +149,9 @@ class Trace(object):
             (new.trace_id == current.trace_id and
              new.parent_span_id == current.span_id)
 
-        The new L{Trace} instance will have a new unique span_id and if set the
-        endpoint of the current L{Trace} object.
+        The new L{Trace} instance will have a new unique span_id, the tracers
+        and sampling decision of the current L{Trace} object and if set its
+        endpoint.
 
         @param name: C{str} name describing the new span represented by the new
             Trace object.
@@ -105,11 +159,33 @@ class Trace(object):
         @returns: L{Trace}
         """
         trace = self.__class__(
-            name, trace_id=self.trace_id, parent_span_id=self.span_id)
+            name, trace_id=self.trace_id, parent_span_id=self.span_id,
+            tracers=self._tracers, sampled=self.sampled)
         trace.set_endpoint(self._endpoint)
 
         return trace
 
+    def span(self, name):
+        """
+        Time a block of code as a child span of this trace::
+
+            with trace.span('render') as child:
+                child.record(Annotation.string('template', 'index.html'))
+
+        The child's C{cs} and C{cr} annotations are recorded together when
+        the block exits, with one clock read at each end.  If the block
+        raises, an C{error} annotation is recorded as well.  Nothing is
+        created or recorded when there are no tracers.
+
+        @param name: C{str} name of the child span.
+
+        @returns: A context manager whose target is the child L{Trace}.
+        """
+        if not self._tracers:
+            return _NullSpan(self)
+
+        return _Span(self.child(name))
+
     def record(self, *annotations):
         # If this L{Trace} has an endpoint associated with it we will
         # attach that endpoint to the passed annotation if the
@@ -132,6 +208,51 @@ class Trace(object):
         self._endpoint = endpoint
 
 
+class _Span(object):
+    """
+    A child span started by L{Trace.span}.  L{finish} may be called instead
+    of leaving the C{with} block, for spans which end asynchronously.
+    """
+
+    __slots__ = ('trace', '_start')
+
+    def __init__(self, trace):
+        self.trace = trace
+        self._start = None
+
+    def __enter__(self):
+        self._start = math.trunc(time.time() * 1000 * 1000)
+        return self.trace
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.finish(exc_value)
+
+    def finish(self, error=None):
+        if error is None:
+            self.trace.record(Annotation.client_send(self._start),
+                              Annotation.client_recv())
+        else:
+            self.trace.record(Annotation.client_send(self._start),
+                              Annotation.string('error', '{0}', error),
+                              Annotation.client_recv())
+
+
+class _NullSpan(object):
+    __slots__ = ('trace',)
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        return self.trace
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+    def finish(self, error=None):
+        pass
+
+
 class Endpoint(object):
     implements(IEndpoint)
 
@@ -169,7 +290,10 @@ class Annotation(object):
         @param name: C{str} name of this annotation.
 
         @param value: A value of the appropriate type based on
-            C{annotation_type}.
+            C{annotation_type}, or a callable taking no arguments which
+            returns one.  A callable is only called the first time C{value}
+            is read, which normally happens when the annotation is formatted
+            for delivery.
 
         @param annotation_type: C{str} the expected type of our C{value}.
 
@@ -181,6 +305,21 @@ class Annotation(object):
         self.annotation_type = annotation_type
         self.endpoint = endpoint
 
+    @property
+    def value(self):
+        if self._render is not None:
+            self._value = self._render()
+            self._render = None
+
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        if callable(value):
+            self._render, self._value = value, None
+        else:
+            self._render, self._value = None, value
+
     def __eq__(self, other):
         return IAnnotation.providedBy(other) and (
             (self.name, self.value, self.annotation_type, self.endpoint) ==
@@ -219,7 +358,17 @@ class Annotation(object):
         return cls.timestamp(constants.SERVER_RECV, timestamp)
 
     @classmethod
-    def string(cls, name, value):
+    def string(cls, name, value, *args):
+        """
+        Create a string annotation.
+
+        If C{args} are given C{value} is a format string which will be
+        formatted with them when the annotation is delivered, for example
+        C{Annotation.string('http.responsecode', '{0} {1}', code, phrase)}.
+        """
+        if args:
+            value = partial(value.format, *args)
+
         return cls(name, value, 'string')
 
     @classmethod
@@ -12,22 +12,73 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import sys
+import json
+import time
+import threading
+
+from Queue import Queue, Full
 
 from StringIO import StringIO
 
-from collections import defaultdict
+from collections import defaultdict, deque
 
 from zope.interface import implements
 
 from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred,
+    DeferredList,
+    maybeDeferred,
+    succeed
+)
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.task import LoopingCall
+from twisted.python.threadable import isInIOThread
 from twisted.web.client import FileBodyProducer
 from twisted.web.http_headers import Headers
 
+from scrivener._thrift.scribe.ttypes import ResultCode
+
 from tryfer import log
 from tryfer.interfaces import ITracer
 from tryfer._thrift.zipkinCore import constants
-from tryfer.formatters import json_formatter, base64_thrift_formatter
+from tryfer.formatters import (
+    json_span,
+    json_formatter,
+    thrift_spans_formatter,
+    base64_thrift_messages_formatter
+)
+
+
+class DeliveryError(Exception):
+    """
+    A collector was reached but did not accept the traces sent to it.
+    """
+
+
+def _check_scribe_result(result, category):
+    if result == ResultCode.TRY_LATER:
+        raise DeliveryError(
+            "Scribe asked to try later for category: {0}".format(category))
+
+    return result
+
+
+def drain(tracer):
+    """
+    Ask C{tracer} to send everything it has buffered, if it buffers.
+
+    @returns: A L{Deferred} which fires once the tracer's deliveries have
+        finished.
+    """
+    tracer_drain = getattr(tracer, 'drain', None)
+
+    if tracer_drain is None:
+        return succeed(None)
+
+    return maybeDeferred(tracer_drain)
 
 
 class EndAnnotationTracer(object):
@@ -36,7 +87,9 @@ class EndAnnotationTracer(object):
     possible "end annotations" are seen.  An end annotation indicates that from
     the perspective of this tracer the trace is complete.
 
-    @cvar DEFAULT_END_ANNOTATIONS: Default C{list} of end annotations.
+    @cvar DEFAULT_END_ANNOTATIONS: Default C{list} of end annotations.  These
+        include the annotations L{tryfer.http.TracingAgent} records once a
+        response body has been read, which follow C{CLIENT_RECV}.
 
     @param tracer: An L{ITracer} provider to delegate to once an end annotation
         is seen.
@@ -46,23 +99,27 @@ class EndAnnotationTracer(object):
     """
     implements(ITracer)
 
-    DEFAULT_END_ANNOTATIONS = (constants.CLIENT_RECV, constants.SERVER_SEND)
+    DEFAULT_END_ANNOTATIONS = (constants.CLIENT_RECV, constants.SERVER_SEND,
+                               'http.response.body', 'http.response.failed')
 
     def __init__(self, tracer, end_annotations=None):
         self._tracer = tracer
         self._end_annotations = end_annotations or self.DEFAULT_END_ANNOTATIONS
         self._annotations_for_trace = defaultdict(list)
+        self._traces = {}
 
     def record(self, traces):
         for (trace, annotations) in traces:
             trace_key = (trace.trace_id, trace.span_id)
             self._annotations_for_trace[trace_key].extend(annotations)
+            self._traces.setdefault(trace_key, trace)
 
             for annotation in annotations:
                 if annotation.name in self._end_annotations:
                     saved_annotations = self._annotations_for_trace[trace_key]
 
                     del self._annotations_for_trace[trace_key]
+                    del self._traces[trace_key]
 
                     log.debug(format=("Sending trace: %(trace_key)s w/"
                                       " %(annotations)s"),
@@ -73,6 +130,25 @@ class EndAnnotationTracer(object):
 
                     break
 
+    def _send_unfinished(self):
+        pending = [(self._traces[trace_key], annotations)
+                   for (trace_key, annotations)
+                   in self._annotations_for_trace.iteritems()]
+
+        self._annotations_for_trace.clear()
+        self._traces.clear()
+
+        if pending:
+            self._tracer.record(pending)
+
+    def drain(self):
+        """
+        Send the annotations of every unfinished trace on as they are, then
+        drain the next tracer.
+        """
+        self._send_unfinished()
+        return drain(self._tracer)
+
 
 class RawZipkinTracer(object):
     """
@@ -84,24 +160,47 @@ class RawZipkinTracer(object):
     @param scribe_client: An L{scrivener.ScribeClient} instance.
 
     @param category: A C{str} to be used as the scribe category.
+
+    @cvar formatter: The function used to encode traces for L{deliver}.
     """
     implements(ITracer)
 
+    formatter = staticmethod(base64_thrift_messages_formatter)
+
     def __init__(self, scribe_client, category=None):
         self._scribe = scribe_client
         self._category = category or 'zipkin'
 
     def record(self, traces):
-        d = self._scribe.log(
-            self._category,
-            [base64_thrift_formatter(trace, annotations)
-             for (trace, annotations) in traces])
+        return self.deliver(self.formatter(traces))
+
+    def send(self, traces):
+        """
+        Log C{traces} without logging failures.
+
+        @returns: A L{Deferred} which fails if they could not be logged or
+            scribe answered C{TRY_LATER}.
+        """
+        return self._log(self.formatter(traces))
+
+    def _log(self, messages):
+        d = self._scribe.log(self._category, messages)
+        d.addCallback(_check_scribe_result, self._category)
+        return d
+
+    def deliver(self, messages):
+        """
+        Log traces encoded by L{formatter}.
+        """
+        d = self._log(messages)
 
         d.addErrback(
             log.err,
             "Error sending trace to scribe category: {0}".format(
                 self._category))
 
+        return d
+
 
 class ZipkinTracer(object):
     """
@@ -140,6 +239,9 @@ class ZipkinTracer(object):
     def record(self, traces):
         return self._tracer.record(traces)
 
+    def drain(self):
+        return drain(self._tracer)
+
 
 class RawRESTkinHTTPTracer(object):
     """
@@ -152,21 +254,61 @@ class RawRESTkinHTTPTracer(object):
         used to POST the given traces to the specified L{trace_url}.
 
     @param trace_url: The URL to the RESTkin trace API endpoint as a C{str}.
+
+    @cvar formatter: The function used to encode traces for L{deliver}.
+    @cvar content_type: C{str} Content-Type of the request body, or C{None}
+        to send none.
     """
     implements(ITracer)
 
+    formatter = staticmethod(json_formatter)
+    content_type = None
+
     def __init__(self, agent, trace_url):
         self._agent = agent
         self._trace_url = trace_url
 
     def record(self, traces):
-        producer = FileBodyProducer(StringIO(json_formatter(traces)))
+        return self.deliver(self.formatter(traces))
+
+    def send(self, traces):
+        """
+        POST C{traces} without logging failures.
+
+        @returns: A L{Deferred} which fires with the response, or fails if
+            the request failed or the response status was not 2xx.
+        """
+        return self._post(self.formatter(traces))
+
+    def _post(self, body):
+        producer = FileBodyProducer(StringIO(body))
+
+        headers = Headers({})
+        if self.content_type is not None:
+            headers.setRawHeaders('Content-Type', [self.content_type])
 
-        d = self._agent.request('POST', self._trace_url, Headers({}), producer)
+        d = self._agent.request('POST', self._trace_url, headers, producer)
+        d.addCallback(self._check_response)
+        return d
+
+    def _check_response(self, response):
+        if not 200 <= response.code < 300:
+            raise DeliveryError("{0} responded with {1} {2}".format(
+                self._trace_url, response.code, response.phrase))
+
+        return response
+
+    def deliver(self, body):
+        """
+        POST traces encoded by L{formatter}.
+        """
+        d = self._post(body)
         d.addErrback(
             log.err,
             "Error sending trace to: {0}".format(self._trace_url))
 
+        return d
+
 
 class RESTkinHTTPTracer(object):
     """
@@ -203,7 +345,68 @@ class RESTkinHTTPTracer(object):
         )
 
     def record(self, traces):
-        self._tracer.record(traces)
+        return self._tracer.record(traces)
+
+    def drain(self):
+        return drain(self._tracer)
+
+
+class RawZipkinHTTPTracer(RawRESTkinHTTPTracer):
+    """
+    Send annotations to Zipkin's HTTP API as a thrift C{list<Span>}.
+
+    Spans are sent as raw thrift, without the base64 encoding scribe
+    requires.
+
+    This implementation posts all traces immediately and does not implement
+    buffering.
+
+    @param agent: See L{RawRESTkinHTTPTracer}
+
+    @param trace_url: The URL to Zipkin's span API as a C{str}, for example
+        C{'http://zipkin:9411/api/v1/spans'}.
+    """
+    formatter = staticmethod(thrift_spans_formatter)
+    content_type = 'application/x-thrift'
+
+
+class ZipkinHTTPTracer(object):
+    """
+    Send annotations to Zipkin's HTTP API as thrift.
+
+    This is equivalent to EndAnnotationTracer(
+    BufferingTracer(RawZipkinHTTPTracer(agent, trace_url))).
+
+    @param agent: See L{RawZipkinHTTPTracer}
+
+    @param trace_url: See L{RawZipkinHTTPTracer}
+
+    @param end_annotations: See L{EndAnnotationTracer}
+
+    @param max_traces: See L{BufferingTracer}
+
+    @param max_idle_time: See L{BufferingTracer}
+
+    @param _reactor: See L{BufferingTracer}
+    """
+    implements(ITracer)
+
+    def __init__(self, agent, trace_url, end_annotations=None,
+                 max_traces=50, max_idle_time=10, _reactor=None):
+        self._tracer = EndAnnotationTracer(
+            BufferingTracer(
+                RawZipkinHTTPTracer(agent, trace_url),
+                max_traces=max_traces,
+                max_idle_time=max_idle_time,
+                _reactor=_reactor),
+            end_annotations=end_annotations
+        )
+
+    def record(self, traces):
+        return self._tracer.record(traces)
+
+    def drain(self):
+        return drain(self._tracer)
 
 
 class RawRESTkinScribeTracer(object):
@@ -215,22 +418,46 @@ class RawRESTkinScribeTracer(object):
     @param scribe_client: The L{ScribeClient} to log JSON traces to.
 
     @param category: The scribe category as a C{str}
+
+    @cvar formatter: The function used to encode traces for L{deliver}.
     """
     implements(ITracer)
 
+    formatter = staticmethod(json_formatter)
+
     def __init__(self, scribe_client, category=None):
         self._scribe_client = scribe_client
         self._category = category or 'restkin'
 
     def record(self, traces):
-        d = self._scribe_client.log(
-            self._category,
-            [json_formatter(traces)])
+        return self.deliver(self.formatter(traces))
+
+    def send(self, traces):
+        """
+        Log C{traces} without logging failures.
+
+        @returns: A L{Deferred} which fails if they could not be logged or
+            scribe answered C{TRY_LATER}.
+        """
+        return self._log(self.formatter(traces))
+
+    def _log(self, message):
+        d = self._scribe_client.log(self._category, [message])
+        d.addCallback(_check_scribe_result, self._category)
+        return d
+
+    def deliver(self, message):
+        """
+        Log traces encoded by L{formatter}.
+        """
+        d = self._log(message)
         d.addErrback(
             log.err,
             "Error sending trace to scribe category: {0}".format(
                 self._category))
 
+        return d
+
 
 class RESTkinScribeTracer(object):
     """
@@ -269,24 +496,618 @@ class RESTkinScribeTracer(object):
     def record(self, traces):
         return self._tracer.record(traces)
 
+    def drain(self):
+        return drain(self._tracer)
+
+
+class RawUDPTracer(object):
+    """
+    Send annotations as JSON over UDP.
+
+    Each span is serialized separately and as many spans as will fit in
+    L{max_datagram_size} bytes are sent in each datagram as a JSON list.
+    Datagrams are fire-and-forget, there is no acknowledgement or retry and
+    spans which do not fit in a single datagram on their own are dropped.
+
+    This implementation sends all traces immediately and does no buffering.
+    The UDP port it sends from is opened when it first records and released
+    by L{close}, or by L{drain} before the reactor shuts down.
+
+    @param host: The C{str} IPv4 address of the collector.
+
+    @param port: The C{int} UDP port of the collector.
+
+    @param max_datagram_size: C{int} maximum size of each datagram in bytes.
+        Default 1400, which fits in an ethernet MTU of 1500 along with the IP
+        and UDP headers.
+
+    @param _reactor: An L{IReactorUDP} provider.
+    """
+    implements(ITracer)
+
+    def __init__(self, host, port, max_datagram_size=1400, _reactor=None):
+        self._address = (host, port)
+        self._max_datagram_size = max_datagram_size
+        self._reactor = _reactor or reactor
+        self._protocol = None
+        self._port = None
+
+    def _send(self, datagram):
+        try:
+            self._protocol.transport.write(datagram, self._address)
+        except Exception:
+            log.err(None, "Error sending trace to: {0}:{1}".format(
+                *self._address))
+
+    def record(self, traces):
+        if self._port is None:
+            # A closed port lets go of its protocol asynchronously, so each
+            # port gets a new one.
+            self._protocol = DatagramProtocol()
+            self._port = self._reactor.listenUDP(0, self._protocol)
+
+        max_size = self._max_datagram_size
+        pending = []
+
+        # The size of '[' + ','.join(pending) + ']'
+        pending_size = 1
+
+        for (trace, annotations) in traces:
+            encoded = json.dumps(json_span(trace, annotations),
+                                 separators=(',', ':'))
+            size = len(encoded) + 1
+
+            if size + 1 > max_size:
+                log.msg(format="Dropping %(size)d byte trace %(trace)r.",
+                        system=self.__class__.__name__,
+                        size=size, trace=trace)
+                continue
+
+            if pending_size + size > max_size:
+                self._send('[' + ','.join(pending) + ']')
+                pending = []
+                pending_size = 1
+
+            pending.append(encoded)
+            pending_size += size
+
+        if pending:
+            self._send('[' + ','.join(pending) + ']')
+
+    def close(self):
+        """
+        Stop listening on the UDP port used to send datagrams.  Recording
+        again opens a new one.
+
+        @returns: A L{Deferred} which fires once the port has been released.
+        """
+        port, self._port = self._port, None
+
+        if port is None:
+            return succeed(None)
+
+        return maybeDeferred(port.stopListening)
+
+    def drain(self):
+        """
+        Datagrams are sent as soon as they are recorded, so there is nothing
+        to wait for, but release the port as draining precedes shutdown.
+        """
+        return self.close()
+
+
+class UDPTracer(object):
+    """
+    Send annotations as JSON over UDP.
+
+    This is equivalent to EndAnnotationTracer(
+    BufferingTracer(RawUDPTracer(host, port))).
+
+    This implementation mostly exists for convenience.
+
+    @param host: See L{RawUDPTracer}
+
+    @param port: See L{RawUDPTracer}
+
+    @param max_datagram_size: See L{RawUDPTracer}
+
+    @param end_annotations: See L{EndAnnotationTracer}
+
+    @param max_traces: See L{BufferingTracer}
+
+    @param max_idle_time: See L{BufferingTracer}
+
+    @param _reactor: See L{BufferingTracer} and L{RawUDPTracer}
+    """
+    implements(ITracer)
+
+    def __init__(self, host, port, max_datagram_size=1400,
+                 end_annotations=None, max_traces=50, max_idle_time=10,
+                 _reactor=None):
+        self._tracer = EndAnnotationTracer(
+            BufferingTracer(
+                RawUDPTracer(host, port, max_datagram_size, _reactor),
+                max_traces=max_traces,
+                max_idle_time=max_idle_time,
+                _reactor=_reactor),
+            end_annotations=end_annotations
+        )
+
+    def record(self, traces):
+        return self._tracer.record(traces)
+
+    def drain(self):
+        return drain(self._tracer)
+
+
+class FileTracer(object):
+    """
+    Append traces to a file as newline delimited compact JSON, for a log
+    shipper to pick up.
+
+    Each recorded C{(trace, annotations)} is written as one line, so to get
+    one line per completed span with all of its annotations, wrap it in an
+    L{EndAnnotationTracer}::
+
+        push_tracer(EndAnnotationTracer(FileTracer('/var/log/spans.json')))
+
+    Lines are buffered in memory and written to the file once
+    L{max_buffer_size} bytes are buffered or L{flush_interval} seconds after
+    the first unwritten line was recorded, whichever comes first.
+
+    When writing would grow the file past L{max_file_size} bytes, or the file
+    was opened more than L{max_file_age} seconds ago, it is renamed to
+    C{path.YYYYmmddHHMMSS} (using UTC) and a new file is started.
+
+    @param path: The C{str} path of the file to append to.
+
+    @param max_buffer_size: C{int} number of bytes to buffer before writing.
+        Default 65536.
+
+    @param flush_interval: C{int} or C{float} maximum number of seconds a
+        line is buffered for.  Default 1.
+
+    @param max_file_size: C{int} number of bytes after which the file is
+        rotated, or C{None} to never rotate by size.  Default C{None}.
+
+    @param max_file_age: C{int} or C{float} number of seconds after which the
+        file is rotated, or C{None} to never rotate by age.  Default C{None}.
+
+    @param fsync: When to C{fsync} the file.  C{'flush'} after every write,
+        C{'rotate'} before a file is rotated or closed, or C{None} to leave it
+        to the operating system.  Default C{None}.
+
+    @param flush_scheduler: The L{FlushScheduler} used for time based
+        flushes.  Default: the result of L{get_flush_scheduler} for
+        C{_reactor}.
+
+    @param _reactor: An L{IReactorTime} provider.
+    """
+    implements(ITracer)
+
+    FSYNC_POLICIES = (None, 'flush', 'rotate')
+
+    def __init__(self, path, max_buffer_size=65536, flush_interval=1,
+                 max_file_size=None, max_file_age=None, fsync=None,
+                 flush_scheduler=None, _reactor=None):
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy: {0!r}".format(fsync))
+
+        self._path = path
+        self._max_buffer_size = max_buffer_size
+        self._flush_interval = flush_interval
+        self._max_file_size = max_file_size
+        self._max_file_age = max_file_age
+        self._fsync = fsync
+
+        self._reactor = _reactor or reactor
+        self._scheduler = flush_scheduler or get_flush_scheduler(
+            self._reactor)
+
+        self._buffer = []
+        self._buffered = 0
+
+        self._open()
+
+    def _open(self):
+        self._file = open(self._path, 'ab')
+        self._size = os.path.getsize(self._path)
+        self._opened = self._reactor.seconds()
+
+    def _should_rotate(self, size):
+        if not self._size:
+            return False
+
+        if (self._max_file_size is not None and
+                self._size + size > self._max_file_size):
+            return True
+
+        return (self._max_file_age is not None and
+                self._reactor.seconds() - self._opened >= self._max_file_age)
+
+    def _rotated_path(self):
+        rotated = '{0}.{1}'.format(
+            self._path,
+            time.strftime('%Y%m%d%H%M%S',
+                          time.gmtime(self._reactor.seconds())))
+
+        candidate = rotated
+        n = 0
+        while os.path.exists(candidate):
+            n += 1
+            candidate = '{0}.{1}'.format(rotated, n)
+
+        return candidate
+
+    def _rotate(self):
+        if self._fsync is not None:
+            os.fsync(self._file.fileno())
+
+        self._file.close()
+
+        try:
+            os.rename(self._path, self._rotated_path())
+        except OSError:
+            # Keep appending to the current file rather than lose traces.
+            log.err(None, "Error rotating: {0}".format(self._path))
+
+        self._open()
+
+    def flush(self):
+        """
+        Write all buffered lines to the file.
+        """
+        self._scheduler.cancel(self.flush)
+
+        if not self._buffer:
+            return
+
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+
+        try:
+            # An earlier rotation may have failed to reopen the file.
+            if self._file.closed:
+                self._open()
+
+            if self._should_rotate(len(data)):
+                self._rotate()
+
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+
+            if self._fsync == 'flush':
+                os.fsync(self._file.fileno())
+        except (IOError, OSError):
+            log.err(None, "Error writing traces to: {0}".format(self._path))
+
+    def drain(self):
+        self.flush()
+
+    def close(self):
+        """
+        Write all buffered lines and close the file.
+        """
+        self.flush()
+
+        # A failed rotation may have left it closed already.
+        if self._file.closed:
+            return
+
+        if self._fsync is not None:
+            os.fsync(self._file.fileno())
+
+        self._file.close()
+
+    def record(self, traces):
+        was_empty = not self._buffer
+
+        for (trace, annotations) in traces:
+            line = json.dumps(json_span(trace, annotations),
+                              separators=(',', ':')) + '\n'
+            self._buffer.append(line)
+            self._buffered += len(line)
+
+        if self._buffered >= self._max_buffer_size:
+            self.flush()
+        elif was_empty and self._buffer:
+            self._scheduler.schedule(self.flush, self._flush_interval)
+
+
+class _BackgroundWriter(object):
+    """
+    Write to a file-like object from a daemon thread so that slow
+    destinations do not block the reactor.
+
+    At most C{max_pending} writes are queued.  When the queue is full the
+    C{overflow} policy decides what happens to new writes: C{'drop'} discards
+    them, C{'block'} waits for the writer thread to catch up.
+
+    @ivar dropped: C{int} number of writes discarded so far.
+    """
+    OVERFLOW_POLICIES = ('drop', 'block')
+
+    def __init__(self, destination, max_pending=1000, overflow='drop'):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(
+                "Unknown overflow policy: {0!r}".format(overflow))
+
+        self._destination = destination
+        self._queue = Queue(max_pending)
+        self._block = overflow == 'block'
+        self._overflowing = False
+        self._thread = None
+        self.dropped = 0
+
+    def _run(self, stopping):
+        destination = self._destination
+
+        while True:
+            data = self._queue.get()
+
+            if data is None:
+                return
+
+            try:
+                destination.write(data)
+                destination.flush()
+            except Exception:
+                log.err(None, "Error writing traces.")
+            finally:
+                self._queue.task_done()
+
+            # stop() could not queue its sentinel while the queue was full.
+            if stopping.is_set() and self._queue.empty():
+                return
+
+    def write(self, data):
+        if self._thread is not None and self._stopping.is_set():
+            if self._thread.is_alive():
+                # A stopped writer is still stuck writing to the
+                # destination, a second one would interleave with it.
+                self.dropped += 1
+                return
+
+            self._thread = None
+
+        if self._thread is None:
+            self._stopping = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run, args=(self._stopping,),
+                name='tryfer-writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+        try:
+            self._queue.put(data, self._block)
+        except Full:
+            self.dropped += 1
+
+            if not self._overflowing:
+                self._overflowing = True
+                log.msg("Writer queue is full, dropping traces.",
+                        system=self.__class__.__name__)
+        else:
+            self._overflowing = False
+
+    def drain(self, reactor, timeout, interval=0.01):
+        """
+        Wait for everything queued to be written, polling every C{interval}
+        seconds.
+
+        @returns: A L{Deferred} which fires once the queue is empty and the
+            last write has finished, or once C{timeout} seconds have passed.
+        """
+        d = Deferred()
+        deadline = reactor.seconds() + timeout
+
+        def _poll():
+            if self._thread is None or not self._queue.unfinished_tasks:
+                d.callback(None)
+            elif reactor.seconds() >= deadline:
+                log.msg(format="Timed out draining %(pending)d writes.",
+                        system=self.__class__.__name__,
+                        pending=self._queue.qsize())
+                d.callback(None)
+            else:
+                reactor.callLater(interval, _poll)
+
+        _poll()
+        return d
+
+    def stop(self, timeout=None):
+        """
+        Stop the writer thread once everything queued has been written.
+
+        @param timeout: C{float} maximum number of seconds to wait or
+            C{None} to wait until it has stopped.  A thread stuck writing
+            to its destination is abandoned once C{timeout} has passed, and
+            writes are dropped until it exits.
+        """
+        if self._thread is None:
+            return
+
+        if not self._stopping.is_set():
+            self._stopping.set()
+
+            try:
+                self._queue.put_nowait(None)
+            except Full:
+                pass
+
+        self._thread.join(timeout)
+
+        if not self._thread.is_alive():
+            self._thread = None
+
 
 class DebugTracer(object):
     """
     Send annotations immediately to a file-like destination in JSON format.
 
-    All traces will be written immediately to the destination.
+    All traces will be formatted immediately.  By default they are also
+    written and flushed to the destination immediately.  If L{background} is
+    true they are instead handed to a bounded queue which is written by a
+    separate thread, so a slow destination such as a pipe does not block the
+    reactor.
 
     @param destination: A file-like object to write JSON formatted traces to.
+
+    @param background: C{bool} whether to write from a background thread.
+        Default C{False}.
+
+    @param max_pending: C{int} number of batches of traces which may be
+        waiting to be written by the background thread.  Default 1000.
+
+    @param overflow: What to do with traces when L{max_pending} batches are
+        waiting.  C{'drop'} discards them, C{'block'} waits for the
+        background thread to catch up.  Default C{'drop'}.
+
+    @param _reactor: An L{IReactorTime} provider used by L{drain}.
     """
     implements(ITracer)
 
-    def __init__(self, destination=None):
+    def __init__(self, destination=None, background=False, max_pending=1000,
+                 overflow='drop', _reactor=None):
         self.destination = destination or sys.stdout
+        self._reactor = _reactor or reactor
+        self._writer = None
+
+        if background:
+            self._writer = _BackgroundWriter(
+                self.destination, max_pending, overflow)
 
     def record(self, traces):
-        self.destination.write(json_formatter(traces, indent=2))
-        self.destination.write('\n')
-        self.destination.flush()
+        data = json_formatter(traces, indent=2) + '\n'
+
+        if self._writer is not None:
+            self._writer.write(data)
+        else:
+            self.destination.write(data)
+            self.destination.flush()
+
+    def drain(self, timeout=5):
+        """
+        Wait for the background thread to write all pending traces.
+
+        @param timeout: C{float} maximum number of seconds to wait.
+
+        @returns: A L{Deferred} which fires once they have been written or
+            C{timeout} seconds have passed.
+        """
+        if self._writer is None:
+            return succeed(None)
+
+        return self._writer.drain(self._reactor, timeout)
+
+    def stop(self, timeout=None):
+        """
+        Stop the background thread once all pending traces have been
+        written.  See L{_BackgroundWriter.stop}.
+        """
+        if self._writer is not None:
+            self._writer.stop(timeout)
+
+
+class FlushScheduler(object):
+    """
+    A coarse timer wheel which drives any number of deferred flushes from a
+    single L{LoopingCall}.
+
+    Rather than each L{BufferingTracer} creating and resetting its own
+    L{IDelayedCall} for every recorded trace, they schedule their flush with a
+    shared L{FlushScheduler}.  Scheduling only updates a deadline, the reactor
+    is only involved once per L{interval} and only while at least one flush
+    is pending.
+
+    Deadlines are measured from the time of the most recent tick, so a
+    scheduled function will be called at most L{interval} seconds early or
+    late.
+
+    @param interval: C{int} or C{float} number of seconds between checks for
+        expired deadlines.  Default 1.
+
+    @param _reactor: An L{IReactorTime} provider used to drive the
+        L{LoopingCall}.
+    """
+
+    def __init__(self, interval=1, _reactor=None):
+        self._interval = interval
+        self._reactor = _reactor or reactor
+        self._deadlines = {}
+        self._ticking = False
+
+        self._loop = LoopingCall(self._tick)
+        self._loop.clock = self._reactor
+
+        self.now = None
+
+    def schedule(self, f, delay):
+        """
+        Call C{f} once C{delay} seconds have elapsed.  If C{f} is already
+        scheduled its deadline is replaced.
+
+        @param f: A callable taking no arguments.
+        @param delay: C{int} or C{float} number of seconds.
+        """
+        if not self._loop.running:
+            self.now = self._reactor.seconds()
+            self._loop.start(self._interval, now=False)
+
+        self._deadlines[f] = self.now + delay
+
+    def cancel(self, f):
+        """
+        Stop C{f} from being called if it is currently scheduled.
+        """
+        self._deadlines.pop(f, None)
+
+        # While ticking the loop is left running so that a flush which
+        # schedules more work does not restart it from inside its own call,
+        # _tick stops it afterwards if nothing is left.
+        if not self._deadlines and self._loop.running and not self._ticking:
+            self._loop.stop()
+
+    def _tick(self):
+        self.now = now = self._reactor.seconds()
+        self._ticking = True
+
+        try:
+            for f in list(self._deadlines):
+                # An earlier flush in this tick may have cancelled or
+                # rescheduled f.
+                deadline = self._deadlines.get(f)
+                if deadline is not None and deadline <= now:
+                    del self._deadlines[f]
+
+                    try:
+                        f()
+                    except Exception:
+                        log.err(None, "Error running scheduled flush.")
+        finally:
+            self._ticking = False
+
+        if not self._deadlines and self._loop.running:
+            self._loop.stop()
+
+
+_flushSchedulers = {}
+
+
+def get_flush_scheduler(_reactor=None):
+    """
+    Get the L{FlushScheduler} shared by all tracers using C{_reactor}.
+    """
+    _reactor = _reactor or reactor
+
+    scheduler = _flushSchedulers.get(_reactor)
+    if scheduler is None:
+        scheduler = _flushSchedulers[_reactor] = FlushScheduler(
+            _reactor=_reactor)
+
+    return scheduler
 
 
 class BufferingTracer(object):
@@ -298,6 +1119,10 @@ class BufferingTracer(object):
     This means that for a max_traces of 5 if 10 traces are received, all
     10 traces will be flushed to the next tracer.
 
+    Idle flushes are driven by a L{FlushScheduler} which is shared by all
+    tracers using the same reactor, so L{max_idle_time} is only accurate to
+    within the scheduler's interval.
+
     @param tracer: An L{ITracer} provider to record bufferred traces to.
 
     @param max_traces: C{int} of the number of traces to buffer before
@@ -306,54 +1131,294 @@ class BufferingTracer(object):
     @param max_idle_time: C{int} of number of seconds since the last trace was
         received to send all bufferred traces.  Default 10.
 
+    @param flush_scheduler: The L{FlushScheduler} used for idle flushes.
+        Default: the result of L{get_flush_scheduler} for C{_reactor}.
+
+    @param buffer_factory: A callable returning an empty buffer with
+        C{extend} and C{__len__}, whose iteration gives the buffered traces,
+        such as L{tryfer.columnar.ColumnarSpanBuffer}.  Default C{list}.
+
     @param _reactor: An L{I_reactorTime} provider used to defer buffering to a
         future reactor iteration.
     """
     implements(ITracer)
 
-    def __init__(self, tracer, max_traces=50, max_idle_time=10, _reactor=None):
+    def __init__(self, tracer, max_traces=50, max_idle_time=10,
+                 flush_scheduler=None, buffer_factory=list, _reactor=None):
         self._max_traces = max_traces
         self._max_idle_time = max_idle_time
 
         self._reactor = _reactor or reactor
+        self._scheduler = flush_scheduler or get_flush_scheduler(
+            self._reactor)
         self._tracer = tracer
-        self._buffer = []
-        self._idle_dc = None
+        self._buffer_factory = buffer_factory
+        self._buffer = buffer_factory()
         self._flush_dc = None
-
-    def _reset(self):
-        if self._idle_dc and self._idle_dc.active():
-            self._idle_dc.reset(self._max_idle_time)
-        else:
-            self._idle_dc = self._reactor.callLater(
-                self._max_idle_time, self._flush)
+        self._in_flight = set()
 
     def _flush(self):
-        if self._idle_dc and self._idle_dc.active():
-            self._idle_dc.cancel()
+        self._scheduler.cancel(self._flush)
 
         if self._flush_dc is not None:
             self._flush_dc = None
 
         flushable = self._buffer
-        self._buffer = []
+        self._buffer = self._buffer_factory()
 
         if flushable:
-            self._tracer.record(flushable)
+            if not isinstance(flushable, list):
+                flushable = list(flushable)
+
+            d = self._tracer.record(flushable)
+
+            if isinstance(d, Deferred) and not d.called:
+                self._in_flight.add(d)
+                d.addBoth(self._delivered, d)
+
+    def _delivered(self, result, d):
+        self._in_flight.discard(d)
+        return result
+
+    def drain(self):
+        """
+        Flush the buffer now, then drain the next tracer and wait for every
+        delivery still in flight.
+        """
+        self._flush()
+
+        return DeferredList(
+            [drain(self._tracer)] + list(self._in_flight),
+            consumeErrors=True)
 
     def record(self, traces):
         self._buffer.extend(traces)
 
-        if len(self._buffer) >= self._max_traces:
+        if len(self._buffer) >= self._max_traces or not self._max_idle_time:
             # The buffer is full, flush in the next _reactor iteration.  If
             # we have not already scheduled a flush to happen.
             if self._flush_dc is None:
                 self._flush_dc = self._reactor.callLater(0, self._flush)
 
         else:
-            # The buffer is not full, reset the idle timer to DelayedCall to
-            # flush after 10 seconds.
-            self._reset()
+            # The buffer is not full, push back the idle flush so it happens
+            # max_idle_time seconds from now.
+            self._scheduler.schedule(self._flush, self._max_idle_time)
+
+
+class _SinkQueue(object):
+    """
+    Deliver payloads to one sink of a L{FanOutTracer} in order, with at most
+    C{concurrency} deliveries in flight and at most C{max_pending} waiting.
+    When the queue is full the oldest waiting payload is dropped.
+    """
+
+    def __init__(self, deliver, concurrency=1, max_pending=100):
+        self._deliver = deliver
+        self._concurrency = concurrency
+        self._max_pending = max_pending
+        self._pending = deque()
+        self._in_flight = 0
+        self._drained = []
+
+        self.dropped = 0
+
+    def put(self, payload):
+        if len(self._pending) >= self._max_pending:
+            self._pending.popleft()
+            self.dropped += 1
+            log.msg(format="Dropped traces for slow sink: %(sink)r",
+                    system=FanOutTracer.__name__,
+                    sink=self._deliver)
+
+        self._pending.append(payload)
+        self._next()
+
+    def _next(self):
+        while self._pending and self._in_flight < self._concurrency:
+            self._in_flight += 1
+
+            d = maybeDeferred(self._deliver, self._pending.popleft())
+            d.addErrback(log.err, "Error delivering traces.")
+            d.addBoth(self._delivered)
+
+    def _delivered(self, result):
+        self._in_flight -= 1
+        self._next()
+
+        if not self._in_flight and self._drained:
+            drained, self._drained = self._drained, []
+
+            for d in drained:
+                d.callback(None)
+
+    def drain(self):
+        """
+        @returns: A L{Deferred} which fires once every queued payload has
+            been delivered.
+        """
+        if not self._in_flight:
+            return succeed(None)
+
+        d = Deferred()
+        self._drained.append(d)
+        return d
+
+
+class _FanOut(object):
+    implements(ITracer)
+
+    def __init__(self, sinks, concurrency, max_pending):
+        self._sinks = []
+
+        for sink in sinks:
+            formatter = getattr(sink, 'formatter', None)
+
+            if formatter is None:
+                deliver = sink.record
+            else:
+                deliver = sink.deliver
+
+            self._sinks.append(
+                (formatter, _SinkQueue(deliver, concurrency, max_pending)))
+
+    def record(self, traces):
+        encoded = {}
+
+        for (formatter, queue) in self._sinks:
+            if formatter is None:
+                queue.put(traces)
+                continue
+
+            if formatter not in encoded:
+                encoded[formatter] = formatter(traces)
+
+            queue.put(encoded[formatter])
+
+    def drain(self):
+        return DeferredList(
+            [queue.drain() for (_, queue) in self._sinks])
+
+
+class FanOutTracer(object):
+    """
+    Send the same traces to several tracers while only aggregating,
+    buffering and encoding them once.
+
+    This is equivalent to EndAnnotationTracer(BufferingTracer(...)) in front
+    of every sink, except that sinks which share a C{formatter}, such as
+    L{RawRESTkinHTTPTracer} and L{RawRESTkinScribeTracer}, are handed the
+    same encoded payload.  Sinks without a C{formatter} and C{deliver}
+    method are given the traces themselves via C{record}.
+
+    Each sink has its own queue so a slow sink does not hold up the others.
+
+    @param sinks: A C{list} of raw L{ITracer} providers.
+
+    @param end_annotations: See L{EndAnnotationTracer}
+
+    @param max_traces: See L{BufferingTracer}
+
+    @param max_idle_time: See L{BufferingTracer}
+
+    @param concurrency: C{int} maximum number of deliveries in flight to
+        each sink.  Default 1.
+
+    @param max_pending: C{int} maximum number of batches waiting for each
+        sink.  Beyond this the oldest batch is dropped.  Default 100.
+
+    @param _reactor: See L{BufferingTracer}
+    """
+    implements(ITracer)
+
+    def __init__(self, sinks, end_annotations=None, max_traces=50,
+                 max_idle_time=10, concurrency=1, max_pending=100,
+                 _reactor=None):
+        self._fan_out = _FanOut(sinks, concurrency, max_pending)
+        self._tracer = EndAnnotationTracer(
+            BufferingTracer(
+                self._fan_out,
+                max_traces=max_traces,
+                max_idle_time=max_idle_time,
+                _reactor=_reactor),
+            end_annotations=end_annotations
+        )
+
+    def dropped(self):
+        """
+        @returns: A C{list} of the number of batches dropped for each sink,
+            in the order the sinks were given.
+        """
+        return [queue.dropped for (_, queue) in self._fan_out._sinks]
+
+    def record(self, traces):
+        return self._tracer.record(traces)
+
+    def drain(self):
+        return drain(self._tracer)
+
+
+class ThreadSafeTracer(object):
+    """
+    An L{ITracer} which may be recorded to from any thread, such as
+    C{deferToThread} workers and C{adbapi} connection pools, and records to
+    C{tracer} in the reactor thread.
+
+    Records made in the reactor thread are passed straight on.  Records
+    made in other threads are appended to a queue without taking a lock,
+    and the queue is drained into C{tracer} in a single batch by one
+    C{callFromThread} call, however many records arrive before the reactor
+    gets to it.
+
+    Wrap every tracer given to L{set_tracers} or L{push_tracer} with this if
+    traces are recorded outside the reactor thread.
+
+    @param tracer: An L{ITracer} provider which is only used from the
+        reactor thread.
+
+    @param _reactor: An L{IReactorThreads} provider.
+    """
+    implements(ITracer)
+
+    def __init__(self, tracer, _reactor=None):
+        self._tracer = tracer
+        self._reactor = _reactor or reactor
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._scheduled = False
+
+    def record(self, traces):
+        if isInIOThread():
+            return self._tracer.record(traces)
+
+        # deque.extend is atomic, so only deciding whether a drain needs
+        # to be scheduled takes the lock.
+        self._queue.extend(traces)
+
+        with self._lock:
+            if self._scheduled:
+                return
+
+            self._scheduled = True
+
+        self._reactor.callFromThread(self._drain)
+
+    def _drain(self):
+        with self._lock:
+            self._scheduled = False
+
+        traces = []
+        queue = self._queue
+
+        while queue:
+            traces.append(queue.popleft())
+
+        if traces:
+            self._tracer.record(traces)
+
+    def drain(self):
+        self._drain()
+        return drain(self._tracer)
 
 
 _globalTracers = []
@@ -371,3 +1436,51 @@ def push_tracer(tracer):
 
 def get_tracers():
     return _globalTracers
+
+
+def drain_on_shutdown(tracers=None, timeout=5, _reactor=None):
+    """
+    Drain tracers before the reactor shuts down, so that spans which are
+    still buffered, or whose end annotation has not been recorded, are sent
+    rather than lost.
+
+    Shutdown waits for deliveries in flight but never for longer than
+    C{timeout} seconds, so it stays bounded even if collectors are down.
+
+    @param tracers: A C{list} of L{ITracer} providers, or C{None} to drain
+        the global tracers as they are at shutdown.
+
+    @param timeout: C{int} or C{float} seconds.  Default 5.
+
+    @param _reactor: An L{IReactorCore} and L{IReactorTime} provider.
+
+    @returns: The ID of the system event trigger, for use with
+        C{removeSystemEventTrigger}.
+    """
+    _reactor = _reactor or reactor
+
+    def _drain():
+        finished = Deferred()
+
+        def _done(result):
+            if not finished.called:
+                timer.cancel()
+                finished.callback(None)
+
+        def _timed_out():
+            log.msg(format="Gave up draining tracers after %(timeout)s "
+                           "seconds.",
+                    system='drain_on_shutdown',
+                    timeout=timeout)
+            finished.callback(None)
+
+        timer = _reactor.callLater(timeout, _timed_out)
+
+        DeferredList(
+            [drain(tracer)
+             for tracer in (get_tracers() if tracers is None else tracers)],
+            consumeErrors=True).addCallback(_done)
+
+        return finished
+
+    return _reactor.addSystemEventTrigger('before', 'shutdown', _drain)